@@ -0,0 +1,37 @@
+"""add user presence
+
+Revision ID: 3f9c2b7d41a8
+Revises: e6413e54287f
+Create Date: 2026-10-17 09:12:41.518230
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2b7d41a8'
+down_revision: Union[str, None] = 'e6413e54287f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'user_presence',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('last_seen_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('online_until', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_user_presence_online_until'), 'user_presence', ['online_until'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_user_presence_online_until'), table_name='user_presence')
+    op.drop_table('user_presence')
@@ -0,0 +1,60 @@
+"""read watermarks instead of message_read_status
+
+Revision ID: 5d2e7b9c1f04
+Revises: 8c1e5a0f7d23
+Create Date: 2026-10-17 14:03:27.904112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2e7b9c1f04'
+down_revision: Union[str, None] = '8c1e5a0f7d23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        'chat_members',
+        sa.Column('last_read_message_id', sa.Integer(), server_default=sa.text('0'), nullable=False)
+    )
+    # Сжатие построчных отметок: отметка участника - последнее прочитанное им сообщение чата
+    op.execute("""
+        UPDATE chat_members AS cm
+        SET last_read_message_id = latest.message_id
+        FROM (
+            SELECT m.chat_id, r.user_id, max(r.message_id) AS message_id
+            FROM message_read_status AS r
+            JOIN messages AS m ON m.id = r.message_id
+            GROUP BY m.chat_id, r.user_id
+        ) AS latest
+        WHERE cm.chat_id = latest.chat_id AND cm.user_id = latest.user_id
+    """)
+    op.drop_table('message_read_status')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table(
+        'message_read_status',
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('read_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('message_id', 'user_id')
+    )
+    # Отметка разворачивается обратно в строку на каждое сообщение до неё
+    op.execute("""
+        INSERT INTO message_read_status (message_id, user_id, read_at)
+        SELECT m.id, cm.user_id, now()
+        FROM chat_members AS cm
+        JOIN messages AS m ON m.chat_id = cm.chat_id AND m.id <= cm.last_read_message_id
+    """)
+    op.drop_column('chat_members', 'last_read_message_id')
@@ -0,0 +1,28 @@
+"""add messages (chat_id, id) index
+
+Revision ID: 8c1e5a0f7d23
+Revises: 3f9c2b7d41a8
+Create Date: 2026-10-17 11:40:03.274915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c1e5a0f7d23'
+down_revision: Union[str, None] = '3f9c2b7d41a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
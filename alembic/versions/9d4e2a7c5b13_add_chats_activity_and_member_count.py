@@ -0,0 +1,136 @@
+"""add chats last_message_id, last_activity_at, member_count
+
+Revision ID: 9d4e2a7c5b13
+Revises: f3a9c61d7e28
+Create Date: 2026-10-17 19:05:44.271930
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4e2a7c5b13'
+down_revision: Union[str, None] = 'f3a9c61d7e28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column(
+        'chats',
+        sa.Column('last_activity_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False)
+    )
+    op.add_column('chats', sa.Column('member_count', sa.Integer(), server_default=sa.text('0'), nullable=False))
+
+    # Начальные значения по текущим данным
+    op.execute("""
+        UPDATE chats AS c
+        SET last_message_id = m.id,
+            last_activity_at = COALESCE(m.created_at, c.created_at),
+            member_count = (SELECT count(*) FROM chat_members AS cm WHERE cm.chat_id = c.id)
+        FROM chats AS base
+        LEFT JOIN LATERAL (
+            SELECT id, created_at FROM messages WHERE chat_id = base.id ORDER BY id DESC LIMIT 1
+        ) AS m ON true
+        WHERE base.id = c.id
+    """)
+    op.create_index('ix_chats_last_activity_at_id', 'chats', ['last_activity_at', 'id'], unique=False)
+
+    # Триггеры уровня оператора: многострочная вставка (групповая запись,
+    # пакеты) обновляет строку чата один раз
+    op.execute("""
+        CREATE FUNCTION chats_on_messages_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE chats AS c
+            SET last_message_id = n.last_message_id,
+                last_activity_at = GREATEST(c.last_activity_at, n.last_activity_at)
+            FROM (
+                SELECT chat_id, max(id) AS last_message_id, max(created_at) AS last_activity_at
+                FROM new_messages
+                GROUP BY chat_id
+            ) AS n
+            WHERE c.id = n.chat_id
+              AND (c.last_message_id IS NULL OR c.last_message_id < n.last_message_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER messages_update_chat_activity
+        AFTER INSERT ON messages
+        REFERENCING NEW TABLE AS new_messages
+        FOR EACH STATEMENT EXECUTE FUNCTION chats_on_messages_insert()
+    """)
+    # Удаление последнего сообщения возвращает чату предыдущее
+    op.execute("""
+        CREATE FUNCTION chats_on_messages_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE chats AS c
+            SET last_message_id = m.id,
+                last_activity_at = COALESCE(m.created_at, c.created_at)
+            FROM chats AS base
+            LEFT JOIN LATERAL (
+                SELECT id, created_at FROM messages WHERE chat_id = base.id ORDER BY id DESC LIMIT 1
+            ) AS m ON true
+            WHERE base.id = c.id
+              AND c.last_message_id IN (SELECT id FROM old_messages);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER messages_restore_chat_activity
+        AFTER DELETE ON messages
+        REFERENCING OLD TABLE AS old_messages
+        FOR EACH STATEMENT EXECUTE FUNCTION chats_on_messages_delete()
+    """)
+    op.execute("""
+        CREATE FUNCTION chats_on_members_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE chats AS c
+                SET member_count = c.member_count + n.added
+                FROM (SELECT chat_id, count(*) AS added FROM new_members GROUP BY chat_id) AS n
+                WHERE c.id = n.chat_id;
+            ELSE
+                UPDATE chats AS c
+                SET member_count = c.member_count - o.removed
+                FROM (SELECT chat_id, count(*) AS removed FROM old_members GROUP BY chat_id) AS o
+                WHERE c.id = o.chat_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER chat_members_count_insert
+        AFTER INSERT ON chat_members
+        REFERENCING NEW TABLE AS new_members
+        FOR EACH STATEMENT EXECUTE FUNCTION chats_on_members_change()
+    """)
+    op.execute("""
+        CREATE TRIGGER chat_members_count_delete
+        AFTER DELETE ON chat_members
+        REFERENCING OLD TABLE AS old_members
+        FOR EACH STATEMENT EXECUTE FUNCTION chats_on_members_change()
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER chat_members_count_delete ON chat_members")
+    op.execute("DROP TRIGGER chat_members_count_insert ON chat_members")
+    op.execute("DROP FUNCTION chats_on_members_change()")
+    op.execute("DROP TRIGGER messages_restore_chat_activity ON messages")
+    op.execute("DROP FUNCTION chats_on_messages_delete()")
+    op.execute("DROP TRIGGER messages_update_chat_activity ON messages")
+    op.execute("DROP FUNCTION chats_on_messages_insert()")
+    op.drop_index('ix_chats_last_activity_at_id', table_name='chats')
+    op.drop_column('chats', 'member_count')
+    op.drop_column('chats', 'last_activity_at')
+    op.drop_column('chats', 'last_message_id')
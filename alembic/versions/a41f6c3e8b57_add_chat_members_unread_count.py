@@ -0,0 +1,44 @@
+"""add chat_members unread_count
+
+Revision ID: a41f6c3e8b57
+Revises: 5d2e7b9c1f04
+Create Date: 2026-10-17 15:21:08.337415
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f6c3e8b57'
+down_revision: Union[str, None] = '5d2e7b9c1f04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        'chat_members',
+        sa.Column('unread_count', sa.Integer(), server_default=sa.text('0'), nullable=False)
+    )
+    # Начальные значения счётчиков по текущим отметкам прочтения
+    op.execute("""
+        UPDATE chat_members AS cm
+        SET unread_count = (
+            SELECT count(*)
+            FROM messages AS m
+            WHERE m.chat_id = cm.chat_id
+              AND m.id > cm.last_read_message_id
+              AND m.sender_id <> cm.user_id
+        )
+    """)
+    op.create_index('ix_chat_members_user_id', 'chat_members', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_members_user_id', table_name='chat_members')
+    op.drop_column('chat_members', 'unread_count')
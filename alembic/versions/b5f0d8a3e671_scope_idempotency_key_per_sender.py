@@ -0,0 +1,46 @@
+"""scope messages idempotency_key per sender
+
+Revision ID: b5f0d8a3e671
+Revises: e1b83f5a2c49
+Create Date: 2026-10-17 17:32:51.640273
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5f0d8a3e671'
+down_revision: Union[str, None] = 'e1b83f5a2c49'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.drop_constraint('messages_idempotency_key_key', 'messages', type_='unique')
+    # Ключ уникален в пределах отправителя; очищенные (NULL) ключи в индекс не попадают
+    op.create_index(
+        'ix_messages_sender_id_idempotency_key',
+        'messages',
+        ['sender_id', 'idempotency_key'],
+        unique=True,
+        postgresql_where=sa.text('idempotency_key IS NOT NULL')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_sender_id_idempotency_key', table_name='messages')
+    # Ключ, совпавший у разных отправителей, остаётся только у первого сообщения
+    op.execute("""
+        UPDATE messages AS m
+        SET idempotency_key = NULL
+        WHERE EXISTS (
+            SELECT 1 FROM messages AS earlier
+            WHERE earlier.idempotency_key = m.idempotency_key AND earlier.id < m.id
+        )
+    """)
+    op.create_unique_constraint('messages_idempotency_key_key', 'messages', ['idempotency_key'])
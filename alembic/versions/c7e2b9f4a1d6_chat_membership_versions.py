@@ -0,0 +1,94 @@
+"""chat membership versions and change log
+
+Revision ID: c7e2b9f4a1d6
+Revises: 9d4e2a7c5b13
+Create Date: 2026-10-17 20:12:08.514377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2b9f4a1d6'
+down_revision: Union[str, None] = '9d4e2a7c5b13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('membership_version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    op.create_table(
+        'chat_membership_changes',
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('action', sa.String(length=10), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('chat_id', 'version', 'user_id')
+    )
+
+    # Каждый оператор над chat_members - одна новая версия состава чата
+    # и строки изменений с этой версией (по одной на участника)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION chats_on_members_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                WITH bumped AS (
+                    UPDATE chats AS c
+                    SET member_count = c.member_count + n.added,
+                        membership_version = c.membership_version + 1
+                    FROM (SELECT chat_id, count(*) AS added FROM new_members GROUP BY chat_id) AS n
+                    WHERE c.id = n.chat_id
+                    RETURNING c.id, c.membership_version
+                )
+                INSERT INTO chat_membership_changes (chat_id, version, user_id, action)
+                SELECT b.id, b.membership_version, m.user_id, 'added'
+                FROM bumped AS b
+                JOIN new_members AS m ON m.chat_id = b.id;
+            ELSE
+                WITH bumped AS (
+                    UPDATE chats AS c
+                    SET member_count = c.member_count - o.removed,
+                        membership_version = c.membership_version + 1
+                    FROM (SELECT chat_id, count(*) AS removed FROM old_members GROUP BY chat_id) AS o
+                    WHERE c.id = o.chat_id
+                    RETURNING c.id, c.membership_version
+                )
+                INSERT INTO chat_membership_changes (chat_id, version, user_id, action)
+                SELECT b.id, b.membership_version, m.user_id, 'removed'
+                FROM bumped AS b
+                JOIN old_members AS m ON m.chat_id = b.id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("""
+        CREATE OR REPLACE FUNCTION chats_on_members_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE chats AS c
+                SET member_count = c.member_count + n.added
+                FROM (SELECT chat_id, count(*) AS added FROM new_members GROUP BY chat_id) AS n
+                WHERE c.id = n.chat_id;
+            ELSE
+                UPDATE chats AS c
+                SET member_count = c.member_count - o.removed
+                FROM (SELECT chat_id, count(*) AS removed FROM old_members GROUP BY chat_id) AS o
+                WHERE c.id = o.chat_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.drop_table('chat_membership_changes')
+    op.drop_column('chats', 'membership_version')
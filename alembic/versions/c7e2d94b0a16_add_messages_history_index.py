@@ -0,0 +1,33 @@
+"""add messages (chat_id, created_at, id) index
+
+Revision ID: c7e2d94b0a16
+Revises: a41f6c3e8b57
+Create Date: 2026-10-17 16:02:51.772903
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2d94b0a16'
+down_revision: Union[str, None] = 'a41f6c3e8b57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_messages_chat_id_created_at_id',
+        'messages',
+        ['chat_id', 'created_at', 'id'],
+        unique=False
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_chat_id_created_at_id', table_name='messages')
@@ -0,0 +1,34 @@
+"""add messages created_at brin index
+
+Revision ID: e1b83f5a2c49
+Revises: c7e2d94b0a16
+Create Date: 2026-10-17 16:44:13.208561
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1b83f5a2c49'
+down_revision: Union[str, None] = 'c7e2d94b0a16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_messages_created_at_brin',
+        'messages',
+        ['created_at'],
+        unique=False,
+        postgresql_using='brin'
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_created_at_brin', table_name='messages')
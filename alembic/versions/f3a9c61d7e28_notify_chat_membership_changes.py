@@ -0,0 +1,48 @@
+"""notify chat_membership on chat_members changes
+
+Revision ID: f3a9c61d7e28
+Revises: b5f0d8a3e671
+Create Date: 2026-10-17 18:20:37.518904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a9c61d7e28'
+down_revision: Union[str, None] = 'b5f0d8a3e671'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Кэши составов чатов во всех процессах сбрасываются по chat_id из уведомления;
+    # обновления счётчиков и отметок прочтения триггер не затрагивают
+    op.execute("""
+        CREATE FUNCTION notify_chat_membership() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                PERFORM pg_notify('chat_membership', OLD.chat_id::text);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('chat_membership', NEW.chat_id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER chat_members_notify_membership
+        AFTER INSERT OR DELETE OR UPDATE OF chat_id, user_id ON chat_members
+        FOR EACH ROW EXECUTE FUNCTION notify_chat_membership()
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER chat_members_notify_membership ON chat_members")
+    op.execute("DROP FUNCTION notify_chat_membership()")
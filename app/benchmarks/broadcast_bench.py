@@ -0,0 +1,133 @@
+"""
+Бенчмарк рассылки события в чат: стоимость на одного получателя.
+
+Сравнивает старый путь (json round-trip + json.dumps на каждого получателя)
+с сериализацией события один раз в готовый кадр, который раскладывается
+по исходящим очередям соединений. Отдельно показывает, что один медленный
+клиент больше не задерживает рассылку остальным.
+
+Запуск (из директории app/):
+    python -m benchmarks.broadcast_bench
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from src.core.logging import logger
+from src.features.websocket.session_manager import WebSocketSessionManager
+from src.features.websocket.utils import DateTimeEncoder
+
+
+RECIPIENTS = (10, 100, 1000, 5000)
+ROUNDS = 200
+
+
+class FakeWebSocket:
+    """Заглушка WebSocket, которая только считает отправленные байты"""
+    def __init__(self, delay: float = 0):
+        self.sent_bytes = 0
+        self.delay = delay
+
+    async def send_text(self, data: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent_bytes += len(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def drain(manager: WebSocketSessionManager):
+    """Ожидание, пока writer-задачи отправят все кадры"""
+    while any(sender.depth for sender in manager.senders.values()):
+        await asyncio.sleep(0)
+
+
+def make_event() -> dict:
+    return {
+        "message_type": "new_message",
+        "message_id": 123456,
+        "chat_id": 1,
+        "sender_id": 0,
+        "text": "Привет! " * 20,
+        "timestamp": datetime.utcnow()
+    }
+
+
+async def legacy_broadcast(connections, chat_id: int, message: dict, current_user_id: int):
+    """Прежняя реализация broadcast_message (без логирования)"""
+    message_json = json.loads(json.dumps(message, cls=DateTimeEncoder))
+    for user_id, websockets in connections[chat_id].items():
+        if user_id == current_user_id:
+            continue
+        for websocket in websockets:
+            await websocket.send_text(json.dumps(message_json, cls=DateTimeEncoder))
+
+
+async def run_case(recipients: int) -> tuple[float, float]:
+    manager = WebSocketSessionManager()
+    connections = defaultdict(lambda: defaultdict(set))
+    for user_id in range(1, recipients + 1):
+        websocket = FakeWebSocket()
+        connections[1][user_id].add(websocket)
+        await manager.connect(websocket, 1, user_id)
+
+    event = make_event()
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        await legacy_broadcast(connections, 1, event, 0)
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        await manager.broadcast_message(1, event, 0)
+    await drain(manager)
+    encode_once = time.perf_counter() - started
+
+    for user_id, websockets in list(manager.active_connections[1].items()):
+        for websocket in list(websockets):
+            await manager.disconnect(websocket, 1, user_id)
+
+    per_recipient = ROUNDS * recipients / 1e6
+    return legacy / per_recipient, encode_once / per_recipient
+
+
+async def run_slow_consumer_case(recipients: int = 100) -> float:
+    """Время доставки одного события быстрым клиентам при одном медленном"""
+    manager = WebSocketSessionManager(send_queue_size=16)
+    slow = FakeWebSocket(delay=0.5)
+    await manager.connect(slow, 1, 1)
+    fast = []
+    for user_id in range(2, recipients + 2):
+        websocket = FakeWebSocket()
+        fast.append(websocket)
+        await manager.connect(websocket, 1, user_id)
+
+    started = time.perf_counter()
+    await manager.broadcast_message(1, make_event(), 0)
+    while not all(websocket.sent_bytes for websocket in fast):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    for user_id, websockets in list(manager.active_connections[1].items()):
+        for websocket in list(websockets):
+            await manager.disconnect(websocket, 1, user_id)
+    return elapsed
+
+
+async def main():
+    logger.remove()
+    print(f"{'recipients':>10} | {'legacy, us/recipient':>20} | {'encode-once, us/recipient':>25} | speedup")
+    for recipients in RECIPIENTS:
+        legacy, encode_once = await run_case(recipients)
+        print(f"{recipients:>10} | {legacy:>20.3f} | {encode_once:>25.3f} | x{legacy / encode_once:.1f}")
+
+    elapsed = await run_slow_consumer_case()
+    print(f"\nOne slow consumer (0.5s per frame): fast recipients served in {elapsed * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
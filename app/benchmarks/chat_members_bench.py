@@ -0,0 +1,118 @@
+"""
+Бенчмарк создания группового чата и добавления участников.
+
+Сравнивает прежний путь - поиск каждого приглашённого отдельным запросом
+(UserRepository.get_by_id в цикле) - с поиском всех одним запросом
+id = ANY(:user_ids). Для текущего пути меряется и вся операция
+ChatService: create_chat с N участниками и add_members ещё N участников,
+каждая - один INSERT ... ON CONFLICT DO NOTHING и один commit.
+
+Бенчмарк создаёт временных пользователей и удаляет их (вместе с чатами) в конце.
+Нужна поднятая БД с хотя бы одним пользователем (например, после init_db.py).
+Запуск (из директории app/):
+    python -m benchmarks.chat_members_bench
+"""
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import select, delete, insert
+
+from src.core.db import AsyncSessionFactory, engine
+from src.core.logging import logger
+from src.features.chats.models import Chat
+from src.features.chats.schemas import ChatCreate, ChatType
+from src.features.chats.services import ChatService
+from src.features.users.models import User
+from src.features.users.repositories import UserRepository
+from src.features.users.schemas import UserInDB
+
+
+MEMBER_COUNTS = (10, 1_000, 10_000)
+
+
+async def create_users(prefix: str, count: int) -> list[int]:
+    """Временные пользователи одной вставкой"""
+    async with AsyncSessionFactory() as db:
+        result = await db.execute(
+            insert(User).returning(User.id),
+            [
+                {
+                    "username": f"{prefix}_{number}",
+                    "email": f"{prefix}_{number}@bench.local",
+                    "hashed_password": "-",
+                    "is_active": True
+                }
+                for number in range(count)
+            ]
+        )
+        user_ids = list(result.scalars().all())
+        await db.commit()
+        return user_ids
+
+
+async def lookup_one_by_one(user_ids: list[int]) -> float:
+    """Прежний путь: запрос на каждого приглашённого"""
+    async with AsyncSessionFactory() as db:
+        repository = UserRepository(db)
+        started = time.perf_counter()
+        for user_id in user_ids:
+            await repository.get_by_id(user_id)
+        return time.perf_counter() - started
+
+
+async def lookup_bulk(user_ids: list[int]) -> float:
+    """Текущий путь: один запрос id = ANY(:user_ids)"""
+    async with AsyncSessionFactory() as db:
+        started = time.perf_counter()
+        await UserRepository(db).get_by_ids(user_ids)
+        return time.perf_counter() - started
+
+
+async def create_and_extend(creator: UserInDB, first: list[int], second: list[int]) -> tuple[int, float, float]:
+    """Время create_chat с первой группой и add_members со второй"""
+    async with AsyncSessionFactory() as db:
+        service = ChatService(db)
+        started = time.perf_counter()
+        chat = await service.create_chat(
+            ChatCreate(name="Bench group", chat_type=ChatType.GROUP, member_ids=first),
+            creator
+        )
+        created = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await service.add_members(chat.id, second, creator)
+        return chat.id, created, time.perf_counter() - started
+
+
+async def main():
+    logger.remove()
+    engine.echo = False
+    async with AsyncSessionFactory() as db:
+        creator = (await db.execute(select(User).order_by(User.id).limit(1))).scalar_one_or_none()
+    if creator is None:
+        raise SystemExit("No users in the database, run init_db.py first")
+    creator = UserInDB.model_validate(creator)
+
+    prefix = f"bench_{uuid.uuid4().hex[:8]}"
+    user_ids = await create_users(prefix, 2 * max(MEMBER_COUNTS))
+    chat_ids = []
+    try:
+        print(f"{'members':>8} | {'lookup loop, ms':>15} | {'lookup ANY, ms':>14} | {'create_chat, ms':>15} | {'add_members, ms':>15}")
+        for count in MEMBER_COUNTS:
+            first, second = user_ids[:count], user_ids[count:2 * count]
+            loop = await lookup_one_by_one(first)
+            bulk = await lookup_bulk(first)
+            chat_id, created, added = await create_and_extend(creator, first, second)
+            chat_ids.append(chat_id)
+            print(f"{count:>8} | {loop * 1000:>15.1f} | {bulk * 1000:>14.1f} | {created * 1000:>15.1f} | {added * 1000:>15.1f}")
+    finally:
+        async with AsyncSessionFactory() as db:
+            await db.execute(delete(Chat).where(Chat.id.in_(chat_ids)))
+            await db.execute(delete(User).where(User.username.like(f"{prefix}_%")))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+"""
+Бенчмарк записи сообщений: сообщений в секунду при одновременных отправках.
+
+Сравнивает запись каждого сообщения своим запросом и commit
+(MessageRepository.create) с групповой записью через MessageWriteBuffer,
+где одновременные сообщения уходят одним запросом и одним commit.
+
+Нужна поднятая БД с хотя бы одним чатом (например, после init_db.py).
+Запуск (из директории app/):
+    python -m benchmarks.message_write_bench
+"""
+import asyncio
+import time
+
+from sqlalchemy import select
+
+from src.core.db import AsyncSessionFactory, engine
+from src.core.logging import logger
+from src.features.chats.members_model import chat_members
+from src.features.messages.repositories import MessageRepository
+from src.features.messages.schemas import MessageCreate
+from src.features.messages.write_buffer import MessageWriteBuffer
+
+
+CONCURRENCY = (1, 10, 50, 200)
+MESSAGES_PER_SENDER = 20
+
+
+async def create_one(message_data: MessageCreate, sender_id: int):
+    """Текущий путь: отдельный запрос и commit на каждое сообщение"""
+    async with AsyncSessionFactory() as db:
+        repository = MessageRepository(db)
+        message, _ = await repository.create(message_data, sender_id)
+        await repository.commit()
+        return message
+
+
+async def measure(send, chat_id: int, sender_id: int, senders: int) -> float:
+    async def sender(index: int):
+        for number in range(MESSAGES_PER_SENDER):
+            await send(MessageCreate(text=f"Bench {index}/{number}", chat_id=chat_id), sender_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(index) for index in range(senders)))
+    return senders * MESSAGES_PER_SENDER / (time.perf_counter() - started)
+
+
+async def main():
+    logger.remove()
+    engine.echo = False
+    async with AsyncSessionFactory() as db:
+        membership = (await db.execute(select(chat_members.c.chat_id, chat_members.c.user_id).limit(1))).first()
+    if membership is None:
+        raise SystemExit("No chats in the database, run init_db.py first")
+    chat_id, sender_id = membership
+
+    buffer = MessageWriteBuffer()
+    print(f"{'senders':>8} | {'per-message, msg/s':>18} | {'group commit, msg/s':>19} | speedup")
+    for senders in CONCURRENCY:
+        single = await measure(create_one, chat_id, sender_id, senders)
+        grouped = await measure(buffer.submit, chat_id, sender_id, senders)
+        print(f"{senders:>8} | {single:>18.0f} | {grouped:>19.0f} | x{grouped / single:.1f}")
+    await buffer.stop()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -24,6 +24,42 @@ class Settings(BaseSettings):
     VERSION: str
     API_V1_PREFIX: str
 
+    # WebSocket settings
+    WS_SEND_QUEUE_SIZE: int = 256  # Максимум кадров в исходящей очереди соединения
+    WS_SLOW_CONSUMER_POLICY: str = "drop_oldest"  # drop_oldest | coalesce | disconnect
+    WS_MAX_BACKLOG_MS: int = 5000  # Для disconnect: допустимый возраст самого старого кадра
+    WS_BROADCAST_BACKEND: str = "memory"  # memory | postgres (несколько воркеров/инстансов)
+    WS_BROADCAST_CHANNEL: str = "ws_events"  # Канал LISTEN/NOTIFY для рассылки событий
+    WS_BROADCAST_FLUSH_MS: int = 5  # Окно накопления событий перед NOTIFY
+    WS_PING_INTERVAL_SECONDS: float = 20  # Ping соединений, молчащих дольше этого интервала
+    WS_IDLE_TIMEOUT_SECONDS: float = 60  # Закрытие соединений без входящих кадров
+    WS_PRESENCE_FLUSH_SECONDS: float = 2  # Период пакетной записи присутствия в БД
+    WS_PRESENCE_TTL_SECONDS: float = 90  # Сколько пользователь считается онлайн после последней активности
+    WS_PRESENCE_GRACE_SECONDS: float = 10  # "offline" рассылается, только если пользователь не вернулся за это время
+    WS_PRESENCE_BATCH_MS: int = 250  # Окно объединения смен статусов в чате в один кадр
+    WS_CATCH_UP_LIMIT: int = 500  # Максимум пропущенных сообщений чата, догоняемых при переподключении
+    WS_CATCH_UP_BATCH: int = 100  # Сообщений в одном кадре catch_up
+    WS_MAX_IN_FLIGHT_FRAMES: int = 4  # Кадров одного соединения, обрабатываемых параллельно
+
+    # Chats settings
+    MEMBERSHIP_CACHE_SIZE: int = 10000  # Составов чатов в LRU-кэше процесса (0 - без кэша)
+    CHAT_INBOX_PREVIEW_LENGTH: int = 100  # Символов последнего сообщения в списке чатов
+    CHAT_MEMBERS_PAGE_SIZE: int = 50  # Участников в ответе о чате; остальные - GET /chats/{id}/members
+
+    # Query budget settings
+    QUERY_BUDGET_WARN_THRESHOLD: int = 20  # Запросов на HTTP-запрос или кадр, после которых пишется предупреждение
+    QUERY_BUDGET_REPEAT_THRESHOLD: int = 5  # Повторов одного запроса в пределах бюджета, считающихся N+1
+
+    # Read receipts settings
+    READ_RECEIPTS_MAX_READ_BY: int = 100  # Если прочитавших больше, вместо списка read_by отдаётся только read_count
+
+    # Messages settings
+    IDEMPOTENCY_KEY_TTL_HOURS: int = 72  # Через сколько часов ключ идемпотентности сообщения очищается
+    IDEMPOTENCY_KEY_PRUNE_INTERVAL_MINUTES: float = 60  # Период фоновой очистки устаревших ключей идемпотентности
+    MESSAGE_WRITE_BUFFER_ENABLED: bool = False  # Групповая запись: одновременные сообщения пишутся одним commit
+    MESSAGE_WRITE_BUFFER_DELAY_MS: int = 5  # Окно накопления сообщений перед записью пакета
+    MESSAGE_WRITE_BUFFER_MAX_SIZE: int = 100  # Пакет записывается сразу, как только набралось столько сообщений
+
     @property
     def DATABASE_URL(self) -> str:
         """
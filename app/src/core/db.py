@@ -1,7 +1,10 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 from dotenv import load_dotenv
 from src.config import get_settings
+from src.core.query_budget import install as install_query_budget
 
 # Явно загружаем .env файл перед получением настроек
 load_dotenv()
@@ -22,6 +25,8 @@ engine = create_async_engine(
     echo=True,  # Логирование SQL запросов
     future=True  # Использование новых функций SQLAlchemy
 )
+# Подсчёт запросов на HTTP-запрос и кадр WebSocket (N+1, бюджеты в тестах)
+install_query_budget(engine)
 
 # Создаем фабрику сессий
 AsyncSessionFactory = sessionmaker(
@@ -48,6 +53,22 @@ async def get_db() -> AsyncSession:
         finally:
             await session.close()
 
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Короткоживущая сессия БД вне зависимостей FastAPI.
+    Используется там, где соединение из пула нужно только на время одной операции
+    (например, обработка одного кадра WebSocket).
+    """
+    async with AsyncSessionFactory() as session:
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+
 def setup_db_relationships():
     from src.core.relationships import setup_relationships
     setup_relationships() 
\ No newline at end of file
@@ -0,0 +1,112 @@
+import asyncio
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+
+from src.config import get_settings
+from src.core.logging import logger
+
+
+class PgListener:
+    """
+    Выделенное соединение asyncpg для LISTEN/NOTIFY.
+
+    Одно соединение на процесс обслуживает все каналы: подписчики регистрируют
+    колбэки на канал, а при обрыве соединение переустанавливается и подписки
+    восстанавливаются.
+    """
+    def __init__(self, dsn: str, reconnect_delay: float = 1.0):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        self._conn: Optional[asyncpg.Connection] = None
+        self._lock = asyncio.Lock()
+        self._closing = False
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._reconnect_callbacks: List[Callable[[], None]] = []
+
+    @property
+    def is_connected(self) -> bool:
+        return self._conn is not None and not self._conn.is_closed()
+
+    async def start(self) -> None:
+        """Открытие соединения (повторный вызов ничего не делает)"""
+        self._closing = False
+        if not self.is_connected:
+            await self._connect()
+
+    async def stop(self) -> None:
+        """Закрытие соединения"""
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.debug(f"Error closing LISTEN connection: {str(e)}")
+
+    async def listen(self, channel: str, callback: Callable[[str], None]) -> None:
+        """Подписка колбэка на канал"""
+        first = channel not in self._callbacks
+        self._callbacks[channel].append(callback)
+        if first and self.is_connected:
+            await self._conn.add_listener(channel, self._dispatch)
+
+    def on_reconnect(self, callback: Callable[[], None]) -> None:
+        """Колбэк после переподключения: уведомления за время обрыва потеряны"""
+        self._reconnect_callbacks.append(callback)
+
+    async def notify(self, channel: str, payload: str) -> None:
+        """Отправка уведомления в канал"""
+        if not self.is_connected:
+            raise ConnectionError("LISTEN/NOTIFY connection is not established")
+        # Одно соединение asyncpg не допускает параллельных запросов
+        async with self._lock:
+            await self._conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+    async def _connect(self) -> None:
+        conn = await asyncpg.connect(self.dsn)
+        conn.add_termination_listener(self._on_terminated)
+        for channel in self._callbacks:
+            await conn.add_listener(channel, self._dispatch)
+        self._conn = conn
+        logger.info(f"LISTEN connection established, channels: {list(self._callbacks)}")
+
+    def _dispatch(self, connection, pid: int, channel: str, payload: str) -> None:
+        for callback in self._callbacks.get(channel, ()):
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Error handling notification on channel {channel}: {str(e)}")
+
+    def _on_terminated(self, connection) -> None:
+        if self._closing or connection is not self._conn:
+            return
+        logger.warning("LISTEN connection lost, reconnecting")
+        self._conn = None
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while not self._closing:
+            try:
+                await self._connect()
+            except Exception as e:
+                logger.warning(f"LISTEN reconnect failed: {str(e)}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            for callback in self._reconnect_callbacks:
+                callback()
+            return
+
+
+@lru_cache
+def get_pg_listener() -> PgListener:
+    """Общий для процесса экземпляр PgListener"""
+    settings = get_settings()
+    dsn = settings.DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+    return PgListener(dsn)
@@ -0,0 +1,89 @@
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.config import get_settings
+from src.core.logging import logger
+
+
+settings = get_settings()
+
+_current: ContextVar[Optional["QueryBudget"]] = ContextVar("query_budget", default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Запросов к БД больше, чем разрешено бюджетом"""
+
+
+class QueryBudget:
+    """
+    Счётчик запросов к БД в пределах HTTP-запроса, кадра WebSocket или теста.
+
+    Запросы считаются обработчиком before_cursor_execute движка (install) для
+    бюджета, активного в текущем контексте asyncio. При выходе из блока
+    пишется предупреждение, если запросов больше warn_threshold или один и тот
+    же запрос повторился repeat_threshold раз (признак N+1). Если задан limit,
+    превышение - ошибка (для тестов).
+
+    Пример:
+        with QueryBudget("chat list", limit=3) as budget:
+            await service.get_user_chats(user)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: Optional[int] = None,
+        warn_threshold: int = settings.QUERY_BUDGET_WARN_THRESHOLD,
+        repeat_threshold: int = settings.QUERY_BUDGET_REPEAT_THRESHOLD
+    ):
+        self.name = name
+        self.limit = limit
+        self.warn_threshold = warn_threshold
+        self.repeat_threshold = repeat_threshold
+        self.statements: Counter[str] = Counter()
+        self._token = None
+
+    @property
+    def count(self) -> int:
+        return sum(self.statements.values())
+
+    def record(self, statement: str) -> None:
+        self.statements[statement] += 1
+
+    def __enter__(self) -> "QueryBudget":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current.reset(self._token)
+        self.report()
+        if exc_type is None and self.limit is not None and self.count > self.limit:
+            raise QueryBudgetExceeded(
+                f"{self.name}: {self.count} queries, budget {self.limit}:\n" + "\n".join(self.statements)
+            )
+
+    def report(self) -> None:
+        """Предупреждения о превышении порога и повторяющихся запросах"""
+        if self.count > self.warn_threshold:
+            logger.warning(f"Query budget: {self.name} executed {self.count} queries")
+        for statement, repeats in self.statements.items():
+            if repeats >= self.repeat_threshold:
+                logger.warning(
+                    f"Possible N+1 in {self.name}: query repeated {repeats} times: {' '.join(statement.split())[:200]}"
+                )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    budget = _current.get()
+    if budget is not None:
+        budget.record(statement)
+
+
+def install(engine: AsyncEngine) -> None:
+    """Подключение подсчёта запросов к движку (повторный вызов ничего не делает)"""
+    if not event.contains(engine.sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
@@ -3,19 +3,30 @@ from sqlalchemy.orm import relationship
 from src.features.users.models import User
 from src.features.chats.models import Chat
 from src.features.messages.models import Message
-from src.features.chats.members_model import chat_members
-from src.features.messages.read_status_model import message_read_status
+from src.features.users.presence_model import user_presence
+# Триггеры статистики и состава чатов создаются вместе с таблицами и при create_all
+import src.features.chats.triggers  # noqa: F401
 
 
 def setup_relationships():
-    """Установка отношений между моделями"""
-    
+    """
+    Установка отношений между моделями
+
+    Коллекции с большим числом строк (сообщения, чаты пользователя) не
+    загружаются неявно: lazy="raise" требует явной выборки в репозитории, а
+    удаление полагается на ON DELETE CASCADE в БД (passive_deletes).
+    Участники чата не отображаются в ORM вовсе: составы и страницы участников
+    читаются проекциями из chat_members в ChatRepository.
+    """
+
     # Отношения между User и Chat
     User.created_chats = relationship(
         "Chat",
         back_populates="creator",
         foreign_keys="Chat.creator_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+        lazy="raise"
     )
     Chat.creator = relationship(
         "User",
@@ -23,58 +34,31 @@ def setup_relationships():
         foreign_keys="Chat.creator_id"
     )
 
-    # Отношения для участников чата (many-to-many)
-    User.chats = relationship(
-        "Chat",
-        secondary=chat_members,
-        back_populates="members",
-        lazy="selectin"
-    )
-    Chat.members = relationship(
-        "User",
-        secondary=chat_members,
-        back_populates="chats",
-        lazy="selectin"
-    )
-
     # Отношения для сообщений
     Message.sender = relationship(
         "User",
         back_populates="messages",
-        lazy="selectin"
+        lazy="raise"
     )
     User.messages = relationship(
         "Message",
         back_populates="sender",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+        lazy="raise"
     )
 
     Message.chat = relationship(
         "Chat",
         back_populates="messages",
-        lazy="selectin"
+        lazy="raise"
     )
     Chat.messages = relationship(
         "Message",
         back_populates="chat",
         cascade="all, delete-orphan",
-        lazy="selectin"
-    )
-
-    # Отношения для статусов прочтения сообщений
-    Message.read_by = relationship(
-        "User",
-        secondary=message_read_status,
-        back_populates="read_messages",
-        cascade="all",
-        lazy="selectin"
-    )
-    
-    User.read_messages = relationship(
-        "Message",
-        secondary=message_read_status,
-        back_populates="read_by",
-        lazy="selectin"
+        passive_deletes=True,
+        lazy="raise"
     )
 
 
@@ -1,7 +1,7 @@
 
 
 from src.core.db import Base
-from sqlalchemy import Column, Integer, ForeignKey, Table, PrimaryKeyConstraint
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Table, PrimaryKeyConstraint, Index, text
 
 # Промежуточная таблица для связи many-to-many между чатами и пользователями
 chat_members = Table(
@@ -9,5 +9,24 @@ chat_members = Table(
     Base.metadata,
     Column("chat_id", Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
     Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    # Отметка прочтения: участник прочитал все сообщения чата с id не больше этого
+    Column("last_read_message_id", Integer, nullable=False, server_default=text("0")),
+    # Число непрочитанных сообщений других участников; поддерживается при отправке и прочтении
+    Column("unread_count", Integer, nullable=False, server_default=text("0")),
     PrimaryKeyConstraint("chat_id", "user_id"),  # Составной первичный ключ
-)
\ No newline at end of file
+    # Счётчики непрочитанного по всем чатам пользователя
+    Index("ix_chat_members_user_id", "user_id"),
+)
+
+# Журнал изменений состава чатов: строка на участника в каждой версии состава.
+# Заполняется триггером на chat_members, версия - chats.membership_version
+chat_membership_changes = Table(
+    "chat_membership_changes",
+    Base.metadata,
+    Column("chat_id", Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("user_id", Integer, nullable=False),
+    Column("action", String(10), nullable=False),  # added / removed
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=text("now()")),
+    PrimaryKeyConstraint("chat_id", "version", "user_id"),
+)
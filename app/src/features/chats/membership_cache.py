@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from src.config import get_settings
+from src.core.logging import logger
+from src.core.pg_listener import PgListener, get_pg_listener
+
+
+settings = get_settings()
+
+# Канал, в который триггер chat_members шлёт chat_id при изменении состава чата
+MEMBERSHIP_CHANNEL = "chat_membership"
+
+# Чатов со счётчиком сбросов; при переполнении счётчики обнуляются сменой эпохи
+CHAT_VERSIONS_LIMIT = 100_000
+
+
+class MembershipCache:
+    """
+    Кэш составов чатов: chat_id -> frozenset id участников, с вытеснением LRU.
+
+    Изменения состава приходят из триггера chat_members через LISTEN/NOTIFY,
+    поэтому кэш сбрасывается во всех процессах, кто бы ни менял таблицу.
+    Пока соединение LISTEN не установлено, кэш не используется: без
+    уведомлений нельзя гарантировать, что состав не устарел.
+
+    Независимо от хранения составов (и при max_size=0) кэш ведёт версии чатов:
+    chat_version меняется только при сбросе состава чата, а не при вытеснении,
+    поэтому по ней держатели загруженного состава узнают, что его пора перечитать.
+    """
+
+    def __init__(self, listener: PgListener, max_size: int = settings.MEMBERSHIP_CACHE_SIZE):
+        self.listener = listener
+        self.max_size = max_size
+        self._members: OrderedDict[int, frozenset[int]] = OrderedDict()
+        # Растёт при каждом сбросе: состав, прочитанный до сброса, в кэш не попадает
+        self._version = 0
+        # chat_id -> число сбросов состава; эпоха растёт при сбросе всего кэша
+        self._chat_versions: dict[int, int] = {}
+        self._epoch = 0
+        self._started = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._started and self.max_size > 0 and self.listener.is_connected
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def chat_version(self, chat_id: int) -> tuple[int, int]:
+        """Версия состава чата: меняется при каждом его сбросе, включая сброс всего кэша"""
+        return self._epoch, self._chat_versions.get(chat_id, 0)
+
+    async def start(self) -> None:
+        await self.listener.listen(MEMBERSHIP_CHANNEL, self._on_notification)
+        self.listener.on_reconnect(self.clear)
+        await self.listener.start()
+        self._started = True
+        logger.info(f"Membership cache started: max_size={self.max_size}")
+
+    async def stop(self) -> None:
+        self._started = False
+        self.clear()
+        await self.listener.stop()
+
+    def get(self, chat_id: int) -> Optional[frozenset[int]]:
+        """Участники чата из кэша или None, если их нужно загрузить из БД"""
+        if not self.enabled:
+            return None
+        members = self._members.get(chat_id)
+        if members is not None:
+            self._members.move_to_end(chat_id)
+        return members
+
+    def put(self, chat_id: int, members: Iterable[int], version: int) -> None:
+        """
+        Сохранение загруженного состава
+
+        Args:
+            version: Значение version до запроса к БД; если с тех пор был сброс, состав отбрасывается
+        """
+        if not self.enabled or version != self._version:
+            return
+        self._members[chat_id] = members if isinstance(members, frozenset) else frozenset(members)
+        self._members.move_to_end(chat_id)
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._version += 1
+        self._members.pop(chat_id, None)
+        if chat_id not in self._chat_versions and len(self._chat_versions) >= CHAT_VERSIONS_LIMIT:
+            self._chat_versions.clear()
+            self._epoch += 1
+        self._chat_versions[chat_id] = self._chat_versions.get(chat_id, 0) + 1
+
+    def clear(self) -> None:
+        self._version += 1
+        self._members.clear()
+        self._chat_versions.clear()
+        self._epoch += 1
+
+    def _on_notification(self, payload: str) -> None:
+        self.invalidate(int(payload))
+
+
+membership_cache = MembershipCache(get_pg_listener())
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import String, DateTime, ForeignKey, Enum as SQLAlchemyEnum
+from sqlalchemy import String, DateTime, ForeignKey, Integer, Index, Enum as SQLAlchemyEnum
 
 from enum import Enum as PyEnum
 from typing import List
@@ -18,6 +18,9 @@ class ChatType(str, PyEnum):
 class Chat(Base):
     """Модель чата"""
     __tablename__ = "chats"
+    __table_args__ = (
+        Index("ix_chats_last_activity_at_id", "last_activity_at", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100))
@@ -35,5 +38,15 @@ class Chat(Base):
         onupdate=func.now(),
         nullable=False
     )
+    # Денормализованная статистика: поддерживается триггерами на messages и chat_members
+    last_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    last_activity_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False
+    )
+    member_count: Mapped[int] = mapped_column(Integer, server_default="0", nullable=False)
+    # Растёт на 1 с каждым изменением состава (см. chat_membership_changes)
+    membership_version: Mapped[int] = mapped_column(Integer, server_default="0", nullable=False)
 
 
@@ -1,47 +1,27 @@
+from datetime import datetime
 from typing import List, Optional
-from sqlalchemy import select
+from sqlalchemy import select, update, func, true, tuple_, any_, bindparam, literal, Integer
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 from src.core.logging import logger
 from src.features.chats.models import Chat
+from src.features.messages.models import Message
 from src.features.users.models import User
 from src.features.chats.schemas import ChatCreate, ChatUpdate
-from src.features.chats.members_model import chat_members
+from src.features.chats.members_model import chat_members, chat_membership_changes
 
 
 class ChatRepository:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def create(self, chat: Chat, creator_id: int, members: List[User]) -> Chat:
-        """Создание нового чата"""
+    async def create(self, chat: Chat, creator_id: int, member_ids: List[int]) -> Chat:
+        """Создание нового чата вместе с участниками - одна транзакция"""
         logger.debug(f"Creating chat: {chat.name}, type={chat.chat_type}")
-        try:
-            chat.creator_id = creator_id
-            
-            # Сначала создаем чат
-            self.db.add(chat)
-            await self.db.commit()
-            await self.db.refresh(chat)
-            
-            # Добавляем участников через промежуточную таблицу
-            stmt = chat_members.insert().values([
-                {"chat_id": chat.id, "user_id": member.id}
-                for member in members
-            ])
-            await self.db.execute(stmt)
-            await self.db.commit()
-            
-            # Получаем участников для сериализации
-            chat_members_list = await self.get_chat_members(chat.id)
-            setattr(chat, 'members', chat_members_list)
-            
-            logger.info(f"Created chat: id={chat.id}")
-            return chat
-        except Exception as e:
-            logger.error(f"Error creating chat: {str(e)}")
-            raise
+        chat.creator_id = creator_id
+        return await self.create_group(chat, member_ids)
 
     async def get_by_id(self, chat_id: int) -> Optional[Chat]:
         """Получение чата по ID"""
@@ -53,21 +33,19 @@ class ChatRepository:
         )
         return result.unique().scalar_one_or_none()
 
-    async def get_user_chats(self, user_id: int) -> List[Chat]:
-        """Получение всех чатов пользователя"""
+    async def get_user_chats(self, user_id: int, members_limit: int) -> List[dict]:
+        """Получение всех чатов пользователя с первыми страницами участников - два запроса при любом числе чатов"""
         logger.debug(f"Getting chats for user: {user_id}")
         result = await self.db.execute(
-            select(Chat)
-            .join(chat_members)
+            select(*Chat.__table__.c)
+            .join(chat_members, chat_members.c.chat_id == Chat.id)
             .where(chat_members.c.user_id == user_id)
+            .order_by(Chat.id)
         )
-        chats = list(result.unique().scalars().all())
-        
-        # Для каждого чата получаем его участников
+        chats = [dict(row._mapping) for row in result]
+        members = await self.get_member_pages([chat["id"] for chat in chats], members_limit)
         for chat in chats:
-            members = await self.get_chat_members(chat.id)
-            setattr(chat, 'members', members)
-        
+            chat["members"] = members[chat["id"]]
         return chats
 
     async def update(self, chat: Chat, chat_update: ChatUpdate) -> Chat:
@@ -87,50 +65,106 @@ class ChatRepository:
             logger.error(f"Error updating chat: {str(e)}")
             raise
 
-    async def add_members(self, chat: Chat, new_members: List[User]) -> Chat:
-        """Добавление участников в чат"""
-        logger.debug(f"Adding members to chat: id={chat.id}")
+    async def add_members(self, chat: Chat, member_ids: List[int]) -> Optional[dict]:
+        """
+        Добавление участников в чат: одна вставка и один commit при любом числе участников
+
+        Returns:
+            Optional[dict]: Изменение состава (chat_id, version, added, removed)
+                или None, если все уже состояли в чате
+        """
+        logger.debug(f"Adding {len(member_ids)} members to chat: id={chat.id}")
         try:
-            # Добавляем участников через промежуточную таблицу
-            stmt = chat_members.insert().values([
-                {"chat_id": chat.id, "user_id": member.id}
-                for member in new_members
-            ])
-            await self.db.execute(stmt)
+            added = await self._insert_members(chat.id, member_ids)
+            delta = await self._membership_delta(chat.id, added=added) if added else None
             await self.db.commit()
-            
-            # Получаем обновленный список участников
-            members = await self.get_chat_members(chat.id)
-            setattr(chat, 'members', members)
-            
-            logger.info(f"Added members to chat: id={chat.id}")
-            return chat
+            logger.info(f"Added {len(added)} members to chat: id={chat.id}")
+            return delta
         except Exception as e:
+            await self.db.rollback()
             logger.error(f"Error adding members to chat: {str(e)}")
             raise
 
-    async def remove_members(self, chat: Chat, member_ids: List[int]) -> Chat:
-        """Удаление участников из чата"""
+    async def _insert_members(self, chat_id: int, user_ids: List[int]) -> List[int]:
+        """
+        Вставка строк участников одним INSERT ... SELECT unnest(:user_ids)
+
+        Уже состоящие в чате пропускаются (ON CONFLICT DO NOTHING). Без commit.
+
+        Returns:
+            List[int]: id добавленных участников
+        """
+        user_id = func.unnest(bindparam("user_ids", list(user_ids), type_=ARRAY(Integer))).column_valued("user_id")
+        result = await self.db.execute(
+            pg_insert(chat_members)
+            .from_select(["chat_id", "user_id"], select(literal(chat_id, Integer), user_id))
+            .on_conflict_do_nothing(index_elements=["chat_id", "user_id"])
+            .returning(chat_members.c.user_id)
+        )
+        return list(result.scalars().all())
+
+    async def remove_members(self, chat: Chat, member_ids: List[int]) -> Optional[dict]:
+        """
+        Удаление участников из чата
+
+        Returns:
+            Optional[dict]: Изменение состава (chat_id, version, added, removed)
+                или None, если никто из них не состоял в чате
+        """
         logger.debug(f"Removing members from chat: id={chat.id}")
         try:
             # Удаляем участников из промежуточной таблицы
             stmt = chat_members.delete().where(
                 (chat_members.c.chat_id == chat.id) & 
                 (chat_members.c.user_id.in_(member_ids))
-            )
-            await self.db.execute(stmt)
+            ).returning(chat_members.c.user_id)
+            removed = list((await self.db.execute(stmt)).scalars().all())
+            delta = await self._membership_delta(chat.id, removed=removed) if removed else None
             await self.db.commit()
-            
-            # Получаем обновленный список участников
-            remaining_members = await self.get_chat_members(chat.id)
-            setattr(chat, 'members', remaining_members)
-            
             logger.info(f"Removed members from chat: id={chat.id}")
-            return chat
+            return delta
         except Exception as e:
+            await self.db.rollback()
             logger.error(f"Error removing members from chat: {str(e)}")
             raise
 
+    async def _membership_delta(self, chat_id: int, added: List[int] = (), removed: List[int] = ()) -> dict:
+        """
+        Изменение состава, выполненное в текущей транзакции, с его версией
+
+        Версию назначил триггер на chat_members; строка чата заблокирована
+        до commit, поэтому прочитанная версия - версия именно этого изменения.
+        """
+        version = await self.get_membership_version(chat_id)
+        return {"chat_id": chat_id, "version": version, "added": sorted(added), "removed": sorted(removed)}
+
+    async def get_membership_version(self, chat_id: int) -> Optional[int]:
+        """Текущая версия состава чата"""
+        result = await self.db.execute(select(Chat.membership_version).where(Chat.id == chat_id))
+        return result.scalar_one_or_none()
+
+    async def get_membership_changes(self, chat_id: int, since: int, until: int) -> List[dict]:
+        """
+        Изменения состава чата с версиями в (since, until] - по первичному ключу журнала
+
+        Returns:
+            List[dict]: version, user_id, action по возрастанию версии
+        """
+        result = await self.db.execute(
+            select(
+                chat_membership_changes.c.version,
+                chat_membership_changes.c.user_id,
+                chat_membership_changes.c.action
+            )
+            .where(
+                (chat_membership_changes.c.chat_id == chat_id) &
+                (chat_membership_changes.c.version > since) &
+                (chat_membership_changes.c.version <= until)
+            )
+            .order_by(chat_membership_changes.c.version, chat_membership_changes.c.user_id)
+        )
+        return [dict(row._mapping) for row in result]
+
     async def create_personal(self, chat: Chat) -> Chat:
         """Создание личного чата"""
         try:
@@ -142,39 +176,243 @@ class ChatRepository:
             logger.error(f"Error creating personal chat: {str(e)}")
             raise
 
-    async def get_chat_members(self, chat_id: int) -> List[User]:
-        """Получение участников чата"""
-        result = await self.db.execute(
-            select(User)
-            .join(chat_members)
+    async def get_member_page(self, chat_id: int, limit: int, after: Optional[int] = None) -> List[dict]:
+        """
+        Страница участников чата: только (id, username), без ORM-сущностей
+
+        Keyset по первичному ключу chat_members (chat_id, user_id): страница
+        читается по индексу за O(limit) при любом размере группы.
+
+        Args:
+            chat_id: ID чата
+            limit: Размер страницы
+            after: Курсор - id последнего участника предыдущей страницы
+        """
+        query = (
+            select(chat_members.c.user_id.label("id"), User.username)
+            .join(User, User.id == chat_members.c.user_id)
             .where(chat_members.c.chat_id == chat_id)
         )
-        return list(result.scalars().all())
+        if after is not None:
+            query = query.where(chat_members.c.user_id > after)
+        result = await self.db.execute(query.order_by(chat_members.c.user_id).limit(limit))
+        return [dict(row._mapping) for row in result]
+
+    async def get_member_pages(self, chat_ids: List[int], limit: int) -> dict[int, List[dict]]:
+        """Первые страницы участников нескольких чатов одним запросом (LATERAL по каждому чату)"""
+        pages = {chat_id: [] for chat_id in chat_ids}
+        if not chat_ids:
+            return pages
+        page = (
+            select(chat_members.c.user_id.label("id"), User.username)
+            .join(User, User.id == chat_members.c.user_id)
+            .where(chat_members.c.chat_id == Chat.id)
+            .order_by(chat_members.c.user_id)
+            .limit(limit)
+            .lateral("page")
+        )
+        result = await self.db.execute(
+            select(Chat.id.label("chat_id"), page.c.id, page.c.username)
+            .select_from(Chat)
+            .join(page, true())
+            .where(Chat.id == any_(bindparam("chat_ids", list(chat_ids), type_=ARRAY(Integer))))
+            .order_by(Chat.id, page.c.id)
+        )
+        for chat_id, user_id, username in result:
+            pages[chat_id].append({"id": user_id, "username": username})
+        return pages
 
-    async def create_group(self, chat: Chat, members: List[User]) -> Chat:
-        """Создание группового чата"""
+    async def attach_member_page(self, chat: Chat, limit: int) -> Chat:
+        """Число участников и их первая страница - для сериализации ответа о чате"""
+        await self.db.refresh(chat, ["member_count", "membership_version"])
+        setattr(chat, 'members', await self.get_member_page(chat.id, limit))
+        return chat
+
+    async def get_member_ids(self, chat_ids: List[int]) -> dict[int, set[int]]:
+        """id участников чатов одним запросом, без загрузки пользователей"""
+        members = {chat_id: set() for chat_id in chat_ids}
+        if not chat_ids:
+            return members
+        result = await self.db.execute(
+            select(chat_members.c.chat_id, chat_members.c.user_id)
+            .where(chat_members.c.chat_id.in_(chat_ids))
+        )
+        for chat_id, user_id in result:
+            members[chat_id].add(user_id)
+        return members
+
+    async def get_member_chat_ids(self, user_id: int, chat_ids: List[int]) -> set[int]:
+        """Фильтрация списка чатов: остаются только те, где пользователь состоит"""
+        if not chat_ids:
+            return set()
+        result = await self.db.execute(
+            select(chat_members.c.chat_id)
+            .where(
+                (chat_members.c.user_id == user_id) &
+                (chat_members.c.chat_id.in_(chat_ids))
+            )
+        )
+        return set(result.scalars().all())
+
+    async def get_inbox(
+        self,
+        user_id: int,
+        limit: int,
+        preview_length: int,
+        before: Optional[tuple[datetime, int]] = None
+    ) -> List[dict]:
+        """
+        Страница чатов пользователя по последней активности - один запрос
+
+        Сортировка и курсор идут по денормализованным chats.last_activity_at и
+        chats.last_message_id (их поддерживают триггеры), последнее сообщение
+        подтягивается по первичному ключу - без поиска по messages для каждого чата.
+
+        Args:
+            user_id: ID пользователя
+            limit: Сколько чатов вернуть
+            preview_length: Длина превью последнего сообщения
+            before: Курсор (last_activity_at, chat_id): чаты с более ранней активностью
+
+        Returns:
+            List[dict]: Чаты от недавних к давним со счётчиком непрочитанного и последним сообщением
+        """
+        query = (
+            select(
+                Chat.id.label("chat_id"),
+                Chat.name,
+                Chat.chat_type,
+                Chat.member_count,
+                chat_members.c.unread_count,
+                chat_members.c.last_read_message_id,
+                Message.id.label("last_message_id"),
+                Message.sender_id.label("last_message_sender_id"),
+                func.left(Message.text, preview_length).label("last_message_text"),
+                Message.created_at.label("last_message_created_at"),
+                Chat.last_activity_at
+            )
+            .select_from(
+                chat_members
+                .join(Chat, Chat.id == chat_members.c.chat_id)
+                .outerjoin(Message, Message.id == Chat.last_message_id)
+            )
+            .where(chat_members.c.user_id == user_id)
+        )
+        if before is not None:
+            query = query.where(tuple_(Chat.last_activity_at, Chat.id) < tuple_(*before))
+        result = await self.db.execute(
+            query.order_by(Chat.last_activity_at.desc(), Chat.id.desc()).limit(limit)
+        )
+        return [dict(row._mapping) for row in result]
+
+    def _actual_stats(self):
+        """Статистика чатов, пересчитанная по messages и chat_members"""
+        last_message = (
+            select(Message.id, Message.created_at)
+            .where(Message.chat_id == Chat.id)
+            .order_by(Message.id.desc())
+            .limit(1)
+            .lateral("last_message")
+        )
+        member_count = (
+            select(func.count())
+            .select_from(chat_members)
+            .where(chat_members.c.chat_id == Chat.id)
+            .scalar_subquery()
+        )
+        return (
+            select(
+                Chat.id.label("chat_id"),
+                last_message.c.id.label("last_message_id"),
+                func.coalesce(last_message.c.created_at, Chat.created_at).label("last_activity_at"),
+                member_count.label("member_count")
+            )
+            .select_from(Chat)
+            .outerjoin(last_message, true())
+            .subquery("actual")
+        )
+
+    async def find_inconsistent_stats(self) -> List[dict]:
+        """
+        Чаты, у которых денормализованная статистика разошлась с данными
+
+        Returns:
+            List[dict]: chat_id, сохранённые и пересчитанные значения
+        """
+        actual = self._actual_stats()
+        result = await self.db.execute(
+            select(
+                Chat.id.label("chat_id"),
+                Chat.last_message_id,
+                actual.c.last_message_id.label("actual_last_message_id"),
+                Chat.last_activity_at,
+                actual.c.last_activity_at.label("actual_last_activity_at"),
+                Chat.member_count,
+                actual.c.member_count.label("actual_member_count")
+            )
+            .join(actual, actual.c.chat_id == Chat.id)
+            .where(
+                Chat.last_message_id.is_distinct_from(actual.c.last_message_id) |
+                (Chat.last_activity_at != actual.c.last_activity_at) |
+                (Chat.member_count != actual.c.member_count)
+            )
+            .order_by(Chat.id)
+        )
+        return [dict(row._mapping) for row in result]
+
+    async def repair_stats(self) -> int:
+        """
+        Пересчёт денормализованной статистики у разошедшихся чатов
+
+        Returns:
+            int: Количество исправленных чатов
+        """
+        actual = self._actual_stats()
+        result = await self.db.execute(
+            update(Chat)
+            .where(Chat.id == actual.c.chat_id)
+            .where(
+                Chat.last_message_id.is_distinct_from(actual.c.last_message_id) |
+                (Chat.last_activity_at != actual.c.last_activity_at) |
+                (Chat.member_count != actual.c.member_count)
+            )
+            .values(
+                last_message_id=actual.c.last_message_id,
+                last_activity_at=actual.c.last_activity_at,
+                member_count=actual.c.member_count,
+                updated_at=Chat.updated_at  # Пересчёт статистики - не изменение чата
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.commit()
+        repaired = result.rowcount
+        logger.info(f"Repaired stats of {repaired} chats")
+        return repaired
+
+    async def get_unread_counts(self, user_id: int) -> List[dict]:
+        """Счётчики непрочитанного по всем чатам пользователя (по индексу chat_members.user_id)"""
+        result = await self.db.execute(
+            select(
+                chat_members.c.chat_id,
+                chat_members.c.unread_count,
+                chat_members.c.last_read_message_id
+            )
+            .where(chat_members.c.user_id == user_id)
+            .order_by(chat_members.c.chat_id)
+        )
+        return [dict(row._mapping) for row in result]
+
+    async def create_group(self, chat: Chat, member_ids: List[int]) -> Chat:
+        """Создание группового чата: чат и все участники в одной транзакции"""
         try:
-            # Создаем чат
             self.db.add(chat)
+            await self.db.flush()  # id чата для строк участников
+            await self._insert_members(chat.id, member_ids)
             await self.db.commit()
             await self.db.refresh(chat)
-
-            # Добавляем участников через промежуточную таблицу
-            stmt = chat_members.insert().values([
-                {"chat_id": chat.id, "user_id": member.id}
-                for member in members
-            ])
-            await self.db.execute(stmt)
-            await self.db.commit()
-            
-            # Получаем участников чата
-            chat_members_list = await self.get_chat_members(chat.id)
-            
-            # Добавляем участников к объекту чата для сериализации
-            setattr(chat, 'members', chat_members_list)
-            
-            logger.debug(f"Created group chat: id={chat.id} with {len(chat_members_list)} members")
+            logger.debug(f"Created group chat: id={chat.id} with {chat.member_count} members")
             return chat
         except Exception as e:
+            await self.db.rollback()
             logger.error(f"Error creating group chat: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, status
 from typing import List, Union
 
 from src.features.auth.dependencies import get_current_user
@@ -8,10 +8,15 @@ from src.features.chats.schemas import (
     ChatCreate,
     ChatUpdate,
     ChatInDB,
+    ChatUnread,
+    ChatInbox,
+    ChatMemberPage,
+    ChatMembershipChanges,
     PersonalChatResponse,
     GroupChatResponse
 )
 from src.features.chats.models import ChatType
+from src.features.websocket.dependencies import websocket_manager
 from src.core.logging import logger
 
 router = APIRouter(tags=["chats"])
@@ -34,9 +39,7 @@ async def create_new_chat(
     if chat.chat_type == ChatType.PERSONAL:
         return PersonalChatResponse.from_orm(chat)
     
-    # Для группового чата получаем участников и добавляем их к объекту
-    members = await chat_service.repository.get_chat_members(chat.id)
-    setattr(chat, 'members', members)
+    # Групповой чат сервис возвращает с первой страницей участников
     return GroupChatResponse.from_orm(chat)
 
 
@@ -49,6 +52,26 @@ async def read_user_chats(
     return await chat_service.get_user_chats(current_user)
 
 
+@router.get("/inbox", response_model=ChatInbox)
+async def read_inbox(
+    before: str | None = Query(None, description="Курсор: чаты с более ранней активностью"),
+    limit: int = Query(50, ge=1, le=100),
+    chat_service = Depends(get_chat_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Чаты пользователя по последней активности: участники, превью последнего сообщения, непрочитанное"""
+    return await chat_service.get_inbox(current_user, limit, before)
+
+
+@router.get("/unread", response_model=List[ChatUnread])
+async def read_unread_counts(
+    chat_service = Depends(get_chat_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Счётчики непрочитанных сообщений во всех чатах пользователя"""
+    return await chat_service.get_unread_counts(current_user)
+
+
 @router.get("/{chat_id}", response_model=ChatInDB)
 async def read_chat(
     chat_id: int,
@@ -59,6 +82,30 @@ async def read_chat(
     return await chat_service.get_chat(chat_id, current_user)
 
 
+@router.get("/{chat_id}/members", response_model=ChatMemberPage)
+async def read_chat_members(
+    chat_id: int,
+    after: int | None = Query(None, description="Курсор: id последнего участника предыдущей страницы"),
+    limit: int = Query(50, ge=1, le=500),
+    chat_service = Depends(get_chat_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Участники чата постранично: только id и username"""
+    return await chat_service.get_members(chat_id, current_user, limit, after)
+
+
+@router.get("/{chat_id}/members/changes", response_model=ChatMembershipChanges)
+async def read_membership_changes(
+    chat_id: int,
+    since: int = Query(..., ge=0, description="Версия состава, известная клиенту"),
+    limit: int = Query(100, ge=1, le=1000, description="Сколько версий вернуть"),
+    chat_service = Depends(get_chat_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Изменения состава чата после версии since: добавленные и удалённые участники по версиям"""
+    return await chat_service.get_membership_changes(chat_id, current_user, since, limit)
+
+
 @router.patch("/{chat_id}/update", response_model=ChatInDB)
 async def update_chat_info(
     chat_id: int,
@@ -78,7 +125,10 @@ async def add_members_to_chat(
     current_user: UserInDB = Depends(get_current_user)
 ):
     """Добавление участников в чат"""
-    return await chat_service.add_members(chat_id, member_ids, current_user)
+    chat = await chat_service.add_members(chat_id, member_ids, current_user)
+    for delta in chat_service.membership_deltas:
+        await websocket_manager.send_membership_delta(delta)
+    return chat
 
 
 @router.post("/{chat_id}/members/remove", response_model=ChatInDB)
@@ -89,4 +139,7 @@ async def remove_members_from_chat(
     current_user: UserInDB = Depends(get_current_user)
 ):
     """Удаление участников из чата"""
-    return await chat_service.remove_members(chat_id, member_ids, current_user)
+    chat = await chat_service.remove_members(chat_id, member_ids, current_user)
+    for delta in chat_service.membership_deltas:
+        await websocket_manager.send_membership_delta(delta)
+    return chat
@@ -1,7 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel, constr, Field, field_validator
 from typing import List
-from src.features.users.schemas import UserInDB
 from src.features.chats.models import Chat, ChatType
 from enum import Enum
 from src.core.logging import logger
@@ -40,12 +39,62 @@ class ChatCreate(BaseModel):
 class ChatUpdate(BaseModel):
     name: str | None = None
 
+class ChatUnread(BaseModel):
+    chat_id: int
+    unread_count: int
+    last_read_message_id: int
+
+class ChatLastMessage(BaseModel):
+    id: int
+    sender_id: int
+    text: str  # Превью: первые CHAT_INBOX_PREVIEW_LENGTH символов
+    created_at: datetime
+
+class ChatInboxItem(BaseModel):
+    chat_id: int
+    name: str | None = None
+    chat_type: ChatType
+    member_ids: List[int]
+    member_count: int
+    unread_count: int
+    last_read_message_id: int
+    last_message: ChatLastMessage | None = None
+    last_activity_at: datetime
+
+class ChatInbox(BaseModel):
+    chats: List[ChatInboxItem]
+    has_more: bool  # Есть чаты с более ранней активностью
+    before_cursor: str | None = None  # Курсор для следующей страницы
+
+class ChatMember(BaseModel):
+    id: int
+    username: str
+
+class ChatMemberPage(BaseModel):
+    members: List[ChatMember]
+    has_more: bool  # Есть участники с большими id
+    after_cursor: int | None = None  # Курсор следующей страницы: id последнего участника
+    membership_version: int  # Версия состава на момент чтения страницы
+
+class ChatMembershipDelta(BaseModel):
+    version: int
+    added: List[int] = []
+    removed: List[int] = []
+
+class ChatMembershipChanges(BaseModel):
+    chat_id: int
+    version: int  # Версия состава после применения deltas
+    deltas: List[ChatMembershipDelta]
+    has_more: bool  # Есть более поздние изменения: запросить с since=version
+
 class ChatInDB(ChatBase):
     id: int
     creator_id: int
     created_at: datetime
     updated_at: datetime
-    members: List[UserInDB]
+    member_count: int
+    membership_version: int
+    members: List[ChatMember]  # Первая страница участников
 
     class Config:
         from_attributes = True
@@ -79,7 +128,9 @@ class GroupChatResponse(BaseModel):
     name: str
     chat_type: ChatType
     creator_id: int
-    members: List[UserInDB]
+    member_count: int
+    membership_version: int
+    members: List[ChatMember]  # Первая страница участников
     created_at: datetime
     updated_at: datetime
     participant_id: int | None = None
@@ -98,7 +149,9 @@ class GroupChatResponse(BaseModel):
             name=chat.name,
             chat_type=chat.chat_type,
             creator_id=chat.creator_id,
-            members=[UserInDB.from_orm(m) for m in chat.members],
+            member_count=chat.member_count,
+            membership_version=chat.membership_version,
+            members=chat.members,
             created_at=chat.created_at,
             updated_at=chat.updated_at
         ) 
\ No newline at end of file
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 
@@ -9,18 +9,28 @@ from src.core.exceptions import (
     ValidationException,
     ChatCreateException,
     ChatMemberException,
-    ChatUpdateException
+    ChatUpdateException,
+    ChatException
 )
 from src.features.chats.repositories import ChatRepository
+from src.features.chats.membership_cache import membership_cache
+from src.features.messages.cursors import encode_cursor, decode_cursor
 from src.features.users.repositories import UserRepository
 from src.features.chats.schemas import ChatCreate, ChatUpdate, ChatType
 from src.features.users.schemas import UserInDB
+from src.features.users.models import User
 from src.features.chats.models import Chat
+from src.config import get_settings
+
+
+settings = get_settings()
 
 class ChatService:
     def __init__(self, db: AsyncSession):
         self.repository = ChatRepository(db)
         self.user_repository = UserRepository(db)
+        # Изменения состава после commit - для рассылки событий membership_delta
+        self.membership_deltas: List[dict] = []
 
     async def create_chat(self, chat_data: ChatCreate, current_user: UserInDB) -> Chat:
         """Создание нового чата"""
@@ -45,6 +55,7 @@ class ChatService:
                     created_at=datetime.utcnow(),
                     updated_at=datetime.utcnow()
                 )
+                chat.last_activity_at = chat.created_at  # Активность чата без сообщений - его создание
                 return await self.repository.create_personal(chat)
 
             else:  # GroupChat
@@ -52,17 +63,9 @@ class ChatService:
                     name = f"Group chat {len(chat_data.member_ids)}"
                     raise ValidationException("Group chat must have a name")
                 
-                # Получаем участников для группового чата
-                members = []
-                for user_id in chat_data.member_ids:
-                    logger.info(f"Getting user by id: {user_id}")
-                    user = await self.user_repository.get_by_id(user_id)
-                    if not user:
-                        raise NotFoundException(f"User {user_id} not found")
-                    members.append(user)
-
-                # Добавляем создателя в список участников
-                members.append(current_user)
+                # Участники группового чата - одним запросом, создатель тоже участник
+                members = await self._get_users(chat_data.member_ids)
+                member_ids = list(dict.fromkeys([user.id for user in members] + [current_user.id]))
 
                 chat = Chat(
                     name=chat_data.name,
@@ -71,35 +74,42 @@ class ChatService:
                     created_at=datetime.utcnow(),
                     updated_at=datetime.utcnow()
                 )
-                chat = await self.repository.create_group(chat, members)
-                
-                # Получаем участников и добавляем их к объекту чата
-                members = await self.repository.get_chat_members(chat.id)
-                setattr(chat, 'members', members)
-                
-                return chat
+                chat.last_activity_at = chat.created_at  # Активность чата без сообщений - его создание
+                chat = await self.repository.create_group(chat, member_ids)
+                membership_cache.invalidate(chat.id)
+                return await self.repository.attach_member_page(chat, settings.CHAT_MEMBERS_PAGE_SIZE)
 
+        except (NotFoundException, ValidationException):
+            raise
         except Exception as e:
             logger.error(f"Error creating chat: {str(e)}")
             raise ChatCreateException("Failed to create chat")
 
+    async def _get_users(self, user_ids: List[int]) -> List[User]:
+        """
+        Пользователи по списку ID одним запросом
+
+        Raises:
+            NotFoundException: Если каких-то пользователей нет - со всеми отсутствующими id
+        """
+        users = await self.user_repository.get_by_ids(user_ids)
+        found = {user.id for user in users}
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]
+        if missing:
+            raise NotFoundException(f"Users {missing} not found", details={"user_ids": missing})
+        return users
+
     async def get_chat(self, chat_id: int, current_user: UserInDB) -> Chat:
         """Получение чата по ID"""
         try:
+            await self.require_member(chat_id, current_user)
             chat = await self.repository.get_by_id(chat_id)
             if not chat:
                 logger.warning(f"Chat {chat_id} not found")
                 raise NotFoundException(f"Chat {chat_id} not found")
 
-            # Получаем участников чата
-            members = await self.repository.get_chat_members(chat.id)
-            if current_user.id not in [m.id for m in members]:
-                logger.warning(f"User {current_user.id} attempted to access chat {chat_id} without being a member")
-                raise ForbiddenException("Not a chat member")
-
-            # Устанавливаем участников для сериализации
-            setattr(chat, 'members', members)
-            return chat
+            # Для ответа - только число участников и первая страница
+            return await self.repository.attach_member_page(chat, settings.CHAT_MEMBERS_PAGE_SIZE)
         
         except (NotFoundException, ForbiddenException):
             raise
@@ -107,9 +117,204 @@ class ChatService:
             logger.error(f"Error getting chat {chat_id}: {str(e)}")
             raise ChatException(f"Failed to get chat {chat_id}")
 
-    async def get_user_chats(self, current_user: UserInDB) -> List[Chat]:
+    async def get_member_ids(self, chat_ids: List[int]) -> dict[int, frozenset[int]]:
+        """
+        id участников чатов: из кэша составов, недостающие - одним запросом
+
+        Returns:
+            dict: chat_id -> id участников (пустое множество, если чата нет)
+        """
+        members = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = membership_cache.get(chat_id)
+            if cached is None:
+                missing.append(chat_id)
+            else:
+                members[chat_id] = cached
+        if missing:
+            version = membership_cache.version
+            for chat_id, user_ids in (await self.repository.get_member_ids(missing)).items():
+                members[chat_id] = frozenset(user_ids)
+                membership_cache.put(chat_id, members[chat_id], version)
+        return members
+
+    async def require_member(self, chat_id: int, current_user: UserInDB) -> frozenset[int]:
+        """
+        Проверка членства без загрузки чата и пользователей
+
+        Returns:
+            frozenset: id участников чата
+
+        Raises:
+            NotFoundException: Чат не найден (у чата без участников тоже)
+            ForbiddenException: Пользователь не состоит в чате
+        """
+        members = (await self.get_member_ids([chat_id]))[chat_id]
+        if not members:
+            logger.warning(f"Chat {chat_id} not found")
+            raise NotFoundException(f"Chat {chat_id} not found")
+        if current_user.id not in members:
+            logger.warning(f"User {current_user.id} attempted to access chat {chat_id} without being a member")
+            raise ForbiddenException("Not a chat member")
+        return members
+
+    async def get_member_chat_ids(self, chat_ids: List[int], current_user: UserInDB) -> set[int]:
+        """Чаты из списка, в которых состоит пользователь"""
+        members = await self.get_member_ids(list(dict.fromkeys(chat_ids)))
+        return {chat_id for chat_id, user_ids in members.items() if current_user.id in user_ids}
+
+    async def get_unread_counts(self, current_user: UserInDB) -> List[dict]:
+        """Непрочитанные сообщения во всех чатах пользователя - O(число чатов)"""
+        return await self.repository.get_unread_counts(current_user.id)
+
+    async def get_inbox(self, current_user: UserInDB, limit: int = 50, before: Optional[str] = None) -> dict:
+        """
+        Страница списка чатов пользователя по последней активности
+
+        Один запрос на страницу и один на участников её чатов (или ни одного,
+        если составы есть в кэше) - независимо от числа чатов пользователя.
+
+        Args:
+            current_user: Текущий пользователь
+            limit: Размер страницы
+            before: Курсор предыдущей страницы
+
+        Returns:
+            dict: Чаты, has_more и курсор следующей страницы
+
+        Raises:
+            ValidationException: Если курсор повреждён
+        """
+        rows = await self.repository.get_inbox(
+            current_user.id,
+            limit + 1,
+            settings.CHAT_INBOX_PREVIEW_LENGTH,
+            before=decode_cursor(before) if before is not None else None
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        members = await self.get_member_ids([row["chat_id"] for row in rows])
+
+        chats = []
+        for row in rows:
+            last_message = None
+            if row["last_message_id"] is not None:
+                last_message = {
+                    "id": row["last_message_id"],
+                    "sender_id": row["last_message_sender_id"],
+                    "text": row["last_message_text"],
+                    "created_at": row["last_message_created_at"]
+                }
+            chats.append({
+                "chat_id": row["chat_id"],
+                "name": row["name"],
+                "chat_type": row["chat_type"],
+                "member_ids": sorted(members[row["chat_id"]]),
+                "member_count": row["member_count"],
+                "unread_count": row["unread_count"],
+                "last_read_message_id": row["last_read_message_id"],
+                "last_message": last_message,
+                "last_activity_at": row["last_activity_at"]
+            })
+
+        return {
+            "chats": chats,
+            "has_more": has_more,
+            "before_cursor": encode_cursor(rows[-1]["last_activity_at"], rows[-1]["chat_id"]) if rows else before
+        }
+
+    async def check_stats(self, repair: bool = False) -> List[dict]:
+        """
+        Сверка last_message_id, last_activity_at и member_count чатов с данными
+
+        Args:
+            repair: Пересчитать найденные расхождения
+
+        Returns:
+            List[dict]: Чаты с расхождениями (до исправления)
+        """
+        inconsistent = await self.repository.find_inconsistent_stats()
+        if inconsistent:
+            logger.warning(f"Chat stats are inconsistent in {len(inconsistent)} chats")
+            if repair:
+                await self.repository.repair_stats()
+        return inconsistent
+
+    async def get_user_chats(self, current_user: UserInDB) -> List[dict]:
         """Получение списка чатов пользователя"""
-        return await self.repository.get_user_chats(current_user.id)
+        return await self.repository.get_user_chats(current_user.id, settings.CHAT_MEMBERS_PAGE_SIZE)
+
+    async def get_members(
+        self,
+        chat_id: int,
+        current_user: UserInDB,
+        limit: int = 50,
+        after: Optional[int] = None
+    ) -> dict:
+        """
+        Страница участников чата (id, username) по возрастанию id
+
+        Args:
+            chat_id: ID чата
+            current_user: Текущий пользователь
+            limit: Размер страницы
+            after: id последнего участника предыдущей страницы
+
+        Returns:
+            dict: Участники, has_more и курсор следующей страницы
+        """
+        await self.require_member(chat_id, current_user)
+        # Версия читается до страницы: изменения после неё клиент получит через get_membership_changes
+        version = await self.repository.get_membership_version(chat_id)
+        members = await self.repository.get_member_page(chat_id, limit + 1, after)
+        has_more = len(members) > limit
+        members = members[:limit]
+        return {
+            "members": members,
+            "has_more": has_more,
+            "after_cursor": members[-1]["id"] if members else after,
+            "membership_version": version
+        }
+
+    async def get_membership_changes(
+        self,
+        chat_id: int,
+        current_user: UserInDB,
+        since: int,
+        limit: int = 100
+    ) -> dict:
+        """
+        Изменения состава чата после версии since - O(изменений), а не O(участников)
+
+        Args:
+            chat_id: ID чата
+            current_user: Текущий пользователь
+            since: Версия состава, известная клиенту
+            limit: Сколько версий вернуть за раз
+
+        Returns:
+            dict: chat_id, версия после применения, изменения по версиям, has_more
+
+        Raises:
+            ValidationException: Если since больше текущей версии
+        """
+        await self.require_member(chat_id, current_user)
+        version = await self.repository.get_membership_version(chat_id)
+        if since > version:
+            raise ValidationException(f"Unknown membership version {since}, current is {version}")
+
+        until = min(version, since + limit)
+        deltas: dict[int, dict] = {}
+        for change in await self.repository.get_membership_changes(chat_id, since, until):
+            delta = deltas.setdefault(change["version"], {"version": change["version"], "added": [], "removed": []})
+            delta[change["action"]].append(change["user_id"])
+        return {
+            "chat_id": chat_id,
+            "version": until,
+            "deltas": list(deltas.values()),
+            "has_more": until < version
+        }
 
     async def update_chat(self, chat_id: int, chat_update: ChatUpdate, current_user: UserInDB) -> Chat:
         """Обновление информации о чате"""
@@ -139,21 +344,22 @@ class ChatService:
             logger.warning(f"Attempted to add members to personal chat: {chat_id}")
             raise ValidationException("Cannot add members to personal chat")
 
-        # Получаем текущих участников
-        current_members = await self.repository.get_chat_members(chat.id)
-        current_member_ids = {m.id for m in current_members}
-
-        new_members = []
-        for user_id in member_ids:
-            if user_id in current_member_ids:
-                raise ValidationException(f"User {user_id} is already a member")
-            user = await self.user_repository.get_by_id(user_id)
-            if not user:
-                raise NotFoundException(f"User {user_id} not found")
-            new_members.append(user)
+        # В ответе о чате только первая страница, полный состав - из кэша составов
+        current_member_ids = (await self.get_member_ids([chat_id]))[chat_id]
+        already_members = sorted(set(member_ids) & current_member_ids)
+        if already_members:
+            raise ValidationException(
+                f"Users {already_members} are already members",
+                details={"user_ids": already_members}
+            )
+        new_members = await self._get_users(member_ids)
 
         try:
-            return await self.repository.add_members(chat, new_members)
+            delta = await self.repository.add_members(chat, [user.id for user in new_members])
+            membership_cache.invalidate(chat_id)
+            if delta:
+                self.membership_deltas.append(delta)
+            return await self.repository.attach_member_page(chat, settings.CHAT_MEMBERS_PAGE_SIZE)
         except Exception as e:
             logger.error(f"Error adding members to chat: {str(e)}")
             raise ChatMemberException("Failed to add members to chat")
@@ -175,7 +381,11 @@ class ChatService:
             raise ValidationException("Cannot remove yourself using this endpoint")
 
         try:
-            return await self.repository.remove_members(chat, member_ids)
+            delta = await self.repository.remove_members(chat, member_ids)
+            membership_cache.invalidate(chat_id)
+            if delta:
+                self.membership_deltas.append(delta)
+            return await self.repository.attach_member_page(chat, settings.CHAT_MEMBERS_PAGE_SIZE)
         except Exception as e:
             logger.error(f"Error removing members from chat: {str(e)}")
             raise ChatMemberException("Failed to remove members from chat") 
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Триггеры, без которых схема неполна.
+
+Схему строят и миграции Alembic, и Base.metadata.create_all (при старте приложения
+и в тестах), поэтому DDL триггеров привязан к созданию таблиц: он выполняется только
+вместе с CREATE TABLE и повторяет итоговое состояние миграций.
+"""
+from sqlalchemy import DDL, event
+
+from src.features.chats.members_model import chat_members
+from src.features.messages.models import Message
+
+
+# Статистика чата (chats.last_message_id, last_activity_at, member_count).
+# Триггеры уровня оператора: многострочная вставка обновляет строку чата один раз
+CHATS_ON_MESSAGES_INSERT = ("""
+    CREATE OR REPLACE FUNCTION chats_on_messages_insert() RETURNS trigger AS $$
+    BEGIN
+        UPDATE chats AS c
+        SET last_message_id = n.last_message_id,
+            last_activity_at = GREATEST(c.last_activity_at, n.last_activity_at)
+        FROM (
+            SELECT chat_id, max(id) AS last_message_id, max(created_at) AS last_activity_at
+            FROM new_messages
+            GROUP BY chat_id
+        ) AS n
+        WHERE c.id = n.chat_id
+          AND (c.last_message_id IS NULL OR c.last_message_id < n.last_message_id);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""", """
+    CREATE TRIGGER messages_update_chat_activity
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chats_on_messages_insert()
+""")
+
+# Удаление последнего сообщения возвращает чату предыдущее
+CHATS_ON_MESSAGES_DELETE = ("""
+    CREATE OR REPLACE FUNCTION chats_on_messages_delete() RETURNS trigger AS $$
+    BEGIN
+        UPDATE chats AS c
+        SET last_message_id = m.id,
+            last_activity_at = COALESCE(m.created_at, c.created_at)
+        FROM chats AS base
+        LEFT JOIN LATERAL (
+            SELECT id, created_at FROM messages WHERE chat_id = base.id ORDER BY id DESC LIMIT 1
+        ) AS m ON true
+        WHERE base.id = c.id
+          AND c.last_message_id IN (SELECT id FROM old_messages);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""", """
+    CREATE TRIGGER messages_restore_chat_activity
+    AFTER DELETE ON messages
+    REFERENCING OLD TABLE AS old_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chats_on_messages_delete()
+""")
+
+# Каждый оператор над chat_members - одна новая версия состава чата
+# и строки журнала chat_membership_changes с этой версией (по одной на участника)
+CHATS_ON_MEMBERS_CHANGE = ("""
+    CREATE OR REPLACE FUNCTION chats_on_members_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            WITH bumped AS (
+                UPDATE chats AS c
+                SET member_count = c.member_count + n.added,
+                    membership_version = c.membership_version + 1
+                FROM (SELECT chat_id, count(*) AS added FROM new_members GROUP BY chat_id) AS n
+                WHERE c.id = n.chat_id
+                RETURNING c.id, c.membership_version
+            )
+            INSERT INTO chat_membership_changes (chat_id, version, user_id, action)
+            SELECT b.id, b.membership_version, m.user_id, 'added'
+            FROM bumped AS b
+            JOIN new_members AS m ON m.chat_id = b.id;
+        ELSE
+            WITH bumped AS (
+                UPDATE chats AS c
+                SET member_count = c.member_count - o.removed,
+                    membership_version = c.membership_version + 1
+                FROM (SELECT chat_id, count(*) AS removed FROM old_members GROUP BY chat_id) AS o
+                WHERE c.id = o.chat_id
+                RETURNING c.id, c.membership_version
+            )
+            INSERT INTO chat_membership_changes (chat_id, version, user_id, action)
+            SELECT b.id, b.membership_version, m.user_id, 'removed'
+            FROM bumped AS b
+            JOIN old_members AS m ON m.chat_id = b.id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""", """
+    CREATE TRIGGER chat_members_count_insert
+    AFTER INSERT ON chat_members
+    REFERENCING NEW TABLE AS new_members
+    FOR EACH STATEMENT EXECUTE FUNCTION chats_on_members_change()
+""", """
+    CREATE TRIGGER chat_members_count_delete
+    AFTER DELETE ON chat_members
+    REFERENCING OLD TABLE AS old_members
+    FOR EACH STATEMENT EXECUTE FUNCTION chats_on_members_change()
+""")
+
+# Кэши составов чатов во всех процессах сбрасываются по chat_id из уведомления;
+# обновления счётчиков и отметок прочтения триггер не затрагивают
+NOTIFY_CHAT_MEMBERSHIP = ("""
+    CREATE OR REPLACE FUNCTION notify_chat_membership() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            PERFORM pg_notify('chat_membership', OLD.chat_id::text);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM pg_notify('chat_membership', NEW.chat_id::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+""", """
+    CREATE TRIGGER chat_members_notify_membership
+    AFTER INSERT OR DELETE OR UPDATE OF chat_id, user_id ON chat_members
+    FOR EACH ROW EXECUTE FUNCTION notify_chat_membership()
+""")
+
+
+def _create_with(table, *statements: str) -> None:
+    """Выполнение DDL сразу после CREATE TABLE (asyncpg - по одному оператору)"""
+    for statement in statements:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+
+_create_with(Message.__table__, *CHATS_ON_MESSAGES_INSERT, *CHATS_ON_MESSAGES_DELETE)
+_create_with(chat_members, *CHATS_ON_MEMBERS_CHANGE, *NOTIFY_CHAT_MEMBERSHIP)
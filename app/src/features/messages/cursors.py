@@ -0,0 +1,29 @@
+import base64
+from datetime import datetime
+
+import orjson
+
+from src.core.exceptions import ValidationException
+
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    """
+    Непрозрачный курсор истории: позиция сообщения в порядке (created_at, id)
+    """
+    raw = orjson.dumps({"t": created_at.isoformat(), "id": message_id})
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Разбор курсора истории
+
+    Raises:
+        ValidationException: Если курсор повреждён
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = orjson.loads(raw)
+        return datetime.fromisoformat(data["t"]), int(data["id"])
+    except Exception:
+        raise ValidationException("Invalid history cursor")
@@ -0,0 +1,61 @@
+import asyncio
+from typing import AsyncContextManager, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import get_settings
+from src.core.db import AsyncSessionFactory
+from src.core.logging import logger
+from src.features.messages.services import MessageService
+
+
+settings = get_settings()
+
+
+class IdempotencyKeyPruner:
+    """
+    Периодическая очистка idempotency ключей сообщений старше IDEMPOTENCY_KEY_TTL_HOURS.
+
+    Работает в каждом процессе приложения: очистка - один идемпотентный UPDATE,
+    поэтому одновременный запуск на нескольких инстансах безопасен.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncContextManager[AsyncSession]] = AsyncSessionFactory,
+        interval_minutes: float = settings.IDEMPOTENCY_KEY_PRUNE_INTERVAL_MINUTES
+    ):
+        self.session_factory = session_factory
+        self.interval = interval_minutes * 60
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._prune_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def prune(self) -> int:
+        """Одна очистка; ошибка не останавливает периодическую задачу"""
+        try:
+            async with self.session_factory() as db:
+                return await MessageService(db).prune_idempotency_keys()
+        except Exception as e:
+            logger.error(f"Failed to prune idempotency keys: {str(e)}")
+            return 0
+
+    async def _prune_loop(self) -> None:
+        while True:
+            await self.prune()
+            await asyncio.sleep(self.interval)
+
+
+# Общий для процесса экземпляр; запускается при старте приложения
+idempotency_key_pruner = IdempotencyKeyPruner()
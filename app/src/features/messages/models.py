@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Integer, String, DateTime, ForeignKey, func, ARRAY
+from sqlalchemy import Integer, String, DateTime, ForeignKey, Index, func, text, ARRAY
 from sqlalchemy.orm import Mapped, mapped_column
 from src.core.db import Base
 
@@ -18,6 +18,23 @@ class Message(Base):
         idempotency_key (str): Ключ идемпотентности
     """
     __tablename__ = "messages"
+    __table_args__ = (
+        # Диапазонные выборки сообщений чата по id (догонка после переподключения)
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # Постраничная история чата по курсору (created_at, id)
+        Index("ix_messages_chat_id_created_at_id", "chat_id", "created_at", "id"),
+        # Диапазоны по времени во всех чатах (очистка старых idempotency ключей);
+        # время вставки коррелирует с created_at, поэтому BRIN компактен
+        Index("ix_messages_created_at_brin", "created_at", postgresql_using="brin"),
+        # Idempotency ключи уникальны в пределах отправителя; старые ключи очищаются
+        Index(
+            "ix_messages_sender_id_idempotency_key",
+            "sender_id",
+            "idempotency_key",
+            unique=True,
+            postgresql_where=text("idempotency_key IS NOT NULL")
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     chat_id: Mapped[int] = mapped_column(ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
@@ -34,6 +51,6 @@ class Message(Base):
         onupdate=func.now(),
         nullable=False
     )
-    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True, nullable=True)
+    idempotency_key: Mapped[str] = mapped_column(String(64), nullable=True)
    
 
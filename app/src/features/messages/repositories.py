@@ -1,46 +1,152 @@
 from datetime import datetime
-from sqlalchemy import select, insert
+from sqlalchemy import select, update, func, case, union_all, true, tuple_, literal, Integer, String, ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert, aggregate_order_by, array
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import aliased
 from typing import List, Optional
 from src.core.logging import logger
 
 from src.features.messages.models import Message
 from src.features.messages.schemas import MessageCreate, MessageUpdate
-from src.features.messages.read_status_model import message_read_status
+from src.features.chats.members_model import chat_members
+
+
+def unread_after(watermark):
+    """
+    Число сообщений чата строки chat_members после отметки watermark, отправленных другими.
+    Подзапрос коррелирован с обновляемой строкой chat_members и идёт по индексу (chat_id, id).
+    """
+    counted = aliased(Message)
+    return (
+        select(func.count(counted.id))
+        .where(
+            counted.chat_id == chat_members.c.chat_id,
+            counted.id > watermark,
+            counted.sender_id != chat_members.c.user_id
+        )
+        .scalar_subquery()
+    )
 
 
 class MessageRepository:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def create(self, message_data: MessageCreate, sender_id: int) -> Message:
-        logger.debug(f"Creating message in DB: chat_id={message_data.chat_id}, sender_id={sender_id}")
-        try:
-            # Преобразуем message_data в словарь и добавляем sender_id
-            message_dict = message_data.model_dump()
-            message_dict["sender_id"] = sender_id
-            
-            # Создаем сообщение, используя все поля из message_dict
-            db_message = Message(**message_dict)
-            
-            self.db.add(db_message)
-            await self.db.commit()
-            await self.db.refresh(db_message)
-            logger.debug(f"Message created in DB: id={db_message.id}")
-            return db_message
-        except Exception as e:
-            logger.error(f"Error creating message in DB: {str(e)}")
-            raise
+    async def create(self, message_data: MessageCreate, sender_id: int) -> tuple[Optional[Message], List[dict]]:
+        """
+        Создание сообщения одним запросом (без commit)
+
+        Returns:
+            tuple: Сообщение (None, если отправитель не участник или ключ уже использован)
+                и изменённые счётчики непрочитанного (user_id, chat_id, unread_count)
+        """
+        messages, unread_changes = await self.create_many([(message_data, sender_id)])
+        return messages[0], unread_changes
+
+    async def create_many(
+        self,
+        items: List[tuple[MessageCreate, int]]
+    ) -> tuple[List[Optional[Message]], List[dict]]:
+        """
+        Создание сообщений разных отправителей одним многострочным запросом (без commit)
+
+        INSERT ... SELECT вставляет строку, только если отправитель состоит в чате;
+        повтор с тем же idempotency ключом отправителя ничего не вставляет
+        (ON CONFLICT DO NOTHING), а счётчики непрочитанного остальных участников
+        увеличиваются в том же запросе. id выдаются в порядке items, поэтому
+        порядок сообщений внутри чата совпадает с порядком вызовов.
+
+        Args:
+            items: Пары (данные сообщения, id отправителя)
+
+        Returns:
+            tuple: Сообщения в порядке items (None, если отправитель не участник
+                или ключ уже использован) и изменённые счётчики непрочитанного
+                (user_id, chat_id, unread_count)
+        """
+        logger.debug(f"Creating {len(items)} messages in DB")
+        incoming = func.unnest(
+            literal([data.chat_id for data, _ in items], ARRAY(Integer)),
+            literal([sender_id for _, sender_id in items], ARRAY(Integer)),
+            literal([data.text for data, _ in items], ARRAY(String)),
+            literal([data.idempotency_key for data, _ in items], ARRAY(String))
+        ).table_valued("chat_id", "sender_id", "text", "idempotency_key", with_ordinality="ord").render_derived()
+        batch = (
+            select(
+                incoming.c.ord,
+                incoming.c.chat_id,
+                incoming.c.sender_id,
+                incoming.c.text,
+                incoming.c.idempotency_key,
+                func.nextval(func.pg_get_serial_sequence(Message.__tablename__, "id")).label("id")
+            )
+            .order_by(incoming.c.ord)
+            .cte("batch")
+        )
+        is_member = (
+            select(chat_members.c.chat_id)
+            .where(chat_members.c.chat_id == batch.c.chat_id, chat_members.c.user_id == batch.c.sender_id)
+            .exists()
+        )
+        inserted = (
+            pg_insert(Message)
+            .from_select(
+                ["id", "chat_id", "sender_id", "text", "idempotency_key"],
+                select(batch.c.id, batch.c.chat_id, batch.c.sender_id, batch.c.text, batch.c.idempotency_key)
+                .where(is_member)
+                .order_by(batch.c.ord)
+            )
+            .on_conflict_do_nothing(
+                index_elements=["sender_id", "idempotency_key"],
+                index_where=Message.idempotency_key.is_not(None)
+            )
+            .returning(*Message.__table__.c)
+            .cte("inserted")
+        )
+        recipients = chat_members.alias("recipients")
+        added = (
+            select(recipients.c.chat_id, recipients.c.user_id, func.count().label("added"))
+            .select_from(inserted.join(
+                recipients,
+                (recipients.c.chat_id == inserted.c.chat_id) & (recipients.c.user_id != inserted.c.sender_id)
+            ))
+            .group_by(recipients.c.chat_id, recipients.c.user_id)
+            .subquery("added")
+        )
+        unread = (
+            update(chat_members)
+            .where(chat_members.c.chat_id == added.c.chat_id, chat_members.c.user_id == added.c.user_id)
+            .values(unread_count=chat_members.c.unread_count + added.c.added)
+            .returning(chat_members.c.user_id, chat_members.c.chat_id, chat_members.c.unread_count)
+            .cte("unread")
+        )
+        unread_changes = select(
+            func.coalesce(
+                func.array_agg(aggregate_order_by(
+                    array([unread.c.user_id, unread.c.chat_id, unread.c.unread_count]),
+                    unread.c.user_id,
+                    unread.c.chat_id
+                )),
+                []
+            )
+        ).scalar_subquery()
+
+        result = await self.db.execute(
+            select(aliased(Message, inserted), unread_changes.label("unread"))
+            .select_from(batch.outerjoin(inserted, inserted.c.id == batch.c.id))
+            .order_by(batch.c.ord)
+        )
+        rows = result.all()
+        logger.debug(f"Messages created in DB: {[message.id for message, _ in rows if message]}")
+        return [message for message, _ in rows], [
+            {"user_id": user_id, "chat_id": chat_id, "unread_count": unread_count}
+            for user_id, chat_id, unread_count in rows[0].unread
+        ]
 
     async def get_by_id(self, message_id: int) -> Optional[Message]:
         logger.debug(f"Getting message from DB: id={message_id}")
         result = await self.db.execute(
             select(Message)
-            .options(
-                joinedload(Message.sender),
-                joinedload(Message.chat)
-            )
             .where(Message.id == message_id)
         )
         return result.scalar_one_or_none()
@@ -54,16 +160,57 @@ class MessageRepository:
         logger.debug(f"Getting chat messages from DB: chat_id={chat_id}, skip={skip}, limit={limit}")
         result = await self.db.execute(
             select(Message)
-            .options(
-                joinedload(Message.sender),
-                joinedload(Message.chat)
-            )
             .where(Message.chat_id == chat_id)
             .offset(skip)
             .limit(limit)
             .order_by(Message.created_at.desc())
         )
-        return list(result.scalars().unique())
+        return list(result.scalars())
+
+    async def get_history(
+        self,
+        chat_id: int,
+        limit: int,
+        before: Optional[tuple[datetime, int]] = None,
+        after: Optional[tuple[datetime, int]] = None,
+        inclusive: bool = False
+    ) -> List[dict]:
+        """
+        Страница истории чата по курсору (без OFFSET): диапазон по индексу (chat_id, created_at, id)
+
+        Args:
+            chat_id: ID чата
+            limit: Максимум сообщений
+            before: Позиция (created_at, id), старше которой нужны сообщения
+            after: Позиция (created_at, id), новее которой нужны сообщения
+            inclusive: Для after включать сообщение в самой позиции
+
+        Returns:
+            List[dict]: Сообщения от курсора: по убыванию для before (и без курсора), по возрастанию для after
+        """
+        logger.debug(f"Getting history of chat {chat_id}: before={before}, after={after}, limit={limit}")
+        position = tuple_(Message.created_at, Message.id)
+        query = select(
+            Message.id, Message.chat_id, Message.sender_id, Message.text,
+            Message.created_at, Message.updated_at, Message.idempotency_key
+        ).where(Message.chat_id == chat_id)
+        if after is not None:
+            query = query.where(position >= after if inclusive else position > after)
+            query = query.order_by(Message.created_at, Message.id)
+        else:
+            if before is not None:
+                query = query.where(position < before)
+            query = query.order_by(Message.created_at.desc(), Message.id.desc())
+        result = await self.db.execute(query.limit(limit))
+        return [dict(row._mapping) for row in result]
+
+    async def get_position(self, chat_id: int, message_id: int) -> Optional[tuple[datetime, int]]:
+        """Позиция сообщения чата в порядке истории (created_at, id)"""
+        result = await self.db.execute(
+            select(Message.created_at, Message.id).where(Message.id == message_id, Message.chat_id == chat_id)
+        )
+        row = result.one_or_none()
+        return (row.created_at, row.id) if row is not None else None
 
     async def update(self, message: Message, message_update: MessageUpdate) -> Message:
         """Обновление сообщения"""
@@ -83,62 +230,270 @@ class MessageRepository:
             logger.error(f"Error updating message: {str(e)}")
             raise
 
-    async def delete(self, message: Message) -> None:
+    async def delete(self, message: Message) -> List[dict]:
+        """
+        Удаление сообщения
+
+        Returns:
+            List[dict]: user_id, chat_id, unread_count участников, у которых уменьшился счётчик
+        """
         logger.debug(f"Deleting message from DB: id={message.id}")
         try:
+            # Непрочитанное сообщение перестаёт учитываться в счётчиках участников
+            result = await self.db.execute(
+                update(chat_members)
+                .where(
+                    chat_members.c.chat_id == message.chat_id,
+                    chat_members.c.user_id != message.sender_id,
+                    chat_members.c.last_read_message_id < message.id
+                )
+                .values(unread_count=func.greatest(chat_members.c.unread_count - 1, 0))
+                .returning(chat_members.c.user_id, chat_members.c.chat_id, chat_members.c.unread_count)
+            )
+            unread_changes = [dict(row._mapping) for row in result]
             await self.db.delete(message)
             await self.db.commit()
             logger.debug(f"Message deleted from DB: id={message.id}")
+            return unread_changes
         except Exception as e:
             logger.error(f"Error deleting message from DB: {str(e)}")
             raise
 
-    async def get_by_idempotency_key(self, idempotency_key: str) -> Optional[Message]:
-        """Получение сообщения по idempotency ключу"""
-        query = select(Message).where(Message.idempotency_key == idempotency_key)
+    async def get_by_idempotency_key(self, idempotency_key: str, sender_id: int) -> Optional[Message]:
+        """Получение сообщения отправителя по idempotency ключу"""
+        query = select(Message).where(Message.sender_id == sender_id, Message.idempotency_key == idempotency_key)
         result = await self.db.execute(query)
         return result.scalar_one_or_none()
 
-    async def create_read_status(self, message_id: int, user_id: int) -> None:
+    async def advance_read_watermarks(self, message_ids: List[int], user_id: int) -> List[dict]:
         """
-        Создает запись о прочтении сообщения
-        
+        Сдвиг отметок прочтения пользователя до указанных сообщений (без commit)
+
+        Одним UPDATE на все чаты сообщений: отметка в каждом чате становится
+        не меньше максимального id прочитанного сообщения и никогда не уменьшается,
+        а счётчик непрочитанного пересчитывается по сообщениям после новой отметки.
+
         Args:
-            message_id: ID сообщения
+            message_ids: ID прочитанных сообщений
             user_id: ID пользователя
+
+        Returns:
+            List[dict]: user_id, chat_id, unread_count по чатам сообщений
         """
-        logger.debug(f"Creating read status: message_id={message_id}, user_id={user_id}")
+        logger.debug(f"Advancing read watermarks: message_ids={message_ids}, user_id={user_id}")
+        latest = (
+            select(Message.chat_id, func.max(Message.id).label("message_id"))
+            .where(Message.id.in_(message_ids))
+            .group_by(Message.chat_id)
+            .subquery()
+        )
+        watermark = func.greatest(chat_members.c.last_read_message_id, latest.c.message_id)
+        result = await self.db.execute(
+            update(chat_members)
+            .where(chat_members.c.chat_id == latest.c.chat_id, chat_members.c.user_id == user_id)
+            .values(last_read_message_id=watermark, unread_count=unread_after(watermark))
+            .returning(chat_members.c.user_id, chat_members.c.chat_id, chat_members.c.unread_count)
+        )
+        return [dict(row._mapping) for row in result]
 
-        try:
-            stmt = insert(message_read_status).values(
-                message_id=message_id,
-                user_id=user_id,
-                read_at=datetime.utcnow()
+    async def read_message(
+        self,
+        message_id: int,
+        user_id: int,
+        max_read_by: int,
+        chat_id: Optional[int] = None
+    ) -> Optional[dict]:
+        """
+        Отметка о прочтении одним запросом (без commit): проверка членства,
+        сдвиг отметки прочтения и выборка прочитавших
+
+        Args:
+            message_id: ID сообщения
+            user_id: ID читателя
+            max_read_by: Если прочитавших больше, список не возвращается
+            chat_id: Чат, которому должно принадлежать сообщение
+
+        Returns:
+            Optional[dict]: Поля сообщения, read_count, read_by (или None вместо списка)
+                и unread_count читателя в чате;
+                None, если сообщения нет или пользователь не участник его чата
+        """
+        logger.debug(f"Reading message {message_id} by user {user_id}")
+        target = (
+            select(
+                Message.id, Message.chat_id, Message.sender_id,
+                Message.text, Message.created_at, Message.updated_at
             )
-            await self.db.execute(stmt)
-            await self.db.commit()
-            logger.debug("Read status created successfully")
-        except Exception as e:
-            logger.error(f"Error creating read status: {str(e)}")
-            raise
+            .join(
+                chat_members,
+                (chat_members.c.chat_id == Message.chat_id) & (chat_members.c.user_id == user_id)
+            )
+            .where(Message.id == message_id)
+        )
+        if chat_id is not None:
+            target = target.where(Message.chat_id == chat_id)
+        target = target.cte("target")
+
+        # Повторная отметка ничего не меняет: отметка только растёт
+        watermark = func.greatest(chat_members.c.last_read_message_id, target.c.id)
+        advanced = (
+            update(chat_members)
+            .where(chat_members.c.chat_id == target.c.chat_id, chat_members.c.user_id == user_id)
+            .values(last_read_message_id=watermark, unread_count=unread_after(watermark))
+            .returning(chat_members.c.user_id, chat_members.c.unread_count)
+            .cte("advanced")
+        )
+        # UPDATE в CTE не виден остальной части запроса, поэтому читатель добавляется из RETURNING
+        readers = union_all(
+            select(chat_members.c.user_id).where(
+                chat_members.c.chat_id == target.c.chat_id,
+                chat_members.c.last_read_message_id >= target.c.id,
+                chat_members.c.user_id != user_id
+            ),
+            select(advanced.c.user_id)
+        ).cte("readers")
 
-    async def get_message_readers(self, message_id: int) -> List[int]:
+        read_count = func.count(readers.c.user_id)
+        unread_count = select(advanced.c.unread_count).scalar_subquery()
+        result = await self.db.execute(
+            select(
+                target,
+                read_count.label("read_count"),
+                case((read_count <= max_read_by, func.array_agg(readers.c.user_id)), else_=None).label("read_by"),
+                unread_count.label("unread_count")
+            )
+            .select_from(target)
+            .outerjoin(readers, true())
+            .group_by(*target.c)
+        )
+        row = result.one_or_none()
+        if row is None:
+            return None
+        return {
+            "message_id": row.id,
+            "chat_id": row.chat_id,
+            "sender_id": row.sender_id,
+            "text": row.text,
+            "created_at": row.created_at,
+            "updated_at": row.updated_at,
+            "read_count": row.read_count,
+            "read_by": list(row.read_by) if row.read_by is not None else None,
+            "unread_count": row.unread_count
+        }
+
+    async def get_read_watermarks(self, chat_id: int) -> List[tuple[int, int]]:
+        """Отметки прочтения участников чата: (user_id, last_read_message_id)"""
+        result = await self.db.execute(
+            select(chat_members.c.user_id, chat_members.c.last_read_message_id)
+            .where(chat_members.c.chat_id == chat_id, chat_members.c.last_read_message_id > 0)
+        )
+        return [(user_id, last_read) for user_id, last_read in result]
+
+    async def get_messages_after(self, chat_id: int, after_id: int, limit: int) -> List[dict]:
         """
-        Получает список ID пользователей, прочитавших сообщение
-        
+        Сообщения чата с id больше after_id.
+        Один диапазонный запрос по индексу (chat_id, id).
+
         Args:
-            message_id: ID сообщения
-            
+            chat_id: ID чата
+            after_id: Последнее сообщение, которое уже есть у клиента
+            limit: Максимум сообщений
+
         Returns:
-            List[int]: Список ID пользователей
+            List[dict]: message_id, sender_id, text, timestamp в порядке id
         """
-        logger.debug(f"Getting readers for message: {message_id}")
-        try:
-            query = select(message_read_status.c.user_id).where(
-                message_read_status.c.message_id == message_id
+        logger.debug(f"Getting messages after {after_id} in chat {chat_id}, limit={limit}")
+        result = await self.db.execute(
+            select(Message.id, Message.sender_id, Message.text, Message.created_at)
+            .where(Message.chat_id == chat_id, Message.id > after_id)
+            .order_by(Message.id)
+            .limit(limit)
+        )
+        return [
+            {
+                "message_id": row.id,
+                "sender_id": row.sender_id,
+                "text": row.text,
+                "timestamp": row.created_at
+            }
+            for row in result
+        ]
+
+    async def prune_idempotency_keys(self, older_than: datetime) -> int:
+        """
+        Удаление idempotency ключей старых сообщений: повтор отправки через
+        столько времени уже не ожидается, а уникальный индекс становится меньше
+        Диапазон по created_at во всех чатах обслуживает BRIN индекс ix_messages_created_at_brin
+
+        Returns:
+            int: Число очищенных ключей
+        """
+        result = await self.db.execute(
+            update(Message)
+            .where(Message.created_at < older_than, Message.idempotency_key.is_not(None))
+            .values(idempotency_key=None)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.commit()
+        return result.rowcount
+
+    async def commit(self) -> None:
+        """Фиксация транзакции пакетной операции"""
+        await self.db.commit()
+
+    async def get_by_idempotency_keys(self, idempotency_keys: List[str], sender_id: int) -> dict[str, Message]:
+        """Сообщения отправителя по списку idempotency ключей"""
+        if not idempotency_keys:
+            return {}
+        result = await self.db.execute(
+            select(Message).where(Message.sender_id == sender_id, Message.idempotency_key.in_(idempotency_keys))
+        )
+        return {message.idempotency_key: message for message in result.scalars()}
+
+    async def get_accessible_messages(self, message_ids: List[int], user_id: int) -> dict[int, tuple[int, str, datetime]]:
+        """
+        Сообщения, доступные пользователю (он состоит в чате сообщения)
+
+        Returns:
+            dict: message_id -> (chat_id, text, created_at); недоступных и несуществующих сообщений нет в словаре
+        """
+        result = await self.db.execute(
+            select(Message.id, Message.chat_id, Message.text, Message.created_at)
+            .join(
+                chat_members,
+                (chat_members.c.chat_id == Message.chat_id) & (chat_members.c.user_id == user_id)
             )
-            result = await self.db.execute(query)
-            return [row[0] for row in result.fetchall()]
-        except Exception as e:
-            logger.error(f"Error getting message readers: {str(e)}")
-            raise 
\ No newline at end of file
+            .where(Message.id.in_(message_ids))
+        )
+        return {message_id: (chat_id, text, created_at) for message_id, chat_id, text, created_at in result}
+
+    async def get_readers_many(self, message_ids: List[int], max_read_by: int) -> dict[int, tuple[int, Optional[List[int]]]]:
+        """
+        Прочитавшие пользователи для нескольких сообщений одним запросом
+
+        Args:
+            message_ids: ID сообщений
+            max_read_by: Если прочитавших больше, список не возвращается
+
+        Returns:
+            dict: message_id -> (число прочитавших, их ID или None)
+        """
+        read_count = func.count(chat_members.c.user_id)
+        result = await self.db.execute(
+            select(
+                Message.id,
+                read_count,
+                # Для больших групп список не собирается, достаточно числа
+                case((read_count <= max_read_by, func.array_agg(chat_members.c.user_id)), else_=None)
+            )
+            .join(
+                chat_members,
+                (chat_members.c.chat_id == Message.chat_id) & (chat_members.c.last_read_message_id >= Message.id)
+            )
+            .where(Message.id.in_(message_ids))
+            .group_by(Message.id)
+        )
+        return {
+            message_id: (count, list(readers) if readers is not None else None)
+            for message_id, count, readers in result
+        }
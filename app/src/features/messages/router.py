@@ -1,15 +1,18 @@
-from fastapi import APIRouter, Depends, status
+from datetime import datetime
+from fastapi import APIRouter, Depends, Query, status
 
 from src.features.messages.dependencies import get_message_service
 from src.features.messages.schemas import (
     MessageCreate,
     MessageUpdate,
     MessageInDB,
-
+    MessageReadReceipt,
+    MessageHistory,
 )
 
 from src.features.auth.dependencies import get_current_user
 from src.features.users.schemas import UserInDB
+from src.features.websocket.dependencies import websocket_manager
 
 
 
@@ -24,7 +27,10 @@ async def create_new_message(
     current_user: UserInDB = Depends(get_current_user)
 ):
     """Создание нового сообщения"""
-    return await message_service.create_message(message_data, current_user)
+    message = await message_service.create_message(message_data, current_user)
+    # Счётчики непрочитанного после commit - в соединения участников, как и для WebSocket
+    await websocket_manager.send_unread_counts(message_service.unread_changes)
+    return message
 
 @router.get("/{message_id}", response_model=MessageInDB)
 async def read_message(
@@ -52,16 +58,20 @@ async def delete_message_endpoint(
     current_user: UserInDB = Depends(get_current_user)
 ):
     """Удаление сообщения"""
-    return await message_service.delete_message(message_id, current_user)
+    message = await message_service.delete_message(message_id, current_user)
+    await websocket_manager.send_unread_counts(message_service.unread_changes)
+    return message
 
-@router.post("/{message_id}/read", response_model=MessageInDB)
+@router.post("/{message_id}/read", response_model=MessageReadReceipt)
 async def mark_message_as_read(
     message_id: int,
     message_service = Depends(get_message_service),
     current_user: UserInDB = Depends(get_current_user)
 ):
     """Отметить сообщение как прочитанное"""
-    return await message_service.mark_as_read(message_id, current_user)
+    receipt = await message_service.read_message(message_id, current_user)
+    await websocket_manager.send_unread_counts(message_service.unread_changes)
+    return {**receipt, "reader_id": current_user.id}
 
 @router.get("/chat/{chat_id}", response_model=list[MessageInDB])
 async def read_chat_messages(
@@ -73,3 +83,29 @@ async def read_chat_messages(
 ):
     """Получение сообщений чата"""
     return await message_service.get_chat_messages(chat_id, current_user, skip, limit)
+
+
+@router.get("/chat/{chat_id}/history/around", response_model=MessageHistory)
+async def read_chat_history_window(
+    chat_id: int,
+    message_id: int | None = Query(None, description="Сообщение, вокруг которого нужно окно"),
+    at: datetime | None = Query(None, description="Момент времени для перехода к дате"),
+    limit: int = Query(50, ge=1, le=100),
+    message_service = Depends(get_message_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Окно истории вокруг сообщения или даты в обе стороны"""
+    return await message_service.get_history_window(chat_id, current_user, limit, message_id, at)
+
+
+@router.get("/chat/{chat_id}/history", response_model=MessageHistory)
+async def read_chat_history(
+    chat_id: int,
+    before: str | None = Query(None, description="Курсор: сообщения старше этой позиции"),
+    after: str | None = Query(None, description="Курсор: сообщения новее этой позиции"),
+    limit: int = Query(50, ge=1, le=100),
+    message_service = Depends(get_message_service),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """История чата с постраничной навигацией по курсору"""
+    return await message_service.get_history(chat_id, current_user, limit, before, after)
@@ -40,19 +40,30 @@ class MessageResponse(BaseModel):
     chat_id: int
     sender_id: int
     text: str
-    is_read: bool
+    is_read: bool = False
     created_at: datetime
     updated_at: datetime
-    read_by: list[int] = Field(default_factory=list)
+    read_by: list[int] | None = Field(default_factory=list)  # None, если прочитавших больше READ_RECEIPTS_MAX_READ_BY
+    read_count: int = 0
     idempotency_key: str | None = None
 
     class Config:
         from_attributes = True
 
+class MessageReadReceipt(BaseModel):
+    message_id: int
+    chat_id: int
+    reader_id: int
+    read_count: int
+    read_by: list[int] | None = None  # None, если прочитавших больше READ_RECEIPTS_MAX_READ_BY
+
 class MessageHistory(BaseModel):
-    messages: List[MessageResponse]
-    total: int
-    has_more: bool
+    messages: List[MessageResponse]  # От новых к старым
+    has_more: bool  # Есть ли ещё сообщения в направлении выборки (для окна - более старые)
+    has_newer: bool | None = None  # Для окна: есть ли сообщения новее
+    anchor_id: int | None = None  # Для окна: сообщение, вокруг которого оно построено
+    before_cursor: str | None = None  # Для следующей страницы более старых сообщений
+    after_cursor: str | None = None  # Для сообщений новее этой страницы
 
     class Config:
         json_encoders = {
@@ -1,25 +1,34 @@
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.core.logging import logger
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List
 
 from src.core.exceptions import (
     NotFoundException,
     ForbiddenException,
-    MessageException
+    MessageException,
+    ValidationException
 )
 from src.features.messages.repositories import MessageRepository
 from src.features.messages.schemas import MessageCreate, MessageUpdate
 from src.features.users.schemas import UserInDB
 from src.features.chats.services import ChatService
 from src.features.messages.models import Message
+from src.features.messages.cursors import encode_cursor, decode_cursor
+from src.features.messages.write_buffer import message_write_buffer
+from src.config import get_settings
+
+
+settings = get_settings()
 
 
 class MessageService:
     def __init__(self, db: AsyncSession):
         self.repository = MessageRepository(db)
         self.chat_service = ChatService(db)
+        # Изменённые счётчики непрочитанного (user_id, chat_id, unread_count) для рассылки после commit
+        self.unread_changes: List[dict] = []
 
     async def get_message(self, message_id: int, current_user: UserInDB) -> Message:
         """Получение сообщения по ID с проверкой прав доступа"""
@@ -30,56 +39,55 @@ class MessageService:
             logger.warning(f"Message {message_id} not found")
             raise NotFoundException(f"Message {message_id} not found")
             
-        chat = await self.chat_service.get_chat(message.chat_id, current_user)
-        if current_user.id not in [m.id for m in chat.members]:
-            logger.warning(f"User {current_user.id} attempted to access message {message_id} without chat membership")
-            raise ForbiddenException("Not a chat member")
-            
+        await self.chat_service.require_member(message.chat_id, current_user)
         return message
 
-    async def get_message_by_idempotency_key(self, idempotency_key: str) -> Optional[Message]:
-        """Получение сообщения по idempotency ключу"""
-        return await self.repository.get_by_idempotency_key(idempotency_key)
+    async def get_message_by_idempotency_key(self, idempotency_key: str, current_user: UserInDB) -> Optional[Message]:
+        """Получение сообщения пользователя по idempotency ключу"""
+        return await self.repository.get_by_idempotency_key(idempotency_key, current_user.id)
 
     async def create_message(self, message_data: MessageCreate, current_user: UserInDB) -> Message:
-        """Создание нового сообщения"""
-        logger.info(f"Creating message in chat {message_data.chat_id} by user {current_user.id}")
-        
-        # Проверяем существование сообщения с таким ключом
-        if message_data.idempotency_key:
-            existing_message = await self.get_message_by_idempotency_key(message_data.idempotency_key)
-            if existing_message:
-                logger.info(f"Found existing message with idempotency key {message_data.idempotency_key}")
-                return existing_message
-
-        chat = await self.chat_service.get_chat(message_data.chat_id, current_user)
-        if not chat:
-            logger.warning(f"Chat {message_data.chat_id} not found")
-            raise NotFoundException(f"Chat {message_data.chat_id} not found")
-            
-        if current_user.id not in [m.id for m in chat.members]:
-            logger.warning(f"User {current_user.id} attempted to create message in chat {chat.id} without membership")
-            raise ForbiddenException("Not a chat member")
-        
-        try:
-            now = datetime.utcnow()
-            message_dict = message_data.model_dump()
-            message_dict.update({
-                "created_at": now,
-                "updated_at": now,
-                "sender_id": current_user.id
-            })
+        """
+        Создание нового сообщения
 
+        Проверка членства, вставка и счётчики непрочитанного - один запрос.
+        Повтор с уже использованным idempotency ключом (в том числе
+        конкурентный) возвращает ранее созданное сообщение.
+        """
+        logger.info(f"Creating message in chat {message_data.chat_id} by user {current_user.id}")
 
-            
-            logger.info(f"Message dict: {message_dict}")
-            message = await self.repository.create(MessageCreate(**message_dict), current_user.id)
-            logger.info(f"Message {message.id} created successfully")
-            return message
+        try:
+            if settings.MESSAGE_WRITE_BUFFER_ENABLED:
+                # Запрос и commit общие с другими сообщениями, накопленными буфером
+                message, unread_changes = await message_write_buffer.submit(message_data, current_user.id)
+            else:
+                message, unread_changes = await self.repository.create(message_data, current_user.id)
         except Exception as e:
             logger.error(f"Error creating message: {str(e)}")
             raise MessageException("Failed to create message")
 
+        if message is None:
+            # Ничего не вставлено: ключ уже использован или отправитель не участник чата
+            if message_data.idempotency_key:
+                existing_message = await self.get_message_by_idempotency_key(message_data.idempotency_key, current_user)
+                if existing_message:
+                    logger.info(f"Found existing message with idempotency key {message_data.idempotency_key}")
+                    return existing_message
+            logger.warning(f"User {current_user.id} attempted to create message in chat {message_data.chat_id} without membership")
+            raise ForbiddenException("Not a chat member")
+
+        await self.repository.commit()
+        self.unread_changes.extend(unread_changes)
+        logger.info(f"Message {message.id} created successfully")
+        return message
+
+    async def prune_idempotency_keys(self) -> int:
+        """Очистка idempotency ключей сообщений старше IDEMPOTENCY_KEY_TTL_HOURS"""
+        older_than = datetime.now(timezone.utc) - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+        pruned = await self.repository.prune_idempotency_keys(older_than)
+        logger.info(f"Pruned {pruned} idempotency keys older than {older_than}")
+        return pruned
+
     async def update_message(self, message_id: int, message_update: MessageUpdate, current_user: UserInDB) -> Message:
         logger.info(f"Updating message {message_id} by user {current_user.id}")
         
@@ -107,7 +115,7 @@ class MessageService:
             raise ForbiddenException("Can only delete own messages")
             
         try:
-            await self.repository.delete(message)
+            self.unread_changes.extend(await self.repository.delete(message))
             logger.info(f"Message {message_id} deleted successfully")
             return message
         except Exception as e:
@@ -117,15 +125,8 @@ class MessageService:
     async def get_chat_messages(self, chat_id: int, current_user: UserInDB, skip: int = 0, limit: int = 50):
         logger.info(f"Getting messages for chat {chat_id}, user {current_user.id}")
         
-        chat = await self.chat_service.get_chat(chat_id)
-        if not chat:
-            logger.warning(f"Chat {chat_id} not found")
-            raise NotFoundException(f"Chat {chat_id} not found")
-            
-        if current_user.id not in [m.id for m in chat.members]:
-            logger.warning(f"User {current_user.id} attempted to access chat {chat_id} without membership")
-            raise ForbiddenException("Not a chat member")
-        
+        await self.chat_service.require_member(chat_id, current_user)
+
         try:
             messages = await self.repository.get_chat_messages(chat_id, skip, limit)
             logger.info(f"Retrieved {len(messages)} messages from chat {chat_id}")
@@ -134,55 +135,275 @@ class MessageService:
             logger.error(f"Error getting chat messages: {str(e)}")
             raise MessageException("Failed to get chat messages")
 
-    async def mark_as_read(self, message_id: int, user_id: int) -> Message:
+    async def get_history(
+        self,
+        chat_id: int,
+        current_user: UserInDB,
+        limit: int = 50,
+        before: Optional[str] = None,
+        after: Optional[str] = None
+    ) -> dict:
         """
-        Отмечает сообщение как прочитанное
-        
+        Страница истории чата по непрозрачному курсору
+
+        Стоимость запроса не зависит от глубины: has_more определяется по limit + 1
+        строке, без COUNT по всему чату.
+
         Args:
-            message_id: ID сообщения
-            user_id: ID пользователя, прочитавшего сообщение
-            
+            chat_id: ID чата
+            current_user: Текущий пользователь
+            limit: Размер страницы
+            before: Курсор, старше которого нужны сообщения (прокрутка назад)
+            after: Курсор, новее которого нужны сообщения (прокрутка вперёд)
+
         Returns:
-            Message: Обновленное сообщение
-            
+            dict: Сообщения от новых к старым, has_more в направлении выборки и курсоры краёв страницы
+
         Raises:
-            NotFoundException: Если сообщение не найдено
+            ValidationException: Если переданы оба курсора или курсор повреждён
+            ForbiddenException: Если пользователь не участник чата
         """
-        logger.debug(f"Marking message {message_id} as read by user {user_id}")
-        logger.info(f"НАЧАЛО МАРКАС АС РЕАД")
-  
-        # Получаем сообщение
-        message = await self.repository.get_by_id(message_id)
-        
-        if not message:
-            raise NotFoundException(f"Message {message_id} not found")
-        
-        # Создаем запись в message_read_status
-        await self.repository.create_read_status(message_id, user_id)
+        if before is not None and after is not None:
+            raise ValidationException("Only one of before and after can be used")
+        if chat_id not in await self.chat_service.get_member_chat_ids([chat_id], current_user):
+            logger.warning(f"User {current_user.id} attempted to read history of chat {chat_id} without membership")
+            raise ForbiddenException("Not a chat member")
 
+        rows = await self.repository.get_history(
+            chat_id,
+            limit + 1,
+            before=decode_cursor(before) if before is not None else None,
+            after=decode_cursor(after) if after is not None else None
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is not None:
+            rows.reverse()
+        await self._attach_receipts(chat_id, rows)
 
-        return message 
+        return {
+            "messages": rows,
+            "has_more": has_more,
+            "before_cursor": encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if rows else before,
+            "after_cursor": encode_cursor(rows[0]["created_at"], rows[0]["id"]) if rows else after
+        }
 
-    async def get_message_readers(self, message_id: int) -> List[int]:
+    async def get_history_window(
+        self,
+        chat_id: int,
+        current_user: UserInDB,
+        limit: int = 50,
+        message_id: Optional[int] = None,
+        at: Optional[datetime] = None
+    ) -> dict:
         """
-        Получает список пользователей, прочитавших сообщение
-        
+        Окно истории вокруг сообщения или момента времени (переход по ссылке, поиску, дате)
+
+        Два диапазонных запроса от позиции цели в обе стороны по индексу
+        (chat_id, created_at, id), поэтому время ответа не зависит от того,
+        насколько далеко в прошлом находится цель.
+
+        Args:
+            chat_id: ID чата
+            current_user: Текущий пользователь
+            limit: Размер окна; половина - сообщения старше цели
+            message_id: Сообщение, вокруг которого нужно окно
+            at: Момент времени; целью становится первое сообщение не раньше него
+
+        Returns:
+            dict: Сообщения от новых к старым, anchor_id, has_more (есть старше),
+                has_newer (есть новее) и курсоры краёв окна для дальнейшей прокрутки
+
+        Raises:
+            ValidationException: Если не передана ровно одна цель
+            NotFoundException: Если сообщения нет в чате
+            ForbiddenException: Если пользователь не участник чата
+        """
+        if (message_id is None) == (at is None):
+            raise ValidationException("Exactly one of message_id and at is required")
+        if chat_id not in await self.chat_service.get_member_chat_ids([chat_id], current_user):
+            logger.warning(f"User {current_user.id} attempted to read history of chat {chat_id} without membership")
+            raise ForbiddenException("Not a chat member")
+
+        if message_id is not None:
+            position = await self.repository.get_position(chat_id, message_id)
+            if position is None:
+                raise NotFoundException(f"Message {message_id} not found")
+        else:
+            # id > 0 у всех сообщений, поэтому (at, 0) стоит перед любым сообщением момента at
+            position = (at, 0)
+
+        older_limit = limit // 2
+        newer_limit = limit - older_limit
+        newer = await self.repository.get_history(chat_id, newer_limit + 1, after=position, inclusive=True)
+        older = await self.repository.get_history(chat_id, older_limit + 1, before=position)
+
+        rows = newer[:newer_limit][::-1] + older[:older_limit]
+        await self._attach_receipts(chat_id, rows)
+        return {
+            "messages": rows,
+            "anchor_id": newer[0]["id"] if newer else None,
+            "has_more": len(older) > older_limit,
+            "has_newer": len(newer) > newer_limit,
+            "before_cursor": encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if rows else None,
+            "after_cursor": encode_cursor(rows[0]["created_at"], rows[0]["id"]) if rows else None
+        }
+
+    async def _attach_receipts(self, chat_id: int, rows: List[dict]) -> None:
+        """Прочитавшие сообщения страницы по отметкам участников (один запрос на чат)"""
+        if not rows:
+            return
+        watermarks = await self.repository.get_read_watermarks(chat_id)
+        for row in rows:
+            read_by = [user_id for user_id, last_read in watermarks if last_read >= row["id"]]
+            row["read_count"] = len(read_by)
+            row["read_by"] = read_by if len(read_by) <= settings.READ_RECEIPTS_MAX_READ_BY else None
+
+    async def read_message(self, message_id: int, current_user: UserInDB, chat_id: Optional[int] = None) -> dict:
+        """
+        Отмечает сообщение как прочитанное одним запросом к БД
+
+        Повторная отметка не является ошибкой. Прочтение сообщения означает
+        прочтение и всех предыдущих сообщений чата.
+
         Args:
             message_id: ID сообщения
-            
+            current_user: Пользователь, прочитавший сообщение
+            chat_id: Чат, которому должно принадлежать сообщение
+
         Returns:
-            List[int]: Список ID пользователей, прочитавших сообщение
-            
+            dict: Поля сообщения, read_count и read_by (None для больших групп)
+
         Raises:
-            NotFoundException: Если сообщение не найдено
+            NotFoundException: Если сообщение не найдено или недоступно пользователю
         """
-        logger.debug(f"Getting readers for message {message_id}")
-        
-        # Проверяем существование сообщения
-        message = await self.repository.get_by_id(message_id)
-        if not message:
+        logger.debug(f"Marking message {message_id} as read by user {current_user.id}")
+        receipt = await self.repository.read_message(
+            message_id, current_user.id, settings.READ_RECEIPTS_MAX_READ_BY, chat_id
+        )
+        if receipt is None:
             raise NotFoundException(f"Message {message_id} not found")
-            
-        # Получаем список прочитавших из репозитория
-        return await self.repository.get_message_readers(message_id)
+        await self.repository.commit()
+        self.unread_changes.append({
+            "user_id": current_user.id,
+            "chat_id": receipt["chat_id"],
+            "unread_count": receipt["unread_count"]
+        })
+        return receipt
+
+    async def get_read_receipts(self, message_ids: List[int]) -> dict[int, dict]:
+        """
+        Прочитавшие сообщения по отметкам прочтения участников
+
+        Returns:
+            dict[int, dict]: message_id -> read_count и read_by; для групп, где прочитавших
+                больше READ_RECEIPTS_MAX_READ_BY, read_by равен None
+        """
+        readers = await self.repository.get_readers_many(message_ids, settings.READ_RECEIPTS_MAX_READ_BY)
+        receipts = {}
+        for message_id in message_ids:
+            read_count, read_by = readers.get(message_id, (0, []))
+            receipts[message_id] = {"read_count": read_count, "read_by": read_by}
+        return receipts
+
+    async def get_missed_messages(
+        self,
+        chat_id: int,
+        after_id: int,
+        current_user: UserInDB,
+        limit: int
+    ) -> tuple[List[dict], bool]:
+        """
+        Сообщения, пропущенные клиентом после after_id
+
+        Returns:
+            tuple[List[dict], bool]: Сообщения и признак того, что пропущено больше limit
+        """
+        if chat_id not in await self.chat_service.get_member_chat_ids([chat_id], current_user):
+            logger.warning(f"User {current_user.id} attempted to catch up chat {chat_id} without membership")
+            raise ForbiddenException("Not a chat member")
+
+        messages = await self.repository.get_messages_after(chat_id, after_id, limit + 1)
+        # Прочитавшие вычисляются из отметок участников, без запроса на каждое сообщение
+        watermarks = await self.repository.get_read_watermarks(chat_id)
+        for message in messages:
+            read_by = [user_id for user_id, last_read in watermarks if last_read >= message["message_id"]]
+            message["read_count"] = len(read_by)
+            message["read_by"] = read_by if len(read_by) <= settings.READ_RECEIPTS_MAX_READ_BY else None
+        return messages[:limit], len(messages) > limit
+
+    async def apply_batch(
+        self,
+        messages: List[MessageCreate],
+        read_message_ids: List[int],
+        current_user: UserInDB
+    ) -> tuple[List[Message], dict[int, dict]]:
+        """
+        Пакет новых сообщений и отметок о прочтении в одной транзакции с одним commit.
+        При ошибке любой операции не применяется ни одна.
+        """
+        created = await self._add_messages(messages, current_user) if messages else []
+        readers = await self._add_read_statuses(read_message_ids, current_user) if read_message_ids else {}
+        await self.repository.commit()
+        return created, readers
+
+    async def _add_messages(self, messages: List[MessageCreate], current_user: UserInDB) -> List[Message]:
+        """Вставка сообщений пачки без commit"""
+        logger.info(f"Creating {len(messages)} messages by user {current_user.id}")
+
+        chat_ids = list({message.chat_id for message in messages})
+        allowed = await self.chat_service.get_member_chat_ids(chat_ids, current_user)
+        forbidden = sorted(set(chat_ids) - allowed)
+        if forbidden:
+            logger.warning(f"User {current_user.id} attempted to create messages in chats {forbidden} without membership")
+            raise ForbiddenException(f"Not a member of chats {forbidden}")
+
+        # Тот же запрос, что и для одного сообщения: INSERT ... ON CONFLICT по ключу
+        # отправителя и счётчики непрочитанного, поэтому конкурентный повтор пачки не падает
+        try:
+            created, unread_changes = await self.repository.create_many(
+                [(message, current_user.id) for message in messages]
+            )
+        except Exception as e:
+            logger.error(f"Error creating messages: {str(e)}")
+            raise MessageException("Failed to create messages")
+        self.unread_changes.extend(unread_changes)
+
+        # Не вставленные строки - повторы уже использованных ключей (в том числе внутри пачки)
+        skipped_keys = [
+            message.idempotency_key
+            for message, db_message in zip(messages, created)
+            if db_message is None and message.idempotency_key
+        ]
+        existing = await self.repository.get_by_idempotency_keys(skipped_keys, current_user.id)
+        result = []
+        for message, db_message in zip(messages, created):
+            if db_message is None:
+                db_message = existing.get(message.idempotency_key) if message.idempotency_key else None
+            if db_message is None:
+                # Членство проверено выше: строку отклонил запрос, значит состав успел измениться
+                raise ForbiddenException(f"Not a member of chat {message.chat_id}")
+            result.append(db_message)
+        return result
+
+    async def _add_read_statuses(self, message_ids: List[int], current_user: UserInDB) -> dict[int, dict]:
+        """Отметки о прочтении пачки без commit"""
+        message_ids = list(dict.fromkeys(message_ids))
+        logger.info(f"Marking {len(message_ids)} messages as read by user {current_user.id}")
+
+        accessible = await self.repository.get_accessible_messages(message_ids, current_user.id)
+        missing = [message_id for message_id in message_ids if message_id not in accessible]
+        if missing:
+            raise NotFoundException(f"Messages {missing} not found")
 
+        self.unread_changes.extend(await self.repository.advance_read_watermarks(message_ids, current_user.id))
+        receipts = await self.get_read_receipts(message_ids)
+        return {
+            message_id: {
+                "chat_id": accessible[message_id][0],
+                "text": accessible[message_id][1],
+                "created_at": accessible[message_id][2],
+                **receipts[message_id]
+            }
+            for message_id in message_ids
+        }
@@ -0,0 +1,125 @@
+import asyncio
+from typing import AsyncContextManager, Callable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import get_settings
+from src.core.db import AsyncSessionFactory
+from src.core.logging import logger
+from src.features.messages.models import Message
+from src.features.messages.repositories import MessageRepository
+from src.features.messages.schemas import MessageCreate
+
+
+settings = get_settings()
+
+
+class MessageWriteBuffer:
+    """
+    Групповая запись сообщений (group commit).
+
+    Конкурентные вызовы submit копятся несколько миллисекунд (или до max_size
+    сообщений) и записываются одним многострочным запросом и одним commit.
+    Пакеты пишутся строго по очереди, а id внутри пакета выдаются в порядке
+    вызовов, поэтому порядок сообщений в чате сохраняется.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncContextManager[AsyncSession]] = AsyncSessionFactory,
+        delay_ms: int = settings.MESSAGE_WRITE_BUFFER_DELAY_MS,
+        max_size: int = settings.MESSAGE_WRITE_BUFFER_MAX_SIZE
+    ):
+        self.session_factory = session_factory
+        self.delay = delay_ms / 1000
+        self.max_size = max_size
+        self._pending: List[tuple[MessageCreate, int, asyncio.Future]] = []
+        self._full = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+
+    async def submit(self, message_data: MessageCreate, sender_id: int) -> tuple[Optional[Message], List[dict]]:
+        """
+        Постановка сообщения в пакет и ожидание его commit
+
+        Returns:
+            tuple: Сообщение (None, если отправитель не участник или ключ уже использован)
+                и счётчики непрочитанного в его чате после commit (user_id, chat_id, unread_count)
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message_data, sender_id, future))
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+        return await future
+
+    async def stop(self) -> None:
+        """Запись уже принятых сообщений перед остановкой"""
+        if self._runner is not None:
+            self._full.set()
+            await self._runner
+
+    async def _run(self) -> None:
+        try:
+            while self._pending:
+                if len(self._pending) < self.max_size:
+                    self._full.clear()
+                    try:
+                        await asyncio.wait_for(self._full.wait(), self.delay)
+                    except asyncio.TimeoutError:
+                        pass
+                batch = self._pending[:self.max_size]
+                del self._pending[:self.max_size]
+                await self._flush(batch)
+        finally:
+            self._runner = None
+
+    async def _flush(self, batch: List[tuple[MessageCreate, int, asyncio.Future]]) -> None:
+        statement_error = None
+        try:
+            async with self.session_factory() as db:
+                repository = MessageRepository(db)
+                try:
+                    messages, unread_changes = await repository.create_many(
+                        [(message_data, sender_id) for message_data, sender_id, _ in batch]
+                    )
+                except Exception as e:
+                    # Запрос отклонён до commit: транзакция откатывается, ничего не записано
+                    statement_error = e
+                else:
+                    await repository.commit()
+        except Exception as e:
+            if statement_error is None:
+                # Сбой на commit: пакет мог успеть записаться, и повтор продублировал бы
+                # сообщения без idempotency ключа, поэтому исход отдаём вызывающим
+                logger.error(f"Message write batch of {len(batch)} failed on commit, outcome unknown: {str(e)}")
+                self._fail(batch, e)
+                return
+
+        if statement_error is not None:
+            if len(batch) > 1:
+                # Ошибка одного сообщения не должна отменять остальные: пишем по одному
+                logger.warning(f"Message write batch of {len(batch)} failed, retrying one by one: {str(statement_error)}")
+                for item in batch:
+                    await self._flush([item])
+                return
+            logger.error(f"Error writing buffered message: {str(statement_error)}")
+            self._fail(batch, statement_error)
+            return
+
+        logger.debug(f"Message write batch committed: {len(batch)} messages")
+        for (_, _, future), message in zip(batch, messages):
+            if future.done():
+                continue
+            changes = [change for change in unread_changes if message and change["chat_id"] == message.chat_id]
+            future.set_result((message, changes))
+
+    @staticmethod
+    def _fail(batch: List[tuple[MessageCreate, int, asyncio.Future]], error: Exception) -> None:
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+# Общий для процесса буфер; используется, если включён MESSAGE_WRITE_BUFFER_ENABLED
+message_write_buffer = MessageWriteBuffer()
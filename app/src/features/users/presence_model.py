@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Table
+from src.core.db import Base
+
+# Последняя активность пользователя, общая для всех инстансов приложения
+user_presence = Table(
+    "user_presence",
+    Base.metadata,
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    Column("last_seen_at", DateTime(timezone=True), nullable=False),
+    # Пока online_until в будущем, пользователь считается онлайн хотя бы на одном инстансе
+    Column("online_until", DateTime(timezone=True), nullable=False, index=True),
+)
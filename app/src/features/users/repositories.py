@@ -1,10 +1,13 @@
-from typing import Optional, List
-from sqlalchemy import select
+from datetime import datetime
+from typing import Optional, List, Iterable
+from sqlalchemy import select, func, any_, bindparam, Integer
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 
 from src.core.logging import logger
 from src.features.users.models import User
+from src.features.users.presence_model import user_presence
 from src.features.users.schemas import UserCreate, UserUpdate
 from src.core.security import get_password_hash, SECRET_KEY, ALGORITHM
 from src.core.exceptions import InvalidTokenException
@@ -26,6 +29,22 @@ class UserRepository:
         result = await self.db.execute(select(User).where(User.id == user_id))
         return result.scalar_one_or_none()
 
+    async def get_by_ids(self, user_ids: Iterable[int]) -> List[User]:
+        """
+        Получение пользователей по списку ID одним запросом
+
+        id передаются одним параметром-массивом (id = ANY(:user_ids)), поэтому
+        текст запроса и его план не зависят от длины списка.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        logger.debug(f"Getting {len(user_ids)} users by ids")
+        if not user_ids:
+            return []
+        result = await self.db.execute(
+            select(User).where(User.id == any_(bindparam("user_ids", user_ids, type_=ARRAY(Integer))))
+        )
+        return list(result.scalars().all())
+
     async def get_list(self, skip: int = 0, limit: int = 100) -> List[User]:
         """Получение списка пользователей"""
         logger.debug(f"Getting users list: skip={skip}, limit={limit}")
@@ -106,4 +125,47 @@ class UserRepository:
         if user is None:
             raise InvalidTokenException()
             
-        return user 
\ No newline at end of file
+        return user
+
+
+class PresenceRepository:
+    # Ограничение числа строк в одном INSERT (лимит параметров asyncpg - 32767)
+    UPSERT_CHUNK = 5000
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def upsert_many(self, rows: Iterable[dict], extend_only: bool = False) -> None:
+        """
+        Пакетная запись присутствия пользователей
+
+        Args:
+            rows: Словари с ключами user_id, last_seen_at, online_until
+            extend_only: online_until только продлевается - запись одного инстанса
+                не сокращает онлайн, продлённый другим
+        """
+        rows = list(rows)
+        for start in range(0, len(rows), self.UPSERT_CHUNK):
+            stmt = insert(user_presence).values(rows[start:start + self.UPSERT_CHUNK])
+            online_until = stmt.excluded.online_until
+            if extend_only:
+                online_until = func.greatest(user_presence.c.online_until, online_until)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[user_presence.c.user_id],
+                set_={
+                    "last_seen_at": func.greatest(user_presence.c.last_seen_at, stmt.excluded.last_seen_at),
+                    "online_until": online_until
+                }
+            )
+            await self.db.execute(stmt)
+        await self.db.commit()
+        logger.debug(f"Presence flushed for {len(rows)} users")
+
+    async def get_many(self, user_ids: List[int]) -> dict[int, tuple[datetime, datetime]]:
+        """Присутствие пользователей: user_id -> (last_seen_at, online_until)"""
+        result = await self.db.execute(
+            select(user_presence.c.user_id, user_presence.c.last_seen_at, user_presence.c.online_until)
+            .where(user_presence.c.user_id.in_(user_ids))
+        )
+        return {user_id: (last_seen_at, online_until) for user_id, last_seen_at, online_until in result}
+
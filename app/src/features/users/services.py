@@ -1,5 +1,5 @@
-from datetime import datetime
-from typing import List, Optional
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.core.logging import logger
@@ -9,7 +9,7 @@ from src.core.exceptions import (
     UserAlreadyExistsException,
     UserUpdateException
 )
-from src.features.users.repositories import UserRepository
+from src.features.users.repositories import UserRepository, PresenceRepository
 from src.features.users.schemas import UserCreate, UserUpdate, UserInDB
 from src.features.users.models import User
 
@@ -107,4 +107,37 @@ class UserService:
         if user.id != current_user.id:
             logger.warning(f"User {current_user.id} attempted to delete user {user_id}")
             raise ForbiddenException("Can only delete own account")
-        return await self.repository.delete(user) 
\ No newline at end of file
+        return await self.repository.delete(user)
+
+
+class PresenceService:
+    def __init__(self, db: AsyncSession):
+        self.repository = PresenceRepository(db)
+
+    async def get_presence(self, user_ids: List[int], online_locally: Iterable[int] = ()) -> List[dict]:
+        """
+        Присутствие пользователей по всем инстансам
+
+        Args:
+            user_ids: ID пользователей
+            online_locally: Пользователи с соединениями на текущем инстансе
+                (ещё могут отсутствовать в user_presence до ближайшей записи)
+
+        Returns:
+            List[dict]: user_id, online, last_seen_at в порядке запроса
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        stored = await self.repository.get_many(user_ids)
+        online_locally = set(online_locally)
+        now = datetime.now(timezone.utc)
+
+        presence = []
+        for user_id in user_ids:
+            last_seen_at, online_until = stored.get(user_id, (None, None))
+            presence.append({
+                "user_id": user_id,
+                "online": user_id in online_locally or (online_until is not None and online_until > now),
+                "last_seen_at": last_seen_at
+            })
+        return presence
+
@@ -0,0 +1,334 @@
+import asyncio
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from itertools import count
+from typing import Callable, Dict, List, Optional, Union
+
+import orjson
+
+from src.config import get_settings
+from src.core.logging import logger
+from src.core.pg_listener import PgListener, get_pg_listener
+
+
+settings = get_settings()
+
+# Кому из участников чата кадр не доставляется: один пользователь или список
+ExcludedUsers = Union[int, List[int], None]
+# Обработчик доставки кадра локальным соединениям: (chat_id, frame, exclude_user_id, coalesce_key)
+DeliveryHandler = Callable[[int, str, ExcludedUsers, Optional[str]], None]
+# Обработчик доставки кадра всем локальным соединениям пользователя: (user_id, frame, coalesce_key)
+UserDeliveryHandler = Callable[[int, str, Optional[str]], None]
+# Обработчик доставки кадра соединениям одного участника, подписанным на чат: (chat_id, user_id, frame, coalesce_key)
+MemberDeliveryHandler = Callable[[int, int, str, Optional[str]], None]
+
+# Адресат события в PostgresBus: ("c", chat_id), ("u", user_id) или ("m", (chat_id, user_id))
+Target = tuple[str, Union[int, tuple[int, int]]]
+
+# Лимит payload у NOTIFY - 8000 байт, оставляем запас на служебные поля
+NOTIFY_PAYLOAD_LIMIT = 7500
+
+
+class BroadcastBus(ABC):
+    """
+    Шина событий под WebSocketSessionManager.
+
+    Менеджер публикует уже сериализованные кадры в шину, а шина доставляет их
+    локальным соединениям каждого процесса через обработчик менеджера.
+    """
+    # Все получатели находятся в текущем процессе
+    local_only = True
+
+    def __init__(self):
+        self._handler: Optional[DeliveryHandler] = None
+        self._user_handler: Optional[UserDeliveryHandler] = None
+        self._member_handler: Optional[MemberDeliveryHandler] = None
+
+    def set_handler(self, handler: DeliveryHandler) -> None:
+        self._handler = handler
+
+    def set_user_handler(self, handler: UserDeliveryHandler) -> None:
+        self._user_handler = handler
+
+    def set_member_handler(self, handler: MemberDeliveryHandler) -> None:
+        self._member_handler = handler
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def publish(
+        self,
+        chat_id: int,
+        frame: str,
+        exclude_user_id: ExcludedUsers = None,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        """Публикация кадра для участников чата"""
+
+    @abstractmethod
+    async def publish_to_user(self, user_id: int, frame: str, coalesce_key: Optional[str] = None) -> None:
+        """Публикация кадра для всех соединений пользователя (независимо от чатов)"""
+
+    @abstractmethod
+    async def publish_to_member(
+        self,
+        chat_id: int,
+        user_id: int,
+        frame: str,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        """Публикация кадра для соединений одного участника, подписанных на чат"""
+
+    def _deliver(
+        self,
+        chat_id: int,
+        frame: str,
+        exclude_user_id: ExcludedUsers,
+        coalesce_key: Optional[str]
+    ) -> None:
+        if self._handler is not None:
+            self._handler(chat_id, frame, exclude_user_id, coalesce_key)
+
+    def _deliver_to_user(self, user_id: int, frame: str, coalesce_key: Optional[str]) -> None:
+        if self._user_handler is not None:
+            self._user_handler(user_id, frame, coalesce_key)
+
+    def _deliver_to_member(self, chat_id: int, user_id: int, frame: str, coalesce_key: Optional[str]) -> None:
+        if self._member_handler is not None:
+            self._member_handler(chat_id, user_id, frame, coalesce_key)
+
+
+class InProcessBus(BroadcastBus):
+    """Доставка только внутри текущего процесса (один воркер)"""
+
+    async def publish(
+        self,
+        chat_id: int,
+        frame: str,
+        exclude_user_id: ExcludedUsers = None,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        self._deliver(chat_id, frame, exclude_user_id, coalesce_key)
+
+    async def publish_to_user(self, user_id: int, frame: str, coalesce_key: Optional[str] = None) -> None:
+        self._deliver_to_user(user_id, frame, coalesce_key)
+
+    async def publish_to_member(
+        self,
+        chat_id: int,
+        user_id: int,
+        frame: str,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        self._deliver_to_member(chat_id, user_id, frame, coalesce_key)
+
+
+class PostgresBus(BroadcastBus):
+    """
+    Межпроцессная доставка через Postgres LISTEN/NOTIFY.
+
+    Локальные соединения получают кадр сразу, остальные процессы - через NOTIFY.
+    События копятся несколько миллисекунд и уходят одним уведомлением на чат
+    (или на пользователя и участника чата для адресных событий);
+    большие кадры режутся на части. Каждый процесс отбрасывает свои же
+    уведомления и уже виденные идентификаторы событий.
+    """
+    local_only = False
+
+    def __init__(
+        self,
+        listener: PgListener,
+        channel: str = settings.WS_BROADCAST_CHANNEL,
+        flush_ms: int = settings.WS_BROADCAST_FLUSH_MS,
+        dedup_size: int = 10000,
+        partials_size: int = 1000
+    ):
+        super().__init__()
+        self.listener = listener
+        self.channel = channel
+        self.flush_interval = flush_ms / 1000
+        self.node_id = uuid.uuid4().hex[:12]
+
+        self._sequence = count()
+        # Адресат событий: ("c", chat_id) для чата, ("u", user_id) для пользователя
+        # или ("m", (chat_id, user_id)) для соединений участника в чате
+        self._pending: Dict[Target, List[list]] = defaultdict(list)
+        self._flush_task: Optional[asyncio.Task] = None
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._dedup_size = dedup_size
+        # Недособранные большие кадры; части потерянных уведомлений вытесняются старейшими
+        self._partials: OrderedDict[str, Dict[int, str]] = OrderedDict()
+        self._partials_size = partials_size
+
+    async def start(self) -> None:
+        await self.listener.listen(self.channel, self._on_notification)
+        await self.listener.start()
+        logger.info(f"Postgres broadcast bus started: node={self.node_id}, channel={self.channel}")
+
+    async def stop(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.listener.stop()
+
+    async def publish(
+        self,
+        chat_id: int,
+        frame: str,
+        exclude_user_id: ExcludedUsers = None,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        # Свои соединения обслуживаем сразу, не дожидаясь круга через базу
+        self._deliver(chat_id, frame, exclude_user_id, coalesce_key)
+
+        self._enqueue(("c", chat_id), exclude_user_id, coalesce_key, frame)
+
+    async def publish_to_user(self, user_id: int, frame: str, coalesce_key: Optional[str] = None) -> None:
+        self._deliver_to_user(user_id, frame, coalesce_key)
+        self._enqueue(("u", user_id), None, coalesce_key, frame)
+
+    async def publish_to_member(
+        self,
+        chat_id: int,
+        user_id: int,
+        frame: str,
+        coalesce_key: Optional[str] = None
+    ) -> None:
+        self._deliver_to_member(chat_id, user_id, frame, coalesce_key)
+        self._enqueue(("m", (chat_id, user_id)), None, coalesce_key, frame)
+
+    def _enqueue(
+        self,
+        target: Target,
+        exclude_user_id: ExcludedUsers,
+        coalesce_key: Optional[str],
+        frame: str
+    ) -> None:
+        event_id = f"{self.node_id}:{next(self._sequence)}"
+        self._pending[target].append([event_id, exclude_user_id, coalesce_key, frame])
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # События, поставленные во время отправки, уходят следующим кругом:
+        # пока задача не завершилась, _enqueue новую не запускает
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            pending, self._pending = self._pending, defaultdict(list)
+            for target, events in pending.items():
+                for payload in self._pack(target, events):
+                    try:
+                        await self.listener.notify(self.channel, payload)
+                    except Exception as e:
+                        logger.error(f"Failed to publish events of {target} to other processes: {str(e)}")
+
+    def _pack(self, target: Target, events: List[list]) -> List[str]:
+        """Упаковка событий одного адресата в payload-ы NOTIFY с учётом лимита размера"""
+        kind, target_id = target
+        payloads = []
+        batch: List[list] = []
+        batch_size = 0
+        for event in events:
+            size = len(orjson.dumps(event))
+            if batch and (size > NOTIFY_PAYLOAD_LIMIT or batch_size + size > NOTIFY_PAYLOAD_LIMIT):
+                # Порядок событий сохраняется: накопленная пачка уходит раньше следующего события
+                payloads.append(self._encode({"n": self.node_id, kind: target_id, "e": batch}))
+                batch, batch_size = [], 0
+            if size > NOTIFY_PAYLOAD_LIMIT:
+                payloads.extend(self._split(target, event))
+                continue
+            batch.append(event)
+            batch_size += size
+        if batch:
+            payloads.append(self._encode({"n": self.node_id, kind: target_id, "e": batch}))
+        return payloads
+
+    def _split(self, target: Target, event: list) -> List[str]:
+        """Разбиение слишком большого кадра на части"""
+        kind, target_id = target
+        event_id, exclude_user_id, coalesce_key, frame = event
+        # Запас на экранирование: в худшем случае символ кадра превращается в \\uXXXX
+        chunk_size = NOTIFY_PAYLOAD_LIMIT // 6
+        chunks = [frame[i:i + chunk_size] for i in range(0, len(frame), chunk_size)]
+        return [
+            self._encode({
+                "n": self.node_id,
+                kind: target_id,
+                "p": [event_id, exclude_user_id, coalesce_key, index, len(chunks), chunk]
+            })
+            for index, chunk in enumerate(chunks)
+        ]
+
+    @staticmethod
+    def _encode(payload: dict) -> str:
+        return orjson.dumps(payload).decode()
+
+    def _on_notification(self, payload: str) -> None:
+        data = orjson.loads(payload)
+        if data["n"] == self.node_id:
+            return  # Собственные события уже доставлены локально
+
+        if "m" in data:
+            target = ("m", tuple(data["m"]))
+        else:
+            target = ("u", data["u"]) if "u" in data else ("c", data["c"])
+        if "p" in data:
+            self._on_part(target, data["p"])
+            return
+        for event_id, exclude_user_id, coalesce_key, frame in data["e"]:
+            if self._mark_seen(event_id):
+                self._dispatch(target, frame, exclude_user_id, coalesce_key)
+
+    def _dispatch(
+        self,
+        target: Target,
+        frame: str,
+        exclude_user_id: ExcludedUsers,
+        coalesce_key: Optional[str]
+    ) -> None:
+        kind, target_id = target
+        if kind == "u":
+            self._deliver_to_user(target_id, frame, coalesce_key)
+        elif kind == "m":
+            self._deliver_to_member(*target_id, frame, coalesce_key)
+        else:
+            self._deliver(target_id, frame, exclude_user_id, coalesce_key)
+
+    def _on_part(self, target: Target, part: list) -> None:
+        event_id, exclude_user_id, coalesce_key, index, total, chunk = part
+        chunks = self._partials.get(event_id)
+        if chunks is None:
+            chunks = self._partials[event_id] = {}
+            if len(self._partials) > self._partials_size:
+                self._partials.popitem(last=False)
+        chunks[index] = chunk
+        if len(chunks) < total:
+            return
+        del self._partials[event_id]
+        if self._mark_seen(event_id):
+            frame = "".join(chunks[i] for i in range(total))
+            self._dispatch(target, frame, exclude_user_id, coalesce_key)
+
+    def _mark_seen(self, event_id: str) -> bool:
+        """Дедупликация событий внутри процесса"""
+        if event_id in self._seen:
+            return False
+        self._seen[event_id] = None
+        if len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+        return True
+
+
+def create_broadcast_bus(backend: str = settings.WS_BROADCAST_BACKEND) -> BroadcastBus:
+    """Создание шины по настройке WS_BROADCAST_BACKEND (memory | postgres)"""
+    match backend:
+        case "memory":
+            return InProcessBus()
+        case "postgres":
+            return PostgresBus(get_pg_listener())
+        case _:
+            raise ValueError(f"Unsupported broadcast backend: {backend}")
@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+
+from src.features.chats.membership_cache import membership_cache
+from src.features.chats.models import ChatType
+from src.features.users.schemas import UserInDB
+
+
+# Код закрытия соединения, если пользователь не состоит в чате
+FORBIDDEN_CLOSE_CODE = 4003
+
+
+@dataclass
+class ConnectionContext:
+    """
+    Проверенные при рукопожатии данные соединения чата.
+
+    Кадры обрабатываются по контексту без запросов к БД. Контекст помнит версию
+    состава чата, снятую до загрузки участников: когда уведомление об изменении
+    состава сбрасывает чат в кэше составов, версия меняется, контекст перестаёт
+    быть актуальным и перепроверяется. Вытеснение состава из кэша версию не меняет.
+    """
+    user: UserInDB
+    chat_id: int
+    chat_type: ChatType
+    member_ids: frozenset[int]
+    membership_version: tuple[int, int]
+
+    @property
+    def is_current(self) -> bool:
+        return membership_cache.chat_version(self.chat_id) == self.membership_version
@@ -1,71 +1,319 @@
-from dataclasses import dataclass
 from datetime import datetime
 from fastapi import WebSocket, WebSocketDisconnect
-from sqlalchemy.ext.asyncio import AsyncSession
 from src.core.logging import logger
-from src.features.messages.services import MessageService
+from src.core.exceptions import ForbiddenException, NotFoundException
+from src.core.query_budget import QueryBudget
 from src.features.users.schemas import UserInDB
 from .session_manager import WebSocketSessionManager
 from .message_handler import WebSocketMessageHandler
-from .schemas import MessageWS, ResponseWS
-import json
+from .context import ConnectionContext, FORBIDDEN_CLOSE_CODE
+from .schemas import MessageWS, ResponseWS, SubscribeWS, UnsubscribeWS, PongWS, BatchWS
 from pydantic import TypeAdapter
 
 from starlette.websockets import WebSocketState
 
-from .utils import DateTimeEncoder
+from .utils import encode_frame
+from .pipeline import FramePipeline
+from src.config import get_settings
+from typing import Any
+
+
+settings = get_settings()
+
+message_adapter = TypeAdapter(MessageWS)
+response_adapter = TypeAdapter(ResponseWS)
+
 
 class WebSocketController:
     """Контроллер для обработки WebSocket соединений"""
     def __init__(
         self,
         session_manager: WebSocketSessionManager,
-        message_handler: WebSocketMessageHandler,
-        message_service: MessageService
+        message_handler: WebSocketMessageHandler
     ):
         self.session_manager = session_manager
         self.message_handler = message_handler
-        self.message_service = message_service
 
     async def process_chat_connection(
         self,
         websocket: WebSocket,
         chat_id: int,
-        current_user: UserInDB
+        current_user: UserInDB,
+        last_message_id: int | None = None
     ):
-        """Обработка WebSocket соединения для чата"""
+        """
+        Обработка WebSocket соединения для чата
+
+        Членство проверяется до accept(): не участник получает отказ в рукопожатии.
+        Дальше кадры обрабатываются по контексту соединения, который
+        перепроверяется только после изменения состава чата.
+
+        Args:
+            last_message_id: Последнее сообщение, полученное клиентом до переподключения;
+                пропущенные события придут кадрами catch_up до живых событий
+        """
+        try:
+            context = await self.message_handler.load_connection_context(chat_id, current_user)
+        except (NotFoundException, ForbiddenException) as e:
+            logger.warning(f"Rejecting WebSocket of user {current_user.id} to chat {chat_id}: {e.message}")
+            await websocket.close(code=FORBIDDEN_CLOSE_CODE)
+            return
+
         disconnected = False
+        pipeline = FramePipeline(settings.WS_MAX_IN_FLIGHT_FRAMES)
         try:
             await self.session_manager.handle_connection(websocket, chat_id, current_user.id)
+            if last_message_id is not None:
+                self.session_manager.pause_connection(websocket)
+                await self._resume_with_catch_up(websocket, {chat_id: last_message_id}, current_user)
             
             while True:
                 try:
                     data = await websocket.receive_json()
-                    message = TypeAdapter(MessageWS).validate_python(data)
-                    
-                    response = await self.message_handler.process_message(
-                        message=message,
-                        chat_id=chat_id,
-                        current_user=current_user
-                    )
-                    logger.info(f"Sending direct response to sender {current_user.id}: {response}")
-                    
-                    response_json = json.dumps(response.model_dump(), cls=DateTimeEncoder)
-                    await websocket.send_text(response_json)
-                    logger.info(f"Response sent successfully to user {current_user.id}")
-                    
                 except WebSocketDisconnect as e:
                     logger.info(f"WebSocket disconnect event: {str(e)}")
                     disconnected = True
                     break
-                    
+                self.session_manager.touch(websocket)
+                if not context.is_current:
+                    context = await self._revalidate_context(websocket, context)
+                    if context is None:
+                        disconnected = True
+                        break
+                await self._submit_frame(pipeline, websocket, data, current_user, chat_id, context)
+
         except Exception as e:
             logger.error(f"WebSocket error: {str(e)}")
             disconnected = True
             raise
             
         finally:
+            # Кадры, принятые до отключения, дообрабатываются (сообщения не теряются)
+            await pipeline.barrier()
             # Вызываем handle_disconnection только если действительно произошло отключение
             if disconnected:
                 await self.session_manager.handle_disconnection(websocket, chat_id, current_user.id)
 
+    async def _revalidate_context(self, websocket: WebSocket, context: ConnectionContext) -> ConnectionContext | None:
+        """Перепроверка членства после изменения состава чата; исключённый пользователь отключается"""
+        try:
+            return await self.message_handler.load_connection_context(context.chat_id, context.user)
+        except (NotFoundException, ForbiddenException) as e:
+            logger.info(f"Closing WebSocket of user {context.user.id} in chat {context.chat_id}: {e.message}")
+            try:
+                await websocket.close(code=FORBIDDEN_CLOSE_CODE)
+            except Exception as close_error:
+                logger.debug(f"Error closing WebSocket: {str(close_error)}")
+            return None
+
+    async def process_user_connection(
+        self,
+        websocket: WebSocket,
+        current_user: UserInDB
+    ):
+        """
+        Обработка мультиплексированного WebSocket соединения пользователя.
+
+        Одно соединение обслуживает все чаты пользователя: клиент подписывается
+        и отписывается управляющими кадрами, а кадры с данными адресуются чату
+        через поле chat_id.
+        """
+        pipeline = FramePipeline(settings.WS_MAX_IN_FLIGHT_FRAMES)
+        try:
+            await self.session_manager.handle_user_connection(websocket, current_user.id)
+
+            while True:
+                try:
+                    data = await websocket.receive_json()
+                except WebSocketDisconnect as e:
+                    logger.info(f"WebSocket disconnect event: {str(e)}")
+                    break
+                self.session_manager.touch(websocket)
+                await self._submit_frame(pipeline, websocket, data, current_user)
+
+        finally:
+            await pipeline.barrier()
+            await self.session_manager.handle_user_disconnection(websocket, current_user.id)
+
+    async def _submit_frame(
+        self,
+        pipeline: FramePipeline,
+        websocket: WebSocket,
+        data: Any,
+        current_user: UserInDB,
+        chat_id: int | None = None,
+        context: ConnectionContext | None = None
+    ) -> None:
+        """
+        Передача кадра в конвейер соединения
+
+        Новые сообщения одного чата обрабатываются по порядку, остальные кадры
+        (например, статусы прочтения) - параллельно. Ответы сопоставляются
+        с кадрами клиента по request_id.
+        """
+        try:
+            message = message_adapter.validate_python(data)
+        except Exception as e:
+            request_id = data.get("request_id") if isinstance(data, dict) else None
+            self._send_error(websocket, e, request_id if isinstance(request_id, str) else None)
+            return
+
+        if isinstance(message, PongWS):
+            return
+
+        if isinstance(message, (SubscribeWS, UnsubscribeWS)):
+            # Управляющие кадры меняют маршрутизацию, поэтому выполняются после всех уже принятых кадров
+            await pipeline.barrier()
+            await self._run_frame(websocket, message, current_user, chat_id, context)
+            return
+
+        if isinstance(message, BatchWS):
+            if any(op.message_type == "new_message" for op in message.operations):
+                # Пакет с новыми сообщениями может затрагивать несколько чатов:
+                # порядок сохраняется выполнением после всех принятых кадров
+                await pipeline.barrier()
+                await self._run_frame(websocket, message, current_user, chat_id, context)
+            else:
+                await pipeline.submit(lambda: self._run_frame(websocket, message, current_user, chat_id, context))
+            return
+
+        lane = ("new_message", chat_id or message.chat_id) if message.message_type == "new_message" else None
+        await pipeline.submit(lambda: self._run_frame(websocket, message, current_user, chat_id, context), lane)
+
+    async def _run_frame(
+        self,
+        websocket: WebSocket,
+        message: MessageWS,
+        current_user: UserInDB,
+        chat_id: int | None,
+        context: ConnectionContext | None = None
+    ) -> None:
+        """Обработка одного кадра и постановка ответа в очередь соединения"""
+        with QueryBudget(f"WS {message.message_type} from user {current_user.id}"):
+            await self._process_frame(websocket, message, current_user, chat_id, context)
+
+    async def _process_frame(
+        self,
+        websocket: WebSocket,
+        message: MessageWS,
+        current_user: UserInDB,
+        chat_id: int | None,
+        context: ConnectionContext | None
+    ) -> None:
+        try:
+            if chat_id is None:
+                response = await self._process_user_frame(websocket, message, current_user)
+                if response is None:
+                    return  # Ответ уже поставлен в очередь вместе с кадрами catch_up
+            elif isinstance(message, (SubscribeWS, UnsubscribeWS)):
+                raise ValueError("Subscriptions are supported only on the user connection")
+            elif isinstance(message, BatchWS):
+                response = await self.message_handler.process_batch(message, current_user, chat_id)
+            else:
+                response = await self.message_handler.process_message(
+                    message=message,
+                    chat_id=chat_id,
+                    current_user=current_user,
+                    context=context
+                )
+        except Exception as e:
+            # Ошибка в одном кадре не должна рвать соединение
+            logger.warning(f"Error processing frame from user {current_user.id}: {str(e)}")
+            self._send_error(websocket, e, message.request_id)
+            return
+
+        response.request_id = message.request_id
+        logger.debug(f"Sending {response.response_type} response to sender {current_user.id}")
+        # Ответ идёт через ту же очередь, что и рассылки, чтобы сохранить порядок кадров
+        self.session_manager.send_to_connection(websocket, encode_frame(response.model_dump()))
+
+    def _send_error(self, websocket: WebSocket, error: Exception, request_id: str | None) -> None:
+        """Отправка ответа об ошибке обработки кадра"""
+        response = response_adapter.validate_python({
+            "response_type": "error",
+            "detail": getattr(error, "message", None) or str(error),
+            "request_id": request_id,
+            "timestamp": datetime.utcnow()
+        })
+        self.session_manager.send_to_connection(websocket, encode_frame(response.model_dump()))
+
+    async def _process_user_frame(
+        self,
+        websocket: WebSocket,
+        message: MessageWS,
+        current_user: UserInDB
+    ) -> ResponseWS | None:
+        """Маршрутизация кадра мультиплексированного соединения"""
+        if isinstance(message, SubscribeWS):
+            requested = list(dict.fromkeys(message.chat_ids))
+            allowed = await self.message_handler.get_member_chat_ids(requested, current_user)
+            cursors = {
+                chat_id: last_message_id for chat_id, last_message_id in message.cursors.items()
+                if chat_id in allowed
+            }
+            if cursors:
+                # События, пришедшие во время догонки, будут отправлены после неё
+                self.session_manager.pause_connection(websocket)
+            chat_ids = await self.session_manager.subscribe(
+                websocket, current_user.id, [chat_id for chat_id in requested if chat_id in allowed]
+            )
+            response = response_adapter.validate_python({
+                "response_type": "subscribe",
+                "chat_ids": chat_ids,
+                "rejected": [chat_id for chat_id in requested if chat_id not in allowed],
+                "timestamp": datetime.utcnow()
+            })
+            if not cursors:
+                return response
+            response.request_id = message.request_id
+            await self._resume_with_catch_up(websocket, cursors, current_user, response)
+            return None
+
+        if isinstance(message, UnsubscribeWS):
+            chat_ids = await self.session_manager.unsubscribe(websocket, current_user.id, message.chat_ids)
+            return response_adapter.validate_python({
+                "response_type": "unsubscribe",
+                "chat_ids": chat_ids,
+                "timestamp": datetime.utcnow()
+            })
+
+        if isinstance(message, BatchWS):
+            subscriptions = self.session_manager.get_subscriptions(websocket)
+            not_subscribed = sorted({op.chat_id for op in message.operations} - subscriptions)
+            if not_subscribed:
+                raise ForbiddenException(f"Not subscribed to chats {not_subscribed}")
+            return await self.message_handler.process_batch(message, current_user)
+
+        if message.chat_id not in self.session_manager.get_subscriptions(websocket):
+            raise ForbiddenException(f"Not subscribed to chat {message.chat_id}")
+
+        return await self.message_handler.process_message(
+            message=message,
+            chat_id=message.chat_id,
+            current_user=current_user
+        )
+
+    async def _resume_with_catch_up(
+        self,
+        websocket: WebSocket,
+        cursors: dict[int, int],
+        current_user: UserInDB,
+        response: ResponseWS | None = None
+    ) -> None:
+        """
+        Отправка пропущенных событий на приостановленное соединение и возврат к живой доставке.
+        Порядок: ответ на кадр клиента, кадры catch_up, затем накопленные за паузу события.
+        """
+        frames = [encode_frame(response.model_dump())] if response is not None else []
+        try:
+            frames.extend(await self.message_handler.build_catch_up_frames(cursors, current_user))
+        except Exception as e:
+            logger.warning(f"Catch-up failed for user {current_user.id}: {str(e)}")
+            frames.append(encode_frame(response_adapter.validate_python({
+                "response_type": "error",
+                "detail": f"Catch-up failed: {getattr(e, 'message', None) or str(e)}",
+                "timestamp": datetime.utcnow()
+            }).model_dump()))
+        finally:
+            self.session_manager.resume_connection(websocket, frames)
+
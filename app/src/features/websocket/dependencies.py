@@ -1,7 +1,8 @@
 from fastapi import Depends, WebSocket
-from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
-from src.core.db import get_db
+from src.core.db import session_scope
+from src.core.pg_listener import get_pg_listener
+from src.features.chats.services import ChatService
 from src.core.security import get_token_from_websocket, SECRET_KEY, ALGORITHM
 from src.features.auth.services import AuthService
 from src.features.users.services import UserService
@@ -9,41 +10,61 @@ from src.features.users.schemas import UserInDB
 from src.core.exceptions import InvalidTokenException, WebSocketAuthException, NotFoundException
 from .controller import WebSocketController
 from .session_manager import WebSocketSessionManager
+from .bus import create_broadcast_bus
+from .presence import PresenceTracker
+from src.config import get_settings
 from src.core.logging import logger
-from src.features.messages.services import MessageService
 from src.features.auth.dependencies import get_current_user
 from .message_handler import WebSocketMessageHandler
-from src.features.messages.dependencies import get_message_service
+
+settings = get_settings()
+
+
+async def load_chat_member_ids(chat_id: int) -> frozenset[int]:
+    """Актуальный состав чата (кэш составов уже сброшен уведомлением)"""
+    async with session_scope() as db:
+        return (await ChatService(db).get_member_ids([chat_id]))[chat_id]
+
 
 # Создаем глобальный экземпляр WebSocketSessionManager
-websocket_manager = WebSocketSessionManager()
-
-async def get_websocket_controller(
-    message_service: MessageService = Depends(get_message_service)
-) -> WebSocketController:
-    """Получение экземпляра WebSocketController"""
-    logger.info("Initializing WebSocketController")
-    message_handler = WebSocketMessageHandler(message_service, websocket_manager)
+broadcast_bus = create_broadcast_bus()
+websocket_manager = WebSocketSessionManager(
+    bus=broadcast_bus,
+    presence=PresenceTracker(
+        ping_interval=settings.WS_PING_INTERVAL_SECONDS,
+        idle_timeout=settings.WS_IDLE_TIMEOUT_SECONDS,
+        flush_interval=settings.WS_PRESENCE_FLUSH_SECONDS,
+        online_ttl=settings.WS_PRESENCE_TTL_SECONDS,
+        session_factory=session_scope,
+        # С межпроцессной шиной у пользователя могут быть соединения и на других инстансах
+        single_instance=broadcast_bus.local_only
+    ),
+    membership_listener=get_pg_listener(),
+    membership_loader=load_chat_member_ids
+)
+
+def get_websocket_controller() -> WebSocketController:
+    """
+    Получение экземпляра WebSocketController.
+
+    Контроллер не держит сессию БД: каждый кадр берёт соединение из пула
+    только на время своей обработки.
+    """
+    message_handler = WebSocketMessageHandler(websocket_manager, session_scope)
     return WebSocketController(
         session_manager=websocket_manager,
-        message_handler=message_handler,
-        message_service=message_service
+        message_handler=message_handler
     )
 
-async def get_current_user_ws(
-    websocket: WebSocket,
-    db = Depends(get_db)
-) -> UserInDB:
-    """Получение текущего пользователя из WebSocket соединения"""
+async def get_current_user_ws(websocket: WebSocket) -> UserInDB:
+    """
+    Получение текущего пользователя из WebSocket соединения.
+    Сессия БД открывается только на время проверки токена при рукопожатии.
+    """
     if "Authorization" in websocket.headers:
         token = websocket.headers["Authorization"].split(" ")[1]
-        return await get_current_user(token, db)
+        async with session_scope() as db:
+            user = await get_current_user(token, db)
+            return UserInDB.model_validate(user)
     await websocket.close(code=4000)  # Unauthorized
     return None
-
-async def get_message_service(db: AsyncSession = Depends(get_db)) -> MessageService:
-    """Получение экземпляра MessageService"""
-    logger.info("Initializing MessageService")
-    return MessageService(db) 
-
-
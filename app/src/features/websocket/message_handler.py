@@ -1,49 +1,241 @@
 from datetime import datetime
-from typing import Union
+from typing import AsyncContextManager, Callable, Iterable, Union
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import TypeAdapter
 from src.core.logging import logger
 from src.features.messages.services import MessageService
 from src.features.users.schemas import UserInDB
+from src.features.chats.membership_cache import membership_cache
 from src.features.messages.schemas import MessageCreate
-from .schemas import MessageWS, ResponseWS
+from .schemas import MessageWS, ResponseWS, BatchWS
 from src.core.exceptions import NotFoundException, ForbiddenException
 from .session_manager import WebSocketSessionManager
-from .utils import DateTimeEncoder
-import json
+from .context import ConnectionContext
+from .utils import encode_frame
+from src.config import get_settings
+
+
+settings = get_settings()
 
 class WebSocketMessageHandler:
-    def __init__(self, message_service: MessageService, session_manager: WebSocketSessionManager):
-        self.message_service = message_service
+    def __init__(
+        self,
+        session_manager: WebSocketSessionManager,
+        session_factory: Callable[[], AsyncContextManager[AsyncSession]]
+    ):
         self.session_manager = session_manager
-        
+        # Сессия БД берётся на время обработки одного кадра, а не на всё соединение
+        self.session_factory = session_factory
+
+    async def get_member_chat_ids(self, chat_ids: Iterable[int], current_user: UserInDB) -> set[int]:
+        """Чаты из списка, в которых состоит пользователь"""
+        async with self.session_factory() as db:
+            return await MessageService(db).chat_service.get_member_chat_ids(list(chat_ids), current_user)
+
+    async def load_connection_context(self, chat_id: int, current_user: UserInDB) -> ConnectionContext:
+        """
+        Проверка членства и загрузка данных чата для контекста соединения
+
+        Raises:
+            NotFoundException: Чат не найден
+            ForbiddenException: Пользователь не состоит в чате
+        """
+        # Версия снимается до запроса: сброс во время загрузки сделает контекст неактуальным
+        membership_version = membership_cache.chat_version(chat_id)
+        async with self.session_factory() as db:
+            chat_service = MessageService(db).chat_service
+            member_ids = await chat_service.require_member(chat_id, current_user)
+            chat = await chat_service.repository.get_by_id(chat_id)
+            if not chat:
+                raise NotFoundException(f"Chat {chat_id} not found")
+        return ConnectionContext(
+            user=current_user,
+            chat_id=chat_id,
+            chat_type=chat.chat_type,
+            member_ids=member_ids,
+            membership_version=membership_version
+        )
+
+    async def build_catch_up_frames(self, cursors: dict[int, int], current_user: UserInDB) -> list[str]:
+        """
+        Кадры catch_up с событиями, пропущенными клиентом до переподключения
+
+        Args:
+            cursors: chat_id -> id последнего сообщения, которое есть у клиента
+            current_user: Текущий пользователь
+
+        Returns:
+            list[str]: Кадры по WS_CATCH_UP_BATCH сообщений; последний кадр чата помечен final,
+                а truncated означает, что остаток нужно догрузить через историю
+        """
+        frames = []
+        async with self.session_factory() as db:
+            message_service = MessageService(db)
+            for chat_id, last_message_id in cursors.items():
+                messages, truncated = await message_service.get_missed_messages(
+                    chat_id, last_message_id, current_user, settings.WS_CATCH_UP_LIMIT
+                )
+                batch_size = settings.WS_CATCH_UP_BATCH
+                batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)] or [[]]
+                for index, batch in enumerate(batches):
+                    final = index == len(batches) - 1
+                    frames.append(encode_frame({
+                        "message_type": "catch_up",
+                        "chat_id": chat_id,
+                        "messages": batch,
+                        "final": final,
+                        "truncated": truncated and final,
+                        "timestamp": datetime.utcnow()
+                    }))
+                logger.info(f"Catch-up for user {current_user.id} in chat {chat_id}: {len(messages)} messages")
+        return frames
+
     async def process_message(
         self,
         message: MessageWS,
         chat_id: int,
-        current_user: UserInDB
+        current_user: UserInDB,
+        context: ConnectionContext | None = None
     ) -> ResponseWS:
-        """Обработка входящего сообщения"""
+        """
+        Обработка входящего сообщения
+
+        Args:
+            context: Контекст соединения чата; членство в нём уже проверено
+        """
         logger.info(f"Processing message: {message}")
-        
+
+        if message.message_type == 'user_status':
+            logger.info(f"Processing user_status message: {message}")
+            if context is not None:
+                return self._user_status_response(message, chat_id, current_user)
+
         try:
-            match message.message_type:
-                case 'new_message':
-                    return await self._handle_new_message(message, chat_id, current_user)
-                case 'read_status':
-                    logger.info(f"Processing read_status message: {message}")
-                    return await self._handle_read_status(message, chat_id, current_user)
-                case 'user_status':
-                    logger.info(f"Processing user_status message: {message}")
-                    return await self._handle_user_status(message, chat_id, current_user)
-                case _:
-                    raise ValueError(f"Unsupported message type: {message.message_type}")
+            async with self.session_factory() as db:
+                message_service = MessageService(db)
+                match message.message_type:
+                    case 'new_message':
+                        response = await self._handle_new_message(message_service, message, chat_id, current_user)
+                    case 'read_status':
+                        logger.info(f"Processing read_status message: {message}")
+                        response = await self._handle_read_status(message_service, message, chat_id, current_user)
+                    case 'user_status':
+                        response = await self._handle_user_status(message_service, message, chat_id, current_user)
+                    case _:
+                        raise ValueError(f"Unsupported message type: {message.message_type}")
+            await self.session_manager.send_unread_counts(message_service.unread_changes)
+            return response
                 
         except Exception as e:
             logger.error(f"Error processing message: {str(e)}")
             raise
 
+    async def process_batch(
+        self,
+        batch: BatchWS,
+        current_user: UserInDB,
+        chat_id: int | None = None
+    ) -> ResponseWS:
+        """
+        Обработка пакета операций в одной транзакции
+
+        Args:
+            batch: Пакетный кадр
+            current_user: Текущий пользователь
+            chat_id: Чат соединения; если задан, все операции должны относиться к нему
+
+        Returns:
+            BatchResponse: Результаты операций в порядке пакета
+        """
+        if chat_id is not None:
+            foreign = sorted({op.chat_id for op in batch.operations if op.chat_id != chat_id})
+            if foreign:
+                raise ForbiddenException(f"Batch operations for chats {foreign} on connection to chat {chat_id}")
+
+        new_messages = [op for op in batch.operations if op.message_type == 'new_message']
+        read_message_ids = list(dict.fromkeys(
+            op.message_id for op in batch.operations if op.message_type == 'read_status'
+        ))
+        logger.info(
+            f"Processing batch from user {current_user.id}: "
+            f"{len(new_messages)} messages, {len(read_message_ids)} read receipts"
+        )
+
+        async with self.session_factory() as db:
+            message_service = MessageService(db)
+            created, read = await message_service.apply_batch(
+                [
+                    MessageCreate(text=op.text, chat_id=op.chat_id, idempotency_key=op.idempotency_key)
+                    for op in new_messages
+                ],
+                read_message_ids,
+                current_user
+            )
+
+        # Рассылка только после commit: получатели не увидят событий отменённого пакета
+        # Повторы по idempotency_key внутри пакета рассылаются один раз
+        for db_message in {db_message.id: db_message for db_message in created}.values():
+            await self.session_manager.broadcast_message(
+                chat_id=db_message.chat_id,
+                message={
+                    "message_type": "new_message",
+                    "message_id": db_message.id,
+                    "chat_id": db_message.chat_id,
+                    "sender_id": current_user.id,
+                    "text": db_message.text,
+                    "timestamp": db_message.created_at
+                },
+                current_user_id=current_user.id
+            )
+        for message_id in read_message_ids:
+            await self.session_manager.broadcast_message(
+                chat_id=read[message_id]["chat_id"],
+                message={
+                    "message_type": "read_status",
+                    "message_id": message_id,
+                    "chat_id": read[message_id]["chat_id"],
+                    "sender_id": current_user.id,
+                    "text": read[message_id]["text"],
+                    "timestamp": read[message_id]["created_at"]
+                },
+                current_user_id=current_user.id
+            )
+
+        await self.session_manager.send_unread_counts(message_service.unread_changes)
+
+        now = datetime.utcnow()
+        created_iter = iter(created)
+        results = []
+        for op in batch.operations:
+            if op.message_type == 'new_message':
+                db_message = next(created_iter)
+                results.append({
+                    "response_type": "new_message",
+                    "message_id": db_message.id,
+                    "chat_id": db_message.chat_id,
+                    "sender_id": current_user.id,
+                    "text": db_message.text,
+                    "timestamp": db_message.created_at
+                })
+            else:
+                results.append({
+                    "response_type": "read_status",
+                    "message_id": op.message_id,
+                    "chat_id": read[op.message_id]["chat_id"],
+                    "reader_id": current_user.id,
+                    "read_by": read[op.message_id]["read_by"],
+                    "read_count": read[op.message_id]["read_count"],
+                    "timestamp": now
+                })
+        return TypeAdapter(ResponseWS).validate_python({
+            "response_type": "batch",
+            "results": results,
+            "timestamp": now
+        })
+
     async def _handle_new_message(
         self,
+        message_service: MessageService,
         message: MessageWS,
         chat_id: int,
         current_user: UserInDB
@@ -56,7 +248,7 @@ class WebSocketMessageHandler:
                 idempotency_key=message.idempotency_key
             )
             
-            db_message = await self.message_service.create_message(
+            db_message = await message_service.create_message(
                 message_data=message_create,
                 current_user=current_user
             )
@@ -89,12 +281,8 @@ class WebSocketMessageHandler:
                 "timestamp": db_message.created_at
             }
 
-            response_json = json.loads(
-                json.dumps(response_data, cls=DateTimeEncoder)
-            )
-
-            logger.info(f"Return response: {response_json}")
-            return TypeAdapter(ResponseWS).validate_python(response_json)
+            logger.info(f"Return response: {response_data}")
+            return TypeAdapter(ResponseWS).validate_python(response_data)
             
         except Exception as e:
             logger.error(f"Error handling new message: {str(e)}")
@@ -102,34 +290,22 @@ class WebSocketMessageHandler:
 
     async def _handle_read_status(
         self,
+        message_service: MessageService,
         message: MessageWS,
         chat_id: int,
         current_user: UserInDB
     ) -> ResponseWS:
         """Обработка статуса прочтения"""
-        # Получаем сообщение из БД по id
-        
-        
-        db_message = await self.message_service.get_message(message.message_id, current_user)
-        if not db_message:
-            logger.error(f"Message {message.message_id} not found")
-            raise ValueError(f"Message {message.message_id} not found")
-        # Обновляем статус прочтения используя id из БД
-        await self.message_service.mark_as_read(message.message_id, current_user.id)
-        logger.info(f"УСПЕХ")
-
-        # Получаем список пользователей, прочитавших сообщение
-        read_by = await self.message_service.get_message_readers(db_message.id)
-        logger.info(f"Список пользователей, прочитавших сообщение: {read_by}")
-
+        # Проверка членства, отметка и выборка прочитавших - один запрос
+        receipt = await message_service.read_message(message.message_id, current_user, chat_id)
 
         notification_data = {
             "message_type": "read_status",
-            "message_id": db_message.id,
+            "message_id": receipt["message_id"],
             "chat_id": chat_id,
             "sender_id": current_user.id,
-            "text": db_message.text,
-            "timestamp": db_message.created_at
+            "text": receipt["text"],
+            "timestamp": receipt["created_at"]
         }
 
         logger.info(f"Отправляем уведомление о статусе прочтения: {notification_data}")
@@ -139,14 +315,13 @@ class WebSocketMessageHandler:
             current_user_id=current_user.id
         )
 
-
-
         response_data = {
             "response_type": "read_status",
             "message_id": message.message_id,
             "chat_id": chat_id,
             "reader_id": current_user.id,
-            "read_by": read_by,
+            "read_by": receipt["read_by"],
+            "read_count": receipt["read_count"],
             "timestamp": datetime.utcnow()
         }
         return TypeAdapter(ResponseWS).validate_python(response_data)
@@ -157,6 +332,7 @@ class WebSocketMessageHandler:
 
     async def _handle_user_status(
         self,
+        message_service: MessageService,
         message: MessageWS,
         chat_id: int,
         current_user: UserInDB
@@ -165,6 +341,7 @@ class WebSocketMessageHandler:
         Обработка статуса пользователя
         
         Args:
+            message_service: Сервис сообщений в сессии текущего кадра
             message: Входящее сообщение о статусе
             chat_id: ID чата
             current_user: Текущий пользователь
@@ -173,22 +350,19 @@ class WebSocketMessageHandler:
             UserStatusResponse: Ответ со статусом пользователя
         """
         try:
-            chat = await self.message_service.chat_service.get_chat(chat_id, current_user)
-            if not chat:
-                raise NotFoundException(f"Chat {chat_id} not found")
-                
-            if current_user.id not in [m.id for m in chat.members]:
-                raise ForbiddenException("Not a chat member")
-
-            response_data = {
-                "response_type": "user_status",
-                "user_id": current_user.id,
-                "status": message.status,
-                "timestamp": datetime.utcnow(),
-                "chat_id": chat_id
-            }
-            return TypeAdapter(ResponseWS).validate_python(response_data)
-            
+            await message_service.chat_service.require_member(chat_id, current_user)
+            return self._user_status_response(message, chat_id, current_user)
         except Exception as e:
             logger.error(f"Error handling user status: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
+
+    @staticmethod
+    def _user_status_response(message: MessageWS, chat_id: int, current_user: UserInDB) -> ResponseWS:
+        response_data = {
+            "response_type": "user_status",
+            "user_id": current_user.id,
+            "status": message.status,
+            "timestamp": datetime.utcnow(),
+            "chat_id": chat_id
+        }
+        return TypeAdapter(ResponseWS).validate_python(response_data)
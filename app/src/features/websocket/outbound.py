@@ -0,0 +1,192 @@
+import asyncio
+import time
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, Iterable, Optional
+
+from fastapi import WebSocket
+
+from src.core.logging import logger
+
+
+# Код закрытия для клиента, который не успевает вычитывать кадры
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class SlowConsumerPolicy(str, Enum):
+    """Что делать, когда клиент не успевает вычитывать исходящие кадры"""
+    DROP_OLDEST = "drop_oldest"  # Выбрасываем самый старый кадр
+    COALESCE = "coalesce"  # Схлопываем кадры с одинаковым ключом, иначе как drop_oldest
+    DISCONNECT = "disconnect"  # Закрываем соединение при слишком большом отставании
+
+
+class _Frame:
+    """Кадр в исходящей очереди"""
+    __slots__ = ("frame", "key", "enqueued_at")
+
+    def __init__(self, frame: str, key: Optional[str]):
+        self.frame = frame
+        self.key = key
+        self.enqueued_at = time.monotonic()
+
+
+class ConnectionSender:
+    """
+    Исходящая очередь и writer-задача одного WebSocket соединения.
+
+    Рассылка только кладёт готовый кадр в очередь и сразу возвращается,
+    а отправкой в сокет занимается отдельная задача. Медленный клиент
+    не задерживает ни других получателей, ни отправителя.
+    """
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_size: int,
+        policy: SlowConsumerPolicy,
+        max_backlog_ms: int
+    ):
+        self.websocket = websocket
+        self.max_size = max_size
+        self.policy = policy
+        self.max_backlog = max_backlog_ms / 1000
+
+        self._queue: Deque[_Frame] = deque()
+        self._pending_by_key: Dict[str, _Frame] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        # На паузе кадры копятся в очереди, но не отправляются
+        self.paused = False
+
+        # Счётчики для мониторинга
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.slow_disconnect = False
+
+    @property
+    def depth(self) -> int:
+        """Текущая глубина очереди"""
+        return len(self._queue)
+
+    def start(self) -> None:
+        """Запуск writer-задачи"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self) -> None:
+        """Остановка writer-задачи, неотправленные кадры отбрасываются"""
+        self.closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._queue.clear()
+        self._pending_by_key.clear()
+
+    def pause(self) -> None:
+        """Приостановка отправки (например, на время догонки пропущенных событий)"""
+        self.paused = True
+
+    def resume(self, frames: Iterable[str] = ()) -> None:
+        """
+        Возобновление отправки
+
+        Args:
+            frames: Кадры, которые уйдут раньше всего, что накопилось за время паузы
+        """
+        for frame in reversed(list(frames)):
+            self._queue.appendleft(_Frame(frame, None))
+        self.paused = False
+        self._wakeup.set()
+
+    def enqueue(self, frame: str, key: Optional[str] = None) -> bool:
+        """
+        Постановка кадра в очередь без ожидания отправки
+
+        Args:
+            frame: Сериализованный кадр
+            key: Ключ схлопывания (например, статус конкретного пользователя)
+
+        Returns:
+            bool: False, если кадр не принят (соединение закрыто)
+        """
+        if self.closed:
+            return False
+
+        if self.policy == SlowConsumerPolicy.COALESCE and key is not None:
+            pending = self._pending_by_key.get(key)
+            if pending is not None:
+                # Более свежее состояние заменяет устаревшее на его месте в очереди
+                pending.frame = frame
+                self.coalesced += 1
+                return True
+
+        if self.policy == SlowConsumerPolicy.DISCONNECT and self._is_lagging():
+            self._disconnect_slow_consumer()
+            return False
+
+        if len(self._queue) >= self.max_size:
+            dropped = self._queue.popleft()
+            if dropped.key is not None and self._pending_by_key.get(dropped.key) is dropped:
+                del self._pending_by_key[dropped.key]
+            self.dropped += 1
+
+        entry = _Frame(frame, key)
+        self._queue.append(entry)
+        if key is not None:
+            self._pending_by_key[key] = entry
+        self._wakeup.set()
+        return True
+
+    def _is_lagging(self) -> bool:
+        """Очередь переполнена или самый старый кадр ждёт дольше допустимого"""
+        if len(self._queue) >= self.max_size:
+            return True
+        return bool(self._queue) and time.monotonic() - self._queue[0].enqueued_at > self.max_backlog
+
+    def _disconnect_slow_consumer(self) -> None:
+        """Закрытие соединения медленного клиента"""
+        logger.warning(
+            f"Closing slow WebSocket consumer: {len(self._queue)} frames queued, "
+            f"oldest {time.monotonic() - self._queue[0].enqueued_at:.2f}s"
+        )
+        self.slow_disconnect = True
+        self.closed = True
+        if self._task is not None:
+            # Writer может висеть в send_text, поэтому закрываем соединение отдельной задачей
+            self._task.cancel()
+        self._queue.clear()
+        self._pending_by_key.clear()
+        asyncio.create_task(self._close_websocket(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _close_websocket(self, code: int) -> None:
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), timeout=1)
+        except Exception as e:
+            logger.debug(f"Error closing slow WebSocket consumer: {str(e)}")
+
+    async def _writer(self) -> None:
+        """Последовательная отправка кадров из очереди в сокет"""
+        try:
+            while True:
+                while not self._queue or self.paused:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+
+                entry = self._queue.popleft()
+                if entry.key is not None and self._pending_by_key.get(entry.key) is entry:
+                    del self._pending_by_key[entry.key]
+
+                await self.websocket.send_text(entry.frame)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Сокет уже закрыт - снятие регистрации выполнит основной обработчик соединения
+            logger.info(f"WebSocket writer stopped: {str(e)}")
+            self.closed = True
+            self._queue.clear()
+            self._pending_by_key.clear()
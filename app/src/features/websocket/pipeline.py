@@ -0,0 +1,61 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set
+
+from src.core.logging import logger
+
+
+class FramePipeline:
+    """
+    Конвейер обработки входящих кадров одного соединения.
+
+    Одновременно обрабатывается не больше max_in_flight кадров; когда лимит
+    исчерпан, submit ждёт, и чтение следующих кадров из сокета
+    приостанавливается. Кадры с одинаковой полосой (lane) выполняются строго
+    в порядке поступления, остальные - параллельно.
+    """
+    def __init__(self, max_in_flight: int):
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+        # Последняя задача каждой полосы: следующая задача полосы ждёт её завершения
+        self._lanes: Dict[Hashable, asyncio.Task] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def submit(self, job: Callable[[], Awaitable[None]], lane: Optional[Hashable] = None) -> None:
+        """
+        Запуск обработки кадра
+
+        Args:
+            job: Обработка кадра вместе с отправкой ответа
+            lane: Полоса упорядочивания (например, чат для новых сообщений)
+        """
+        await self._slots.acquire()
+        previous = self._lanes.get(lane) if lane is not None else None
+        task = asyncio.create_task(self._run(job, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if lane is not None:
+            self._lanes[lane] = task
+            task.add_done_callback(lambda done, lane=lane: self._release_lane(lane, done))
+
+    async def barrier(self) -> None:
+        """Ожидание завершения всех уже запущенных кадров"""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def _run(self, job: Callable[[], Awaitable[None]], previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                # Результат предыдущего кадра полосы не важен, важен только порядок
+                await asyncio.wait([previous])
+            await job()
+        except Exception as e:
+            logger.error(f"Unhandled error in frame pipeline: {str(e)}")
+        finally:
+            self._slots.release()
+
+    def _release_lane(self, lane: Hashable, task: asyncio.Task) -> None:
+        if self._lanes.get(lane) is task:
+            del self._lanes[lane]
@@ -0,0 +1,238 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncContextManager, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import WebSocket
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.core.logging import logger
+from src.features.users.repositories import PresenceRepository
+
+
+# Код закрытия соединения, от которого долго не было ни одного кадра
+IDLE_CLOSE_CODE = 4009
+
+
+class PresenceTracker:
+    """
+    Учёт активности соединений и присутствия пользователей.
+
+    Любой входящий кадр (в том числе pong) обновляет время активности сокета.
+    Сокеты, молчащие дольше ping_interval, получают ping, а молчащие дольше
+    idle_timeout считаются мёртвыми (например, полуоткрытое TCP соединение).
+    Время последней активности пользователей пишется в user_presence
+    пакетами раз в flush_interval, чтобы присутствие было видно всем инстансам.
+
+    Если инстансов несколько (single_instance=False), закрытие последнего локального
+    сокета не сокращает online_until: у пользователя могут оставаться соединения
+    на других инстансах, и онлайн истекает сам через online_ttl после последнего продления.
+    """
+    def __init__(
+        self,
+        ping_interval: float,
+        idle_timeout: float,
+        flush_interval: float,
+        online_ttl: float,
+        session_factory: Optional[Callable[[], AsyncContextManager[AsyncSession]]] = None,
+        single_instance: bool = True
+    ):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.flush_interval = flush_interval
+        self.online_ttl = online_ttl
+        # Без фабрики сессий присутствие учитывается только в памяти процесса
+        self.session_factory = session_factory
+        # Единственный инстанс знает обо всех соединениях: его "офлайн" окончательный
+        self.single_instance = single_instance
+
+        # сокет -> время последнего входящего кадра (time.monotonic)
+        self.last_activity: Dict[WebSocket, float] = {}
+        # сокет -> пользователь
+        self.socket_users: Dict[WebSocket, int] = {}
+
+        # Накопленные записи для user_presence: user_id -> (last_seen_at, online_until)
+        self._dirty: Dict[int, tuple[datetime, datetime]] = {}
+        # Когда онлайн пользователя последний раз продлевался в БД (time.monotonic)
+        self._refreshed_at: Dict[int, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def add(self, websocket: WebSocket, user_id: int) -> None:
+        """Начало учёта соединения"""
+        self.socket_users[websocket] = user_id
+        self.touch(websocket)
+
+    def remove(self, websocket: WebSocket, last_socket: bool) -> None:
+        """
+        Окончание учёта соединения
+
+        Args:
+            websocket: Закрываемое соединение
+            last_socket: У пользователя не осталось соединений на этом инстансе
+        """
+        self.last_activity.pop(websocket, None)
+        user_id = self.socket_users.pop(websocket, None)
+        if user_id is not None and last_socket:
+            now = datetime.now(timezone.utc)
+            self._dirty[user_id] = (now, now)
+            self._refreshed_at.pop(user_id, None)
+
+    def touch(self, websocket: WebSocket) -> None:
+        """Отметка активности соединения (вызывается на каждый входящий кадр)"""
+        now = time.monotonic()
+        self.last_activity[websocket] = now
+
+        user_id = self.socket_users.get(websocket)
+        if user_id is None:
+            return
+        # Онлайн в БД продлевается не чаще раза в треть TTL, а не на каждый кадр
+        if now - self._refreshed_at.get(user_id, float("-inf")) >= self.online_ttl / 3:
+            self._refreshed_at[user_id] = now
+            seen = datetime.now(timezone.utc)
+            self._dirty[user_id] = (seen, seen + timedelta(seconds=self.online_ttl))
+
+    def sockets_to_ping(self) -> List[WebSocket]:
+        """Соединения без входящих кадров дольше ping_interval"""
+        deadline = time.monotonic() - self.ping_interval
+        return [ws for ws, seen in self.last_activity.items() if seen <= deadline]
+
+    def idle_sockets(self) -> List[WebSocket]:
+        """Соединения без входящих кадров дольше idle_timeout"""
+        deadline = time.monotonic() - self.idle_timeout
+        return [ws for ws, seen in self.last_activity.items() if seen <= deadline]
+
+    def start(self) -> None:
+        if self.session_factory is not None and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        # Пользователи этого инстанса больше не онлайн
+        now = datetime.now(timezone.utc)
+        for user_id in set(self.socket_users.values()):
+            self._dirty[user_id] = (now, now)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Запись накопленного присутствия одним пакетом"""
+        if not self._dirty or self.session_factory is None:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = [
+            {"user_id": user_id, "last_seen_at": last_seen_at, "online_until": online_until}
+            for user_id, (last_seen_at, online_until) in dirty.items()
+        ]
+        try:
+            async with self.session_factory() as db:
+                await PresenceRepository(db).upsert_many(rows, extend_only=not self.single_instance)
+        except Exception as e:
+            logger.error(f"Failed to flush presence of {len(rows)} users: {str(e)}")
+            # Возвращаем записи, не перетирая более свежие
+            for user_id, value in dirty.items():
+                self._dirty.setdefault(user_id, value)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+class PresenceDebouncer:
+    """
+    Отложенная и пакетная рассылка смены статусов пользователей в чатах.
+
+    "offline" отправляется только если пользователь не переподключился
+    за grace_period; переподключение в этот интервал не порождает ни
+    одного кадра. Все смены статусов в чате за batch_interval уходят
+    одним кадром presence со списком изменений.
+    """
+    def __init__(
+        self,
+        grace_period: float,
+        batch_interval: float,
+        publish: Callable[[int, List[dict]], Awaitable[None]],
+        is_connected: Callable[[int, int], bool]
+    ):
+        self.grace_period = grace_period
+        self.batch_interval = batch_interval
+        self._publish = publish
+        self._is_connected = is_connected
+
+        # (chat_id, user_id) -> момент, после которого отправляется "offline" (time.monotonic)
+        self._offline_deadlines: Dict[tuple[int, int], float] = {}
+        # chat_id -> user_id -> статус, ожидающий отправки
+        self._changes: Dict[int, Dict[int, str]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def online(self, chat_id: int, user_id: int) -> None:
+        """Первое соединение пользователя в чате"""
+        if self._offline_deadlines.pop((chat_id, user_id), None) is not None:
+            # Переподключение в пределах grace_period: для остальных пользователь не уходил
+            return
+        self._changes.setdefault(chat_id, {})[user_id] = "online"
+        self._schedule()
+
+    def offline(self, chat_id: int, user_id: int) -> None:
+        """Последнее соединение пользователя в чате закрыто"""
+        pending = self._changes.get(chat_id)
+        if pending is not None and pending.get(user_id) == "online":
+            # "online" ещё не отправлен - отменяем его вместо пары online/offline
+            del pending[user_id]
+            if not pending:
+                del self._changes[chat_id]
+            return
+        self._offline_deadlines[(chat_id, user_id)] = time.monotonic() + self.grace_period
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._changes or self._offline_deadlines:
+            await asyncio.sleep(self.batch_interval)
+            await self.flush()
+
+    async def flush(self, force: bool = False) -> None:
+        """
+        Отправка накопленных изменений
+
+        Args:
+            force: Не дожидаться grace_period для ожидающих "offline"
+        """
+        now = time.monotonic()
+        for key, deadline in list(self._offline_deadlines.items()):
+            if not force and deadline > now:
+                continue
+            del self._offline_deadlines[key]
+            chat_id, user_id = key
+            if not self._is_connected(chat_id, user_id):
+                self._changes.setdefault(chat_id, {})[user_id] = "offline"
+
+        changes, self._changes = self._changes, {}
+        for chat_id, statuses in changes.items():
+            try:
+                await self._publish(chat_id, [
+                    {"user_id": user_id, "status": status} for user_id, status in statuses.items()
+                ])
+            except Exception as e:
+                logger.error(f"Failed to publish presence of chat {chat_id}: {str(e)}")
+
+    async def stop(self) -> None:
+        """Отмена ожидающих рассылок (при остановке инстанса)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._offline_deadlines.clear()
+        self._changes.clear()
@@ -1,6 +1,11 @@
-from fastapi import APIRouter, WebSocket, Depends
+from fastapi import APIRouter, WebSocket, Depends, Query
 from .controller import WebSocketController
-from .dependencies import get_websocket_controller, get_current_user_ws
+from .dependencies import get_websocket_controller, get_current_user_ws, websocket_manager
+from .schemas import SendQueueStats, PresenceQuery, PresenceResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.core.db import get_db
+from src.features.users.services import PresenceService
+from src.features.auth.dependencies import get_current_user
 from src.features.users.schemas import UserInDB
 
 router = APIRouter()
@@ -9,7 +14,39 @@ router = APIRouter()
 async def websocket_endpoint(
     websocket: WebSocket,
     chat_id: int,
+    last_message_id: int | None = Query(None, description="Последнее полученное сообщение для догонки"),
     controller: WebSocketController = Depends(get_websocket_controller),
     current_user: UserInDB = Depends(get_current_user_ws)
 ):
-    await controller.process_chat_connection(websocket, chat_id, current_user) 
\ No newline at end of file
+    await controller.process_chat_connection(websocket, chat_id, current_user, last_message_id)
+
+
+@router.websocket("/user")
+async def websocket_user_endpoint(
+    websocket: WebSocket,
+    controller: WebSocketController = Depends(get_websocket_controller),
+    current_user: UserInDB = Depends(get_current_user_ws)
+):
+    """Одно соединение на пользователя с подпиской на несколько чатов"""
+    await controller.process_user_connection(websocket, current_user)
+
+
+@router.get("/stats", response_model=SendQueueStats)
+async def websocket_stats(
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """Глубина исходящих очередей и счётчики медленных клиентов"""
+    return websocket_manager.get_queue_stats()
+
+
+@router.post("/presence", response_model=PresenceResponse)
+async def websocket_presence(
+    query: PresenceQuery,
+    current_user: UserInDB = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Какие из пользователей сейчас онлайн (по всем инстансам) и когда были активны"""
+    online_locally = websocket_manager.get_online_users(query.user_ids)
+    users = await PresenceService(db).get_presence(query.user_ids, online_locally)
+    return {"users": users}
+
@@ -1,11 +1,13 @@
 from pydantic import BaseModel, Field
-from typing import Union, Literal, List, Annotated
+from typing import Union, Literal, List, Annotated, Optional, Dict
 from src.features.messages.schemas import MessageCreate
 from datetime import datetime
 
 # Базовая схема для всех WebSocket сообщений
 class BaseWebSocketMessage(BaseModel):
     chat_id: int
+    # Идентификатор кадра клиента, возвращается в ответе на него
+    request_id: Optional[str] = Field(None, max_length=64)
 
     class Config:
         extra = "forbid"
@@ -27,10 +29,45 @@ class UserStatusWS(BaseWebSocketMessage):
     user_id: int
     status: Literal["connected", "disconnected"]
 
+# Базовая схема управляющих кадров мультиплексированного соединения
+class BaseControlMessage(BaseModel):
+    request_id: Optional[str] = Field(None, max_length=64)
+
+    class Config:
+        extra = "forbid"
+
+# Подписка на события чатов
+class SubscribeWS(BaseControlMessage):
+    message_type: Literal['subscribe']
+    chat_ids: List[int] = Field(..., min_length=1)
+    # chat_id -> id последнего полученного сообщения: пропущенное придёт кадрами catch_up
+    cursors: Dict[int, int] = {}
+
+# Отписка от событий чатов
+class UnsubscribeWS(BaseControlMessage):
+    message_type: Literal['unsubscribe']
+    chat_ids: List[int] = Field(..., min_length=1)
+
+# Ответ клиента на ping сервера
+class PongWS(BaseControlMessage):
+    message_type: Literal['pong']
+
+# Операция внутри пакетного кадра
+BatchOperationWS = Annotated[
+    Union[NewMessageWS, ReadStatusWS],
+    Field(discriminator="message_type")
+]
+
+# Пакет операций, выполняемых в одной транзакции
+class BatchWS(BaseControlMessage):
+    message_type: Literal['batch']
+    operations: List[BatchOperationWS] = Field(..., min_length=1, max_length=500)
+
 # Базовая схема для всех ответов
 class BaseWSResponse(BaseModel):
     response_type: str
     timestamp: datetime
+    request_id: Optional[str] = None
 
 # Схема ответа сервера на создание нового сообщения
 class NewMessageResponse(BaseWSResponse):
@@ -47,7 +84,9 @@ class ReadStatusResponse(BaseWSResponse):
     message_id: int
     chat_id: int
     reader_id: int
-    read_by: List[int] = []
+    # None, если прочитавших больше READ_RECEIPTS_MAX_READ_BY: тогда есть только read_count
+    read_by: Optional[List[int]] = []
+    read_count: int = 0
 
 # Схема ответа на статус пользователя
 class UserStatusResponse(BaseWSResponse):
@@ -56,14 +95,58 @@ class UserStatusResponse(BaseWSResponse):
     status: Literal["connected", "disconnected"]
     timestamp: datetime
 
+# Схема ответа на подписку/отписку
+class SubscriptionResponse(BaseWSResponse):
+    response_type: Literal['subscribe', 'unsubscribe']
+    chat_ids: List[int] = []  # Текущие подписки соединения после операции
+    rejected: List[int] = []  # Чаты, в которых пользователь не состоит
+
+# Схема ответа об ошибке обработки кадра
+class ErrorResponse(BaseWSResponse):
+    response_type: Literal['error']
+    detail: str
+
+# Ответ на пакетный кадр: результаты операций в порядке запроса
+class BatchResponse(BaseWSResponse):
+    response_type: Literal['batch']
+    results: List[Annotated[Union[NewMessageResponse, ReadStatusResponse], Field(discriminator="response_type")]]
+
 # Объединённый тип для входящих сообщений с дискриминатором
 MessageWS = Annotated[
-    Union[NewMessageWS, ReadStatusWS, UserStatusWS],
+    Union[NewMessageWS, ReadStatusWS, UserStatusWS, SubscribeWS, UnsubscribeWS, PongWS, BatchWS],
     Field(discriminator="message_type")
 ]
 
 # Объединённый тип для ответов с дискриминатором
 ResponseWS = Annotated[
-    Union[NewMessageResponse, ReadStatusResponse, UserStatusResponse],
+    Union[
+        NewMessageResponse, ReadStatusResponse, UserStatusResponse,
+        SubscriptionResponse, ErrorResponse, BatchResponse
+    ],
     Field(discriminator="response_type")
-]
\ No newline at end of file
+]
+
+# Статистика исходящих очередей WebSocket соединений
+class SendQueueStats(BaseModel):
+    connections: int
+    queued_frames: int
+    max_queue_depth: int
+    sent_frames: int
+    dropped_frames: int
+    coalesced_frames: int
+    slow_disconnects: int
+    policy: str
+
+# Запрос присутствия списка пользователей
+class PresenceQuery(BaseModel):
+    user_ids: List[int] = Field(..., min_length=1, max_length=1000)
+
+# Присутствие одного пользователя
+class UserPresence(BaseModel):
+    user_id: int
+    online: bool
+    last_seen_at: Optional[datetime] = None
+
+class PresenceResponse(BaseModel):
+    users: List[UserPresence]
+
@@ -1,7 +1,7 @@
+import asyncio
 from fastapi import WebSocket
-from typing import Dict, Union, Any
+from typing import Dict, Union, Any, Iterable, Callable, Awaitable
 from src.core.logging import logger
-import json
 from datetime import datetime
 from .schemas import (
     BaseWSResponse,
@@ -14,55 +14,414 @@ from collections import defaultdict
 from typing import Literal
 
 
-from .utils import DateTimeEncoder
+from src.config import get_settings
+from src.core.pg_listener import PgListener
+from src.features.chats.membership_cache import MEMBERSHIP_CHANNEL
+from .bus import BroadcastBus, ExcludedUsers, InProcessBus
+from .context import FORBIDDEN_CLOSE_CODE
+from .outbound import ConnectionSender, SlowConsumerPolicy
+from .presence import IDLE_CLOSE_CODE, PresenceDebouncer, PresenceTracker
+from .utils import encode_frame
+
+
+settings = get_settings()
 
 
 class WebSocketSessionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        send_queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+        slow_consumer_policy: str = settings.WS_SLOW_CONSUMER_POLICY,
+        max_backlog_ms: int = settings.WS_MAX_BACKLOG_MS,
+        bus: BroadcastBus | None = None,
+        presence: PresenceTracker | None = None,
+        presence_grace_seconds: float = settings.WS_PRESENCE_GRACE_SECONDS,
+        presence_batch_ms: int = settings.WS_PRESENCE_BATCH_MS,
+        membership_listener: PgListener | None = None,
+        membership_loader: Callable[[int], Awaitable[Iterable[int]]] | None = None
+    ):
 
+        # chat_id -> user_id -> сокеты, подписанные на события чата
         self.active_connections: Dict[int, Dict[int, set[WebSocket]]] = defaultdict(lambda: defaultdict(set))
+        # user_id -> все сокеты пользователя (и по-чатовые, и мультиплексированные)
+        self.user_connections: Dict[int, set[WebSocket]] = defaultdict(set)
+        # сокет -> чаты, на которые он подписан
+        self.subscriptions: Dict[WebSocket, set[int]] = {}
+        # По-чатовые сокеты (/websocket/chat/{id}): без своего чата они бесполезны и закрываются
+        self.chat_sockets: set[WebSocket] = set()
+        # Исходящая очередь и writer-задача для каждого зарегистрированного соединения
+        self.senders: Dict[WebSocket, ConnectionSender] = {}
+
+        self.send_queue_size = send_queue_size
+        self.slow_consumer_policy = SlowConsumerPolicy(slow_consumer_policy)
+        self.max_backlog_ms = max_backlog_ms
+
+        # Счётчики закрытых соединений, чтобы статистика не терялась при отключениях
+        self._closed_stats = {"sent": 0, "dropped": 0, "coalesced": 0, "slow_disconnects": 0}
+
+        # Шина доставляет события и локальным соединениям, и соединениям других процессов
+        self.bus = bus if bus is not None else InProcessBus()
+        self.bus.set_handler(self.deliver_local)
+        self.bus.set_user_handler(self.deliver_local_to_user)
+        self.bus.set_member_handler(self.deliver_local_to_member)
+
+        # Активность соединений и присутствие пользователей
+        self.presence = presence if presence is not None else PresenceTracker(
+            ping_interval=settings.WS_PING_INTERVAL_SECONDS,
+            idle_timeout=settings.WS_IDLE_TIMEOUT_SECONDS,
+            flush_interval=settings.WS_PRESENCE_FLUSH_SECONDS,
+            online_ttl=settings.WS_PRESENCE_TTL_SECONDS
+        )
+        self._heartbeat_task: asyncio.Task | None = None
+        # Изменения состава чатов (триггер chat_members -> NOTIFY) и загрузка актуального состава:
+        # исключённые участники отключаются от событий чата, даже если молчат
+        self.membership_listener = membership_listener
+        self.membership_loader = membership_loader
+        self._revalidation_tasks: set[asyncio.Task] = set()
+        # Смены статусов рассылаются с задержкой и пачками, чтобы переподключения не порождали шторм кадров
+        self.presence_debouncer = PresenceDebouncer(
+            grace_period=presence_grace_seconds,
+            batch_interval=presence_batch_ms / 1000,
+            publish=self.send_presence_changes,
+            is_connected=self.is_user_connected
+        )
+
+    async def start(self) -> None:
+        """Запуск шины событий и фоновых задач присутствия (при старте приложения)"""
+        await self.bus.start()
+        if self.membership_listener is not None and self.membership_loader is not None:
+            await self.membership_listener.listen(MEMBERSHIP_CHANNEL, self._on_membership_change)
+            await self.membership_listener.start()
+        self.presence.start()
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        """Остановка шины событий и фоновых задач (при остановке приложения)"""
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+        await self.presence_debouncer.stop()
+        await self.presence.stop()
+        await self.bus.stop()
+
+    def touch(self, websocket: WebSocket) -> None:
+        """Отметка входящего кадра от соединения"""
+        self.presence.touch(websocket)
+
+    async def _heartbeat_loop(self) -> None:
+        """Ping молчащих соединений и закрытие мёртвых"""
+        interval = min(self.presence.ping_interval, self.presence.idle_timeout) / 2
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for websocket in self.presence.idle_sockets():
+                    await self._reap(websocket)
+
+                stale = self.presence.sockets_to_ping()
+                if stale:
+                    # Один кадр на все соединения, как и при рассылке
+                    frame = encode_frame({"message_type": "ping", "timestamp": datetime.utcnow()})
+                    for websocket in stale:
+                        self.send_to_connection(websocket, frame, key="ping")
+            except Exception as e:
+                logger.error(f"Heartbeat error: {str(e)}")
+
+    async def _reap(self, websocket: WebSocket) -> None:
+        """Закрытие соединения, от которого давно не было кадров"""
+        user_id = self.presence.socket_users.get(websocket)
+        logger.info(f"Reaping idle WebSocket of user {user_id}")
+        # Полуоткрытое соединение может не ответить на close, поэтому не ждём его
+        asyncio.create_task(self._close_quietly(websocket, IDLE_CLOSE_CODE))
+        if user_id is None:
+            self.presence.remove(websocket, last_socket=False)
+            return
+        await self.handle_user_disconnection(websocket, user_id)
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=1)
+        except Exception as e:
+            logger.debug(f"Error closing idle WebSocket: {str(e)}")
+
+    def register(self, websocket: WebSocket, user_id: int) -> None:
+        """Регистрация соединения пользователя (без подписки на чаты)"""
+        self.user_connections[user_id].add(websocket)
+        self.subscriptions.setdefault(websocket, set())
+        self._register_sender(websocket)
+        self.presence.add(websocket, user_id)
+
+    async def unregister(self, websocket: WebSocket, user_id: int) -> None:
+        """Снятие регистрации соединения"""
+        sockets = self.user_connections.get(user_id)
+        last_socket = False
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.user_connections[user_id]
+                last_socket = True
+        self.subscriptions.pop(websocket, None)
+        self.chat_sockets.discard(websocket)
+        self.presence.remove(websocket, last_socket)
+        await self._unregister_sender(websocket)
+
+    def _attach(self, websocket: WebSocket, chat_id: int, user_id: int) -> bool:
+        """
+        Добавление сокета в маршрутизацию событий чата
+
+        Returns:
+            bool: True, если это первый сокет пользователя в чате
+        """
+        first = not self.is_user_connected(chat_id, user_id)
+        self.active_connections[chat_id][user_id].add(websocket)
+        self.subscriptions.setdefault(websocket, set()).add(chat_id)
+        return first
+
+    def _detach(self, websocket: WebSocket, chat_id: int, user_id: int) -> bool:
+        """
+        Удаление сокета из маршрутизации событий чата
+
+        Returns:
+            bool: True, если у пользователя не осталось сокетов в чате
+        """
+        subscribed = self.subscriptions.get(websocket)
+        if subscribed is not None:
+            subscribed.discard(chat_id)
+        if chat_id not in self.active_connections or user_id not in self.active_connections[chat_id]:
+            return False
+        self.active_connections[chat_id][user_id].discard(websocket)
+        if self.active_connections[chat_id][user_id]:
+            return False
+        del self.active_connections[chat_id][user_id]
+        if not self.active_connections[chat_id]:
+            del self.active_connections[chat_id]
+        return True
 
     async def connect(self, websocket: WebSocket, chat_id: int, user_id: int):
         """Подключение нового пользователя к чату"""
-        self.active_connections[chat_id][user_id].add(websocket)
+        self.register(websocket, user_id)
+        self._attach(websocket, chat_id, user_id)
         logger.info(f"User {user_id} connected to chat {chat_id}. Active connections: {len(self.active_connections[chat_id][user_id])}")
 
     async def disconnect(self, websocket: WebSocket, chat_id: int, user_id: int):
         """Отключение пользователя от чата"""
-        if chat_id in self.active_connections and user_id in self.active_connections[chat_id]:
-            self.active_connections[chat_id][user_id].discard(websocket)
-            if not self.active_connections[chat_id][user_id]:
-                del self.active_connections[chat_id][user_id]
-            if not self.active_connections[chat_id]:
-                del self.active_connections[chat_id]
+        self._detach(websocket, chat_id, user_id)
+        await self.unregister(websocket, user_id)
         logger.info(f"User {user_id} disconnected from chat {chat_id}")
 
-    async def broadcast_message(self, chat_id: int, message: Any, current_user_id: int) -> None:
+    async def subscribe(self, websocket: WebSocket, user_id: int, chat_ids: Iterable[int]) -> list[int]:
+        """
+        Подписка соединения на события чатов
+
+        Args:
+            websocket: Зарегистрированное соединение
+            user_id: ID пользователя
+            chat_ids: Чаты, членство в которых уже проверено
+
+        Returns:
+            list[int]: Все чаты, на которые подписано соединение
+        """
+        for chat_id in chat_ids:
+            if self._attach(websocket, chat_id, user_id):
+                # Статус "online" нужен, только если это первый сокет пользователя в чате
+                self.presence_debouncer.online(chat_id, user_id)
+        logger.info(f"User {user_id} subscribed to chats {sorted(self.subscriptions.get(websocket, ()))}")
+        return sorted(self.subscriptions.get(websocket, ()))
+
+    async def unsubscribe(self, websocket: WebSocket, user_id: int, chat_ids: Iterable[int]) -> list[int]:
+        """
+        Отписка соединения от событий чатов
+
+        Returns:
+            list[int]: Чаты, на которые соединение осталось подписано
+        """
+        for chat_id in list(chat_ids):
+            if self._detach(websocket, chat_id, user_id):
+                # Статус "offline" - когда у пользователя не осталось сокетов в чате
+                self.presence_debouncer.offline(chat_id, user_id)
+        return sorted(self.subscriptions.get(websocket, ()))
+
+    def _on_membership_change(self, payload: str) -> None:
+        """Уведомление об изменении состава чата: перепроверка его локальных подписчиков"""
+        chat_id = int(payload)
+        if chat_id not in self.active_connections:
+            return
+        task = asyncio.create_task(self.revalidate_chat(chat_id))
+        self._revalidation_tasks.add(task)
+        task.add_done_callback(self._revalidation_tasks.discard)
+
+    async def revalidate_chat(self, chat_id: int) -> None:
+        """Отключение от событий чата подключённых к этому процессу пользователей, которые больше не участники"""
+        connected = set(self.active_connections.get(chat_id, ()))
+        if not connected:
+            return
+        try:
+            members = set(await self.membership_loader(chat_id))
+        except Exception as e:
+            logger.error(f"Failed to revalidate members of chat {chat_id}: {str(e)}")
+            return
+        await self.evict(chat_id, connected - members)
+
+    async def evict(self, chat_id: int, user_ids: Iterable[int]) -> None:
+        """
+        Отключение исключённых участников от событий чата
+
+        Мультиплексированные соединения отписываются от чата, по-чатовые
+        закрываются с кодом 4003.
+        """
+        for user_id in user_ids:
+            for websocket in list(self.active_connections.get(chat_id, {}).get(user_id, ())):
+                await self.unsubscribe(websocket, user_id, [chat_id])
+                if websocket in self.chat_sockets:
+                    asyncio.create_task(self._close_quietly(websocket, FORBIDDEN_CLOSE_CODE))
+                logger.info(f"User {user_id} removed from chat {chat_id}, WebSocket detached")
+
+    def get_subscriptions(self, websocket: WebSocket) -> set[int]:
+        """Чаты, на которые подписано соединение"""
+        return self.subscriptions.get(websocket, set())
+
+    def _register_sender(self, websocket: WebSocket) -> ConnectionSender:
+        """Создание исходящей очереди для соединения"""
+        sender = self.senders.get(websocket)
+        if sender is None:
+            sender = ConnectionSender(
+                websocket,
+                max_size=self.send_queue_size,
+                policy=self.slow_consumer_policy,
+                max_backlog_ms=self.max_backlog_ms
+            )
+            self.senders[websocket] = sender
+            sender.start()
+        return sender
+
+    async def _unregister_sender(self, websocket: WebSocket) -> None:
+        """Остановка исходящей очереди соединения"""
+        sender = self.senders.pop(websocket, None)
+        if sender is None:
+            return
+        await sender.stop()
+        self._closed_stats["sent"] += sender.sent
+        self._closed_stats["dropped"] += sender.dropped
+        self._closed_stats["coalesced"] += sender.coalesced
+        self._closed_stats["slow_disconnects"] += int(sender.slow_disconnect)
+
+    def send_to_connection(self, websocket: WebSocket, frame: str, key: str | None = None) -> bool:
+        """Постановка кадра в исходящую очередь конкретного соединения"""
+        sender = self.senders.get(websocket)
+        if sender is None:
+            logger.warning("Attempt to send to unregistered WebSocket connection")
+            return False
+        return sender.enqueue(frame, key)
+
+    def pause_connection(self, websocket: WebSocket) -> None:
+        """Приостановка отправки кадров соединению (события продолжают копиться в очереди)"""
+        sender = self.senders.get(websocket)
+        if sender is not None:
+            sender.pause()
+
+    def resume_connection(self, websocket: WebSocket, frames: Iterable[str] = ()) -> None:
+        """Возобновление отправки, frames уходят раньше накопленных за паузу событий"""
+        sender = self.senders.get(websocket)
+        if sender is not None:
+            sender.resume(frames)
+
+    async def broadcast_message(
+        self,
+        chat_id: int,
+        message: Any,
+        current_user_id: ExcludedUsers,
+        coalesce_key: str | None = None
+    ) -> None:
         """Отправка сообщения всем подключенным пользователям в чате"""
-        if chat_id in self.active_connections:
-            message_json = json.loads(json.dumps(message, cls=DateTimeEncoder))
-
-            # Отправляем сообщение всем подключенным пользователям
-            for user_id, websockets in self.active_connections[chat_id].items():
-                if user_id == current_user_id:  # Пропускаем текущего пользователя
-                    continue
-                    
-                for websocket in websockets:
-                    try:
-                        # Убираем проверку состояния - пусть WebSocket сам обрабатывает свои ошибки
-                        match message_json["message_type"]:
-                            case "new_message":
-                                logger.info(f"УВЕДОМЛЕНИЯ О НОВОМ СООБЩЕНИИ: to user {user_id} in chat {chat_id} \n {message_json}")
-                            case "read_status":
-                                logger.info(f"СТАТУС ПРОЧТЕНИЯ: to user {user_id} in chat {chat_id} \n {message_json}")
-                            case "user_status":
-                                logger.info(f"СТАТУС ПОЛЬЗОВАТЕЛЯ: to user {user_id} in chat {chat_id} \n {message_json}")
-
-                        await websocket.send_text(json.dumps(message_json, cls=DateTimeEncoder))
-                        logger.info(f"Message sent successfully to user {user_id}")
-                    except Exception as e:
-                        logger.error(f"Error sending message to user {user_id}: {str(e)}")
-                        # Не отключаем соединение здесь - пусть это делает основной обработчик
+        if self.bus.local_only and chat_id not in self.active_connections:
+            return
+
+        # Сериализуем событие один раз и рассылаем один и тот же кадр всем получателям
+        frame = encode_frame(message)
+        await self.broadcast_frame(chat_id, frame, current_user_id, coalesce_key)
+
+    async def broadcast_frame(
+        self,
+        chat_id: int,
+        frame: str,
+        current_user_id: ExcludedUsers,
+        coalesce_key: str | None = None
+    ) -> None:
+        """Публикация уже сериализованного кадра в шину событий чата"""
+        await self.bus.publish(chat_id, frame, current_user_id, coalesce_key)
+
+    def deliver_local(
+        self,
+        chat_id: int,
+        frame: str,
+        current_user_id: ExcludedUsers,
+        coalesce_key: str | None = None
+    ) -> None:
+        """
+        Постановка кадра в очереди всех подключенных к этому процессу пользователей чата.
+        Отправкой занимаются writer-задачи соединений, поэтому метод не ждёт медленных клиентов.
+        """
+        excluded = current_user_id if isinstance(current_user_id, list) else (current_user_id,)
+        recipients = 0
+        for user_id, websockets in self.active_connections.get(chat_id, {}).items():
+            if user_id in excluded:  # Пропускаем текущего пользователя
+                continue
+
+            for websocket in websockets:
+                if self.send_to_connection(websocket, frame, coalesce_key):
+                    recipients += 1
+
+        logger.debug(f"Broadcast to chat {chat_id}: {recipients} connections, {len(frame)} bytes")
+
+    async def send_to_user(self, user_id: int, message: Any, coalesce_key: str | None = None) -> None:
+        """Отправка события во все соединения пользователя на всех инстансах"""
+        if self.bus.local_only and user_id not in self.user_connections:
+            return
+        await self.bus.publish_to_user(user_id, encode_frame(message), coalesce_key)
+
+    def deliver_local_to_member(self, chat_id: int, user_id: int, frame: str, coalesce_key: str | None = None) -> None:
+        """Постановка кадра в очереди соединений пользователя, подписанных на чат, в этом процессе"""
+        for websocket in self.active_connections.get(chat_id, {}).get(user_id, ()):
+            self.send_to_connection(websocket, frame, coalesce_key)
+
+    async def send_unread_counts(self, changes: Iterable[dict]) -> None:
+        """
+        Отправка изменившихся счётчиков непрочитанного во все соединения их владельцев
+
+        Кадр кодируется один раз на чат и значение счётчика: после нового сообщения
+        счётчик у большинства получателей одинаковый, и они получают один и тот же кадр.
+
+        Args:
+            changes: user_id, chat_id, unread_count после commit (более поздние - свежее)
+        """
+        latest: dict[tuple[int, int], int] = {}
+        for change in changes:
+            latest[(change["user_id"], change["chat_id"])] = change["unread_count"]
+
+        timestamp = datetime.utcnow()
+        frames: dict[tuple[int, int], str] = {}
+        for (user_id, chat_id), unread_count in latest.items():
+            if self.bus.local_only and user_id not in self.user_connections:
+                continue
+            frame = frames.get((chat_id, unread_count))
+            if frame is None:
+                frame = frames[(chat_id, unread_count)] = encode_frame({
+                    "message_type": "unread",
+                    "counts": [{"chat_id": chat_id, "unread_count": unread_count}],
+                    "timestamp": timestamp
+                })
+            # Более свежий счётчик чата заменяет ещё не отправленный
+            await self.bus.publish_to_user(user_id, frame, f"unread:{chat_id}")
+
+    def deliver_local_to_user(self, user_id: int, frame: str, coalesce_key: str | None = None) -> None:
+        """Постановка кадра в очереди всех соединений пользователя в этом процессе"""
+        for websocket in self.user_connections.get(user_id, ()):
+            self.send_to_connection(websocket, frame, coalesce_key)
 
     async def send_user_status(self, chat_id: int, user_id: int, status: Literal["online", "offline"]):
         """Отправка статуса пользователя"""
@@ -73,31 +432,110 @@ class WebSocketSessionManager:
             "chat_id": chat_id,
             "timestamp": datetime.utcnow()
         }
-        await self.broadcast_message(chat_id, status_message, user_id)
+        await self.broadcast_message(
+            chat_id,
+            status_message,
+            user_id,
+            coalesce_key=f"user_status:{chat_id}:{user_id}"
+        )
+
+    async def send_presence_changes(self, chat_id: int, changes: list[dict]) -> None:
+        """
+        Отправка пачки смен статусов пользователей чата одним кадром.
+        Как и прежде, пользователь не получает уведомление о собственном статусе:
+        участники пачки исключаются из общего кадра и получают в этом чате свой - без своей записи
+        """
+        if self.bus.local_only and chat_id not in self.active_connections:
+            return
+        changed_user_ids = [change["user_id"] for change in changes]
+        presence_message = {
+            "message_type": "presence",
+            "chat_id": chat_id,
+            "changes": changes,
+            "timestamp": datetime.utcnow()
+        }
+        await self.broadcast_message(chat_id, presence_message, changed_user_ids)
+        if len(changes) == 1:
+            return
+        for user_id in changed_user_ids:
+            await self.bus.publish_to_member(chat_id, user_id, encode_frame({
+                **presence_message,
+                "changes": [change for change in changes if change["user_id"] != user_id]
+            }))
+
+    async def send_membership_delta(self, delta: dict) -> None:
+        """
+        Отправка изменения состава участникам чата (и исключённым - последним кадром)
+
+        Args:
+            delta: chat_id, version, added, removed после commit
+        """
+        await self.broadcast_message(
+            delta["chat_id"],
+            {
+                "message_type": "membership_delta",
+                **delta,
+                "timestamp": datetime.utcnow()
+            },
+            None
+        )
+        # Исключённые получают изменение и сразу отключаются от событий чата;
+        # другие процессы сделают то же по уведомлению об изменении состава
+        await self.evict(delta["chat_id"], delta["removed"])
 
     async def send_personal_message(self, chat_id: int, user_id: int, message: dict):
         """Отправка личного сообщения конкретному пользователю"""
-        if chat_id in self.active_connections and user_id in self.active_connections[chat_id]:
-            await self.active_connections[chat_id][user_id].send_json(message)
+        frame = encode_frame(message)
+        for websocket in self.active_connections.get(chat_id, {}).get(user_id, ()):
+            self.send_to_connection(websocket, frame)
 
     def get_active_users(self, chat_id: int) -> list[int]:
         """Получение списка активных пользователей в чате"""
         return list(self.active_connections.get(chat_id, {}).keys())
 
+    def get_queue_stats(self) -> dict:
+        """Статистика исходящих очередей для мониторинга"""
+        depths = [sender.depth for sender in self.senders.values()]
+        return {
+            "connections": len(depths),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "sent_frames": self._closed_stats["sent"] + sum(s.sent for s in self.senders.values()),
+            "dropped_frames": self._closed_stats["dropped"] + sum(s.dropped for s in self.senders.values()),
+            "coalesced_frames": self._closed_stats["coalesced"] + sum(s.coalesced for s in self.senders.values()),
+            "slow_disconnects": self._closed_stats["slow_disconnects"] + sum(
+                int(s.slow_disconnect) for s in self.senders.values()
+            ),
+            "policy": self.slow_consumer_policy.value
+        }
+
+    def get_online_users(self, user_ids: Iterable[int]) -> set[int]:
+        """Пользователи из списка, у которых есть соединения с этим инстансом"""
+        return {user_id for user_id in user_ids if user_id in self.user_connections}
+
     def is_user_connected(self, chat_id: int, user_id: int) -> bool:
         """Проверка, подключен ли пользователь к чату"""
         return chat_id in self.active_connections and user_id in self.active_connections[chat_id]
 
     async def handle_connection(self, websocket: WebSocket, chat_id: int, user_id: int):
-        """Обработка нового подключения"""
+        """Обработка нового подключения к чату"""
         await websocket.accept()
-        await self.connect(websocket, chat_id, user_id)
-        # Отправляем статус "online" всем участникам чата
-        await self.send_user_status(chat_id, user_id, "online")
+        self.register(websocket, user_id)
+        self.chat_sockets.add(websocket)
+        await self.subscribe(websocket, user_id, [chat_id])
 
     async def handle_disconnection(self, websocket: WebSocket, chat_id: int, user_id: int):
         """Обработка отключения"""
-        # Отправляем статус "offline" всем участникам чата
-        if self.is_user_connected(chat_id, user_id):
-            await self.send_user_status(chat_id, user_id, "offline")
-        await self.disconnect(websocket, chat_id, user_id) 
\ No newline at end of file
+        await self.handle_user_disconnection(websocket, user_id)
+
+    async def handle_user_connection(self, websocket: WebSocket, user_id: int):
+        """Обработка нового мультиплексированного подключения пользователя"""
+        await websocket.accept()
+        self.register(websocket, user_id)
+        logger.info(f"User {user_id} opened multiplexed connection. Sockets: {len(self.user_connections[user_id])}")
+
+    async def handle_user_disconnection(self, websocket: WebSocket, user_id: int):
+        """Отписка соединения от всех чатов и снятие регистрации"""
+        await self.unsubscribe(websocket, user_id, self.get_subscriptions(websocket))
+        await self.unregister(websocket, user_id)
+        logger.info(f"User {user_id} connection closed")
@@ -1,9 +1,32 @@
 import json
 from datetime import datetime
+from typing import Any
+
+import orjson
+
 
 class DateTimeEncoder(json.JSONEncoder):
     """Кастомный JSON encoder для datetime объектов"""
     def default(self, obj):
         if isinstance(obj, datetime):
             return obj.isoformat()
-        return super().default(obj)
\ No newline at end of file
+        return super().default(obj)
+
+
+def _default(obj: Any) -> Any:
+    """Фолбэк для типов, которые orjson не умеет сериализовать сам"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def encode_frame(payload: Any) -> str:
+    """
+    Сериализует событие в готовый текстовый WebSocket-кадр.
+
+    orjson нативно пишет datetime в ISO 8601 (тот же формат, что и
+    DateTimeEncoder), поэтому промежуточный json.loads/json.dumps не нужен.
+    Результат — неизменяемая строка, которую можно отдать любому числу
+    получателей без повторной сериализации.
+    """
+    return orjson.dumps(payload, default=_default).decode()
@@ -15,7 +15,12 @@ from src.core.logging import setup_logging, logger
 from src.core.exceptions import setup_exception_handlers
 from src.core.relationships import setup_relationships
 from src.core.db import Base, engine, setup_db_relationships
+from src.core.query_budget import QueryBudget
 from src.core.wait_for_postgres import wait_for_postgres
+from src.features.websocket.dependencies import websocket_manager
+from src.features.messages.write_buffer import message_write_buffer
+from src.features.messages.key_pruner import idempotency_key_pruner
+from src.features.chats.membership_cache import membership_cache
 
 
 # Инициализируем настройки
@@ -53,6 +58,19 @@ async def startup():
 
     setup_relationships()
 
+    await membership_cache.start()
+    await websocket_manager.start()
+    idempotency_key_pruner.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Освобождение ресурсов приложения"""
+    await idempotency_key_pruner.stop()
+    await websocket_manager.stop()
+    await message_write_buffer.stop()
+    await membership_cache.stop()
+
 # Регистрируем обработчики исключений
 setup_exception_handlers(app)
 
@@ -63,6 +81,14 @@ app.include_router(api_router, prefix=settings.API_V1_PREFIX)
 async def health_check():
     return {"status": "ok"}
 
+@app.middleware("http")
+async def count_queries(request: Request, call_next):
+    """Число запросов к БД на HTTP-запрос - в заголовке X-Query-Count"""
+    with QueryBudget(f"{request.method} {request.url.path}") as budget:
+        response = await call_next(request)
+    response.headers["X-Query-Count"] = str(budget.count)
+    return response
+
 # Middleware для логирования запросов
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
@@ -1,5 +1,13 @@
+import asyncio
+from contextlib import asynccontextmanager
 import pytest
 from httpx import AsyncClient
+from sqlalchemy import delete, text
+from src.core.db import AsyncSessionFactory, Base, engine
+from src.core.pg_listener import get_pg_listener, PgListener
+from src.features.chats.services import ChatService
+from src.features.messages.models import Message
+from src.features.chats.membership_cache import MembershipCache, MEMBERSHIP_CHANNEL
 from tests.conftest import AUTH_USER_DATA, VALID_USER_DATA
 
 from .logger_for_pytest import logger
@@ -7,6 +15,26 @@ from .logger_for_pytest import logger
 pytestmark = pytest.mark.asyncio
 
 
+@asynccontextmanager
+async def create_all_schema():
+    """
+    Схема, построенная Base.metadata.create_all (как при старте приложения),
+    во временной схеме БД; удаляется по выходу, даже если тест делал commit
+    """
+    async with engine.connect() as conn:
+        try:
+            await conn.execute(text("CREATE SCHEMA create_all_check"))
+            await conn.execute(text("SET search_path TO create_all_check"))
+            await conn.run_sync(Base.metadata.create_all)
+            yield conn
+        finally:
+            await conn.rollback()
+            await conn.execute(text("DROP SCHEMA IF EXISTS create_all_check CASCADE"))
+            await conn.commit()
+            # search_path и подготовленные запросы к удалённой схеме не должны вернуться в пул
+            await conn.invalidate()
+
+
 async def get_available_user_id(client: AsyncClient, headers: dict) -> int:
     """Получает ID пользователя, с которым еще нет чата"""
     # Получаем список всех пользователей
@@ -300,4 +328,418 @@ class TestChats:
 
         # Пробуем получить доступ к чату от имени пользователя не из чата
         response = await client.get(f"/api/v1/chats/{group_chat['id']}", headers=test_user_headers)
-        assert response.status_code == 403, "Должен быть запрещен доступ к чужому чату" 
\ No newline at end of file
+        assert response.status_code == 403, "Должен быть запрещен доступ к чужому чату" 
+
+    async def test_membership_cache_invalidation(self, client: AsyncClient):
+        """Тест кэша составов: вытеснение LRU и сброс по уведомлению об изменении chat_members"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+
+        response = await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Membership cache chat",
+            "member_ids": [others[0]]
+        })
+        assert response.status_code == 200
+        chat_id = response.json()["id"]
+
+        cache = MembershipCache(PgListener(get_pg_listener().dsn), max_size=2)
+        await cache.start()
+        try:
+            cache.put(chat_id, {me["id"], others[0]}, cache.version)
+            cache.put(-1, set(), cache.version)
+            assert cache.get(chat_id) == {me["id"], others[0]}
+            # chat_id использован последним, поэтому вытесняется -1
+            evicted_version = cache.chat_version(-1)
+            cache.put(-2, set(), cache.version)
+            assert cache.get(-1) is None
+            assert cache.get(chat_id) is not None
+            # Вытеснение - не изменение состава: версия чата прежняя
+            assert cache.chat_version(-1) == evicted_version
+
+            # Состав меняет другой процесс (сервер) - кэш сбрасывается по NOTIFY
+            version = cache.version
+            chat_version = cache.chat_version(chat_id)
+            response = await client.post(f"/api/v1/chats/{chat_id}/members/add", headers=headers, json=[others[1]])
+            assert response.status_code == 200
+            for _ in range(100):
+                if cache.get(chat_id) is None:
+                    break
+                await asyncio.sleep(0.02)
+            assert cache.get(chat_id) is None
+            assert cache.chat_version(chat_id) != chat_version
+
+            # Состав, прочитанный до сброса, в кэш не попадает
+            cache.put(chat_id, {me["id"], others[0]}, version)
+            assert cache.get(chat_id) is None
+        finally:
+            await cache.stop()
+
+    async def test_membership_versions_without_cache(self, client: AsyncClient):
+        """Тест версий составов при MEMBERSHIP_CACHE_SIZE=0: составы не хранятся, но сбросы по NOTIFY учитываются"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+
+        response = await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Membership versions chat",
+            "member_ids": [others[0]]
+        })
+        assert response.status_code == 200
+        chat_id = response.json()["id"]
+
+        cache = MembershipCache(PgListener(get_pg_listener().dsn), max_size=0)
+        await cache.start()
+        try:
+            cache.put(chat_id, {me["id"], others[0]}, cache.version)
+            assert cache.get(chat_id) is None
+            version = cache.chat_version(chat_id)
+            # Без изменений состава версия стабильна, хотя кэша нет
+            assert cache.chat_version(chat_id) == version
+
+            response = await client.post(f"/api/v1/chats/{chat_id}/members/add", headers=headers, json=[others[1]])
+            assert response.status_code == 200
+            for _ in range(100):
+                if cache.chat_version(chat_id) != version:
+                    break
+                await asyncio.sleep(0.02)
+            assert cache.chat_version(chat_id) != version
+
+            # Переподключение LISTEN (уведомления могли потеряться) меняет версии всех чатов
+            version = cache.chat_version(chat_id)
+            cache.clear()
+            assert cache.chat_version(chat_id) != version
+        finally:
+            await cache.stop()
+
+    async def test_inbox(self, client: AsyncClient):
+        """Тест списка чатов по активности: постраничная выборка и число запросов, не зависящее от числа чатов"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        chat_ids = [chat["id"] for chat in (await client.get("/api/v1/chats/list", headers=headers)).json()]
+        assert len(chat_ids) >= 2
+
+        # Самым свежим становится чат с новым сообщением
+        response = await client.post("/api/v1/messages/create", headers=headers, json={
+            "text": "Inbox preview " + "x" * 200,
+            "chat_id": chat_ids[0]
+        })
+        assert response.status_code == 201
+        message_id = response.json()["id"]
+
+        response = await client.get("/api/v1/chats/inbox", headers=headers)
+        assert response.status_code == 200
+        # Пользователь токена, страница чатов, участники
+        assert int(response.headers["X-Query-Count"]) <= 3
+        inbox = response.json()
+        top = inbox["chats"][0]
+        assert top["chat_id"] == chat_ids[0]
+        assert top["last_message"]["id"] == message_id
+        assert len(top["last_message"]["text"]) == 100
+        assert me["id"] in top["member_ids"]
+        activity = [chat["last_activity_at"] for chat in inbox["chats"]]
+        assert activity == sorted(activity, reverse=True)
+
+        paged, before = [], None
+        while True:
+            params = {"limit": 1, **({"before": before} if before else {})}
+            page = (await client.get("/api/v1/chats/inbox", headers=headers, params=params)).json()
+            paged.extend(chat["chat_id"] for chat in page["chats"])
+            before = page["before_cursor"]
+            if not page["has_more"]:
+                break
+        assert paged == [chat["chat_id"] for chat in inbox["chats"]]
+        assert sorted(paged) == sorted(chat_ids)
+
+        response = await client.get("/api/v1/chats/list", headers=headers)
+        assert int(response.headers["X-Query-Count"]) <= 3
+
+    async def test_denormalized_stats(self, client: AsyncClient):
+        """Тест статистики чата: триггеры ведут last_message_id, last_activity_at и member_count"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+
+        response = await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Stats chat",
+            "member_ids": [others[0]]
+        })
+        chat_id = response.json()["id"]
+
+        async def inbox_item() -> dict:
+            inbox = (await client.get("/api/v1/chats/inbox", headers=headers, params={"limit": 100})).json()
+            return next(chat for chat in inbox["chats"] if chat["chat_id"] == chat_id)
+
+        item = await inbox_item()
+        assert item["member_count"] == 2
+        assert item["last_message"] is None
+
+        message_ids = []
+        for text in ("first", "second"):
+            response = await client.post("/api/v1/messages/create", headers=headers, json={"text": text, "chat_id": chat_id})
+            message_ids.append(response.json()["id"])
+        item = await inbox_item()
+        assert item["last_message"]["id"] == message_ids[-1]
+        assert item["last_activity_at"] == item["last_message"]["created_at"]
+
+        # Удаление последнего сообщения возвращает предыдущее
+        async with AsyncSessionFactory() as db:
+            await db.execute(delete(Message).where(Message.id == message_ids[-1]))
+            await db.commit()
+        assert (await inbox_item())["last_message"]["id"] == message_ids[0]
+
+        await client.post(f"/api/v1/chats/{chat_id}/members/add", headers=headers, json=[others[1]])
+        assert (await inbox_item())["member_count"] == 3
+        await client.post(f"/api/v1/chats/{chat_id}/members/remove", headers=headers, json=[others[0]])
+        assert (await inbox_item())["member_count"] == 2
+
+        async with AsyncSessionFactory() as db:
+            assert await ChatService(db).check_stats() == []
+
+    async def test_create_all_schema_stats(self):
+        """Тест: схема из create_all ведёт статистику чатов теми же триггерами, что и миграции"""
+        async with create_all_schema() as conn:
+            user_ids = (await conn.execute(text(
+                "INSERT INTO users (username, email, hashed_password, is_active) "
+                "SELECT 'check_' || n, 'check_' || n || '@check.local', '-', true "
+                "FROM generate_series(1, 3) AS n RETURNING id"
+            ))).scalars().all()
+            chat_id = (await conn.execute(text(
+                "INSERT INTO chats (name, chat_type, creator_id) VALUES ('Check', 'group', :creator_id) RETURNING id"
+            ), {"creator_id": user_ids[0]})).scalar_one()
+
+            async def stats() -> tuple:
+                return (await conn.execute(text(
+                    "SELECT member_count, last_message_id FROM chats WHERE id = :chat_id"
+                ), {"chat_id": chat_id})).one()
+
+            await conn.execute(text(
+                "INSERT INTO chat_members (chat_id, user_id) SELECT :chat_id, id FROM users"
+            ), {"chat_id": chat_id})
+            assert await stats() == (3, None)
+
+            message_ids = (await conn.execute(text(
+                "INSERT INTO messages (chat_id, sender_id, text) "
+                "SELECT :chat_id, :sender_id, 'check ' || n FROM generate_series(1, 2) AS n RETURNING id"
+            ), {"chat_id": chat_id, "sender_id": user_ids[0]})).scalars().all()
+            assert await stats() == (3, max(message_ids))
+
+            await conn.execute(text("DELETE FROM messages WHERE id = :id"), {"id": max(message_ids)})
+            await conn.execute(text("DELETE FROM chat_members WHERE user_id = :user_id"), {"user_id": user_ids[2]})
+            assert await stats() == (2, min(message_ids))
+
+    async def test_create_all_schema_membership_versions(self):
+        """Тест: в схеме из create_all изменения состава получают версии и попадают в журнал"""
+        async with create_all_schema() as conn:
+            user_ids = (await conn.execute(text(
+                "INSERT INTO users (username, email, hashed_password, is_active) "
+                "SELECT 'check_' || n, 'check_' || n || '@check.local', '-', true "
+                "FROM generate_series(1, 3) AS n RETURNING id"
+            ))).scalars().all()
+            chat_id = (await conn.execute(text(
+                "INSERT INTO chats (name, chat_type, creator_id) VALUES ('Check', 'group', :creator_id) RETURNING id"
+            ), {"creator_id": user_ids[0]})).scalar_one()
+
+            await conn.execute(text(
+                "INSERT INTO chat_members (chat_id, user_id) SELECT :chat_id, id FROM users"
+            ), {"chat_id": chat_id})
+            await conn.execute(text("DELETE FROM chat_members WHERE user_id = :user_id"), {"user_id": user_ids[2]})
+
+            version = (await conn.execute(text(
+                "SELECT membership_version FROM chats WHERE id = :chat_id"
+            ), {"chat_id": chat_id})).scalar_one()
+            assert version == 2
+            changes = (await conn.execute(text(
+                "SELECT version, user_id, action FROM chat_membership_changes "
+                "WHERE chat_id = :chat_id ORDER BY version, user_id"
+            ), {"chat_id": chat_id})).all()
+            assert [tuple(change) for change in changes] == [
+                *((1, user_id, "added") for user_id in sorted(user_ids)),
+                (2, user_ids[2], "removed")
+            ]
+
+    async def test_create_all_schema_membership_notify(self):
+        """Тест: в схеме из create_all изменения chat_members сбрасывают кэши составов по NOTIFY"""
+        received = asyncio.Queue()
+        listener = PgListener(get_pg_listener().dsn)
+        await listener.listen(MEMBERSHIP_CHANNEL, received.put_nowait)
+        await listener.start()
+        try:
+            async with create_all_schema() as conn:
+                user_id = (await conn.execute(text(
+                    "INSERT INTO users (username, email, hashed_password, is_active) "
+                    "VALUES ('check_notify', 'check_notify@check.local', '-', true) RETURNING id"
+                ))).scalar_one()
+                chat_id = (await conn.execute(text(
+                    "INSERT INTO chats (name, chat_type, creator_id) VALUES ('Check', 'group', :user_id) RETURNING id"
+                ), {"user_id": user_id})).scalar_one()
+                await conn.execute(text(
+                    "INSERT INTO chat_members (chat_id, user_id) VALUES (:chat_id, :user_id)"
+                ), {"chat_id": chat_id, "user_id": user_id})
+                await conn.commit()
+                assert await asyncio.wait_for(received.get(), 5) == str(chat_id)
+
+                # Каскадное удаление чата тоже меняет состав
+                await conn.execute(text("DELETE FROM chats WHERE id = :chat_id"), {"chat_id": chat_id})
+                await conn.commit()
+                assert await asyncio.wait_for(received.get(), 5) == str(chat_id)
+        finally:
+            await listener.stop()
+
+    async def test_bulk_members(self, client: AsyncClient):
+        """Тест пакетного поиска участников: число запросов не зависит от числа приглашённых"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+        assert len(others) >= 2
+
+        query_counts = []
+        for member_ids in ([others[0]], others):
+            response = await client.post("/api/v1/chats/create", headers=headers, json={
+                "chat_type": "group",
+                "name": "Bulk members chat",
+                "member_ids": member_ids
+            })
+            assert response.status_code == 200
+            assert sorted(m["id"] for m in response.json()["members"]) == sorted(member_ids + [me["id"]])
+            query_counts.append(int(response.headers["X-Query-Count"]))
+        assert query_counts[0] == query_counts[1]
+
+        # Все отсутствующие пользователи перечисляются в одном ответе
+        response = await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Bulk members chat",
+            "member_ids": [others[0], -1, -2]
+        })
+        assert response.status_code == 404
+        assert response.json()["details"]["user_ids"] == [-1, -2]
+
+        chat_id = (await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Bulk members chat",
+            "member_ids": [others[0]]
+        })).json()["id"]
+        response = await client.post(f"/api/v1/chats/{chat_id}/members/add", headers=headers, json=[others[1], -1])
+        assert response.status_code == 404
+        response = await client.post(f"/api/v1/chats/{chat_id}/members/add", headers=headers, json=others[1:])
+        assert response.status_code == 200
+        assert sorted(m["id"] for m in response.json()["members"]) == sorted(others + [me["id"]])
+
+    async def test_member_pages(self, client: AsyncClient):
+        """Тест постраничного списка участников: только id и username, keyset по id"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+
+        response = await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Member pages chat",
+            "member_ids": others
+        })
+        chat = response.json()
+        assert chat["member_count"] == len(others) + 1
+        assert all(set(member) == {"id", "username"} for member in chat["members"])
+
+        paged, after = [], None
+        while True:
+            params = {"limit": 2, **({"after": after} if after is not None else {})}
+            response = await client.get(f"/api/v1/chats/{chat['id']}/members", headers=headers, params=params)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["members"]) <= 2
+            paged.extend(member["id"] for member in page["members"])
+            after = page["after_cursor"]
+            if not page["has_more"]:
+                break
+        assert paged == sorted(others + [me["id"]])
+
+        # Исключённый участник больше не видит состав
+        outsider = next(u for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] == others[0])
+        response = await client.post(f"/api/v1/chats/{chat['id']}/members/remove", headers=headers, json=[outsider["id"]])
+        assert response.status_code == 200
+        assert response.json()["member_count"] == len(others)
+        for password in ("testpass123", "testotest"):
+            outsider_login = await client.post("/api/v1/auth/token", data={
+                "username": outsider["email"],
+                "password": password
+            })
+            if outsider_login.status_code == 200:
+                break
+        outsider_headers = {"Authorization": f"Bearer {outsider_login.json()['access_token']}"}
+        response = await client.get(f"/api/v1/chats/{chat['id']}/members", headers=outsider_headers)
+        assert response.status_code == 403
+
+    async def test_membership_changes(self, client: AsyncClient):
+        """Тест версий состава: изменения после версии since, постранично по версиям"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me = (await client.get("/api/v1/users/me", headers=headers)).json()
+        others = [u["id"] for u in (await client.get("/api/v1/users/list", headers=headers)).json() if u["id"] != me["id"]]
+
+        chat = (await client.post("/api/v1/chats/create", headers=headers, json={
+            "chat_type": "group",
+            "name": "Membership changes chat",
+            "member_ids": [others[0]]
+        })).json()
+        version = chat["membership_version"]
+        page = (await client.get(f"/api/v1/chats/{chat['id']}/members", headers=headers)).json()
+        assert page["membership_version"] == version
+
+        response = await client.post(f"/api/v1/chats/{chat['id']}/members/add", headers=headers, json=[others[1]])
+        assert response.json()["membership_version"] == version + 1
+        response = await client.post(f"/api/v1/chats/{chat['id']}/members/remove", headers=headers, json=[others[0]])
+        assert response.json()["membership_version"] == version + 2
+
+        response = await client.get(f"/api/v1/chats/{chat['id']}/members/changes", headers=headers, params={"since": version})
+        assert response.status_code == 200
+        changes = response.json()
+        assert changes["version"] == version + 2
+        assert not changes["has_more"]
+        assert changes["deltas"] == [
+            {"version": version + 1, "added": [others[1]], "removed": []},
+            {"version": version + 2, "added": [], "removed": [others[0]]}
+        ]
+
+        # Клиентский состав, собранный из страницы и изменений, совпадает с текущим
+        members = {member["id"] for member in page["members"]}
+        for delta in changes["deltas"]:
+            members = (members | set(delta["added"])) - set(delta["removed"])
+        current = (await client.get(f"/api/v1/chats/{chat['id']}/members", headers=headers)).json()
+        assert members == {member["id"] for member in current["members"]}
+
+        response = await client.get(f"/api/v1/chats/{chat['id']}/members/changes", headers=headers, params={"since": version, "limit": 1})
+        assert response.json()["version"] == version + 1
+        assert response.json()["has_more"]
+
+        response = await client.get(f"/api/v1/chats/{chat['id']}/members/changes", headers=headers, params={"since": version + 3})
+        assert response.status_code == 400
@@ -1,8 +1,23 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
 import pytest
 from httpx import AsyncClient
-from .conftest import AUTH_USER_DATA
+from sqlalchemy import event, select, func, update
+from src.config import get_settings
+from src.core.db import engine, AsyncSessionFactory
+from src.core.query_budget import QueryBudget, QueryBudgetExceeded
+from src.features.messages.models import Message
+from src.features.messages.services import MessageService
+from src.features.messages.schemas import MessageCreate
+from src.features.messages.write_buffer import MessageWriteBuffer
+from src.features.messages.key_pruner import IdempotencyKeyPruner
+from src.features.users.schemas import UserInDB
+from .conftest import AUTH_USER_DATA, ADDITIONAL_TEST_USER_DATA
 from .logger_for_pytest import logger
 
+settings = get_settings()
+
 pytestmark = pytest.mark.asyncio  # Добавляем маркер для всех тестов в модуле
 
 async def get_existing_chat(client: AsyncClient, headers: dict) -> int:
@@ -50,4 +65,349 @@ class TestMessages:
         message = response.json()
         assert message["text"] == message_data["text"]
         assert message["chat_id"] == chat_id
-        assert message["sender_id"] == user_id 
\ No newline at end of file
+        assert message["sender_id"] == user_id
+
+    async def test_read_receipt_single_query(self, client: AsyncClient):
+        """Тест отметки о прочтении: один запрос к БД, повторная отметка не является ошибкой"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        me_response = await client.get("/api/v1/users/me", headers=headers)
+        user = UserInDB.model_validate(me_response.json())
+        chat_id = await get_existing_chat(client, headers)
+
+        response = await client.post("/api/v1/messages/create", headers=headers, json={
+            "text": "Read receipt message",
+            "chat_id": chat_id
+        })
+        assert response.status_code == 201
+        message_id = response.json()["id"]
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+        try:
+            async with AsyncSessionFactory() as db:
+                receipt = await MessageService(db).read_message(message_id, user)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", count_statement)
+
+        assert len(statements) == 1, statements
+        assert receipt["message_id"] == message_id
+        assert user.id in receipt["read_by"]
+        assert receipt["read_count"] == len(receipt["read_by"])
+
+        # Повторная отметка через REST возвращает то же состояние
+        response = await client.post(f"/api/v1/messages/{message_id}/read", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["reader_id"] == user.id
+        assert response.json()["read_count"] == receipt["read_count"]
+
+        response = await client.post("/api/v1/messages/999999999/read", headers=headers)
+        assert response.status_code == 404
+
+    async def test_idempotent_create_single_query(self, client: AsyncClient):
+        """Тест создания сообщения: один запрос к БД, повтор и гонка по ключу возвращают одно сообщение"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        user = UserInDB.model_validate((await client.get("/api/v1/users/me", headers=headers)).json())
+        other_login = await client.post("/api/v1/auth/token", data=ADDITIONAL_TEST_USER_DATA)
+        other_headers = {"Authorization": f"Bearer {other_login.json()['access_token']}"}
+        other = UserInDB.model_validate((await client.get("/api/v1/users/me", headers=other_headers)).json())
+        other_chat_ids = {chat["id"] for chat in (await client.get("/api/v1/chats/list", headers=other_headers)).json()}
+        chat_ids = [chat["id"] for chat in (await client.get("/api/v1/chats/list", headers=headers)).json()]
+        chat_id = next(chat_id for chat_id in chat_ids if chat_id in other_chat_ids)
+
+        async def create(sender: UserInDB, key: str):
+            async with AsyncSessionFactory() as db:
+                return await MessageService(db).create_message(
+                    MessageCreate(text="Idempotent message", chat_id=chat_id, idempotency_key=key), sender
+                )
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        key = uuid.uuid4().hex
+        event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+        try:
+            message = await create(user, key)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", count_statement)
+        assert len(statements) == 1, statements
+
+        # Повтор возвращает уже созданное сообщение
+        assert (await create(user, key)).id == message.id
+
+        # Конкурентные отправки с одним ключом не дают дублей и ошибок
+        race_key = uuid.uuid4().hex
+        raced = await asyncio.gather(*(create(user, race_key) for _ in range(5)))
+        assert len({m.id for m in raced}) == 1
+
+        # Ключи уникальны в пределах отправителя
+        assert (await create(other, key)).id != message.id
+
+        response = await client.post("/api/v1/messages/create", headers=headers, json={
+            "text": "Idempotent message",
+            "chat_id": chat_id,
+            "idempotency_key": key
+        })
+        assert response.status_code == 201
+        assert response.json()["id"] == message.id
+
+        # Конкурентные повторы пачки идут тем же INSERT ... ON CONFLICT: без ошибок и дублей
+        batch_keys = [uuid.uuid4().hex, uuid.uuid4().hex]
+
+        async def create_batch():
+            async with AsyncSessionFactory() as db:
+                created, _ = await MessageService(db).apply_batch([
+                    MessageCreate(text="Batch message", chat_id=chat_id, idempotency_key=batch_keys[0]),
+                    MessageCreate(text="Batch message", chat_id=chat_id, idempotency_key=batch_keys[1]),
+                    MessageCreate(text="Batch message", chat_id=chat_id, idempotency_key=batch_keys[0])
+                ], [], user)
+                return created
+
+        batches = await asyncio.gather(*(create_batch() for _ in range(5)))
+        ids = {tuple(m.id for m in batch) for batch in batches}
+        assert len(ids) == 1
+        first, second, repeated = ids.pop()
+        assert first == repeated and first != second
+
+    async def test_idempotency_key_pruning(self, client: AsyncClient):
+        """Тест фоновой очистки: ключи старше IDEMPOTENCY_KEY_TTL_HOURS очищаются, свежие остаются"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        chat_id = await get_existing_chat(client, headers)
+
+        message_ids = []
+        for _ in range(2):
+            response = await client.post("/api/v1/messages/create", headers=headers, json={
+                "text": "Keyed message",
+                "chat_id": chat_id,
+                "idempotency_key": uuid.uuid4().hex
+            })
+            message_ids.append(response.json()["id"])
+        old_id, fresh_id = message_ids
+
+        async with AsyncSessionFactory() as db:
+            await db.execute(
+                update(Message)
+                .where(Message.id == old_id)
+                .values(created_at=func.now() - func.make_interval(0, 0, 0, 0, settings.IDEMPOTENCY_KEY_TTL_HOURS + 1))
+            )
+            await db.commit()
+
+        async def keys() -> dict:
+            async with AsyncSessionFactory() as db:
+                rows = await db.execute(select(Message.id, Message.idempotency_key).where(Message.id.in_(message_ids)))
+                return dict(rows.all())
+
+        pruner = IdempotencyKeyPruner(interval_minutes=60)
+        pruner.start()
+        try:
+            for _ in range(100):
+                if (await keys())[old_id] is None:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            await pruner.stop()
+        current = await keys()
+        assert current[old_id] is None
+        assert current[fresh_id] is not None
+
+    async def test_write_buffer_group_commit(self, client: AsyncClient):
+        """Тест групповой записи: один запрос на пакет, id в порядке вызовов, чужой чат не ломает пакет"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        user = UserInDB.model_validate((await client.get("/api/v1/users/me", headers=headers)).json())
+        chat_id = await get_existing_chat(client, headers)
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        buffer = MessageWriteBuffer(delay_ms=50, max_size=100)
+        event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+        try:
+            results = await asyncio.gather(
+                *(buffer.submit(MessageCreate(text=f"Buffered {index}", chat_id=chat_id), user.id) for index in range(10)),
+                buffer.submit(MessageCreate(text="Foreign chat", chat_id=999999999), user.id)
+            )
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", count_statement)
+
+        assert len(statements) == 1, statements
+        messages = [message for message, _ in results[:10]]
+        assert [message.text for message in messages] == [f"Buffered {index}" for index in range(10)]
+        assert [message.id for message in messages] == sorted(message.id for message in messages)
+        assert all(message.created_at for message in messages)
+        assert results[10] == (None, [])
+
+        # Счётчики непрочитанного отданы по чату сообщения, отправитель в них не входит
+        assert {change["chat_id"] for change in results[0][1]} == {chat_id}
+        assert user.id not in {change["user_id"] for change in results[0][1]}
+
+    async def test_write_buffer_commit_failure(self, client: AsyncClient):
+        """Тест: при сбое на commit пакет не пишется повторно по одному, вызывающие получают ошибку"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        user = UserInDB.model_validate((await client.get("/api/v1/users/me", headers=headers)).json())
+        chat_id = await get_existing_chat(client, headers)
+
+        @asynccontextmanager
+        async def commit_lost_session():
+            """Сессия, у которой commit проходит, но ответ сервера теряется"""
+            async with AsyncSessionFactory() as db:
+                commit = db.commit
+
+                async def commit_then_fail():
+                    await commit()
+                    raise ConnectionError("Connection lost after commit")
+
+                db.commit = commit_then_fail
+                yield db
+
+        text = f"Lost commit {uuid.uuid4().hex}"
+        buffer = MessageWriteBuffer(session_factory=commit_lost_session, delay_ms=50, max_size=100)
+        results = await asyncio.gather(
+            *(buffer.submit(MessageCreate(text=text, chat_id=chat_id), user.id) for _ in range(3)),
+            return_exceptions=True
+        )
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+        async with AsyncSessionFactory() as db:
+            written = await db.scalar(select(func.count()).select_from(Message).where(Message.text == text))
+        assert written == 3
+
+    async def test_query_budget(self, client: AsyncClient):
+        """Тест бюджета запросов: X-Query-Count у эндпоинтов сообщений и ошибка при превышении лимита"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        chat_id = await get_existing_chat(client, headers)
+
+        # Пользователь токена, проверка членства, вставка одним запросом
+        response = await client.post("/api/v1/messages/create", headers=headers, json={
+            "text": "Budget message",
+            "chat_id": chat_id
+        })
+        assert int(response.headers["X-Query-Count"]) <= 2
+        message_id = response.json()["id"]
+
+        # Сообщение без неявной загрузки отправителя, чата и его истории
+        response = await client.get(f"/api/v1/messages/{message_id}", headers=headers)
+        assert response.status_code == 200
+        assert int(response.headers["X-Query-Count"]) <= 3
+
+        response = await client.get(f"/api/v1/messages/chat/{chat_id}/history", headers=headers)
+        assert response.status_code == 200
+        assert int(response.headers["X-Query-Count"]) <= 4
+
+        with pytest.raises(QueryBudgetExceeded):
+            with QueryBudget("two lookups", limit=1):
+                async with AsyncSessionFactory() as db:
+                    service = MessageService(db)
+                    for _ in range(2):
+                        await service.repository.get_by_id(message_id)
+
+    async def test_history_keyset_pagination(self, client: AsyncClient):
+        """Тест истории чата по курсору: страницы без пропусков и повторов, has_more по limit + 1"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        chat_id = await get_existing_chat(client, headers)
+
+        created = []
+        for index in range(5):
+            response = await client.post("/api/v1/messages/create", headers=headers, json={
+                "text": f"History message {index}",
+                "chat_id": chat_id
+            })
+            assert response.status_code == 201
+            created.append(response.json()["id"])
+        newest_first = created[::-1]
+
+        url = f"/api/v1/messages/chat/{chat_id}/history"
+        page1 = (await client.get(url, headers=headers, params={"limit": 2})).json()
+        assert [m["id"] for m in page1["messages"]] == newest_first[:2]
+        assert page1["has_more"] is True
+
+        page2 = (await client.get(url, headers=headers, params={
+            "limit": 2, "before": page1["before_cursor"]
+        })).json()
+        assert [m["id"] for m in page2["messages"]] == newest_first[2:4]
+
+        # Прокрутка вперёд от второй страницы возвращает первую
+        newer = (await client.get(url, headers=headers, params={
+            "limit": 2, "after": page2["after_cursor"]
+        })).json()
+        assert [m["id"] for m in newer["messages"]] == newest_first[:2]
+        assert newer["has_more"] is False
+
+        response = await client.get(url, headers=headers, params={"before": "not-a-cursor"})
+        assert response.status_code == 400
+
+    async def test_history_window_around_message_and_date(self, client: AsyncClient):
+        """Тест окна истории вокруг сообщения и вокруг даты"""
+        login_response = await client.post("/api/v1/auth/token", data={
+            "username": AUTH_USER_DATA["email"],
+            "password": AUTH_USER_DATA["password"]
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        chat_id = await get_existing_chat(client, headers)
+
+        created = []
+        for index in range(7):
+            response = await client.post("/api/v1/messages/create", headers=headers, json={
+                "text": f"Window message {index}",
+                "chat_id": chat_id
+            })
+            created.append(response.json())
+
+        url = f"/api/v1/messages/chat/{chat_id}/history/around"
+        target = created[3]
+        window = (await client.get(url, headers=headers, params={
+            "message_id": target["id"], "limit": 4
+        })).json()
+        # Цель и одно сообщение новее, два старше; порядок от новых к старым
+        assert [m["id"] for m in window["messages"]] == [created[4]["id"], created[3]["id"], created[2]["id"], created[1]["id"]]
+        assert window["anchor_id"] == target["id"]
+        assert window["has_newer"] is True
+        assert window["has_more"] is True
+
+        by_date = (await client.get(url, headers=headers, params={
+            "at": target["created_at"], "limit": 4
+        })).json()
+        assert by_date["anchor_id"] == target["id"]
+
+        # Курсор края окна продолжает прокрутку вперёд
+        newer = (await client.get(f"/api/v1/messages/chat/{chat_id}/history", headers=headers, params={
+            "after": window["after_cursor"], "limit": 10
+        })).json()
+        assert [m["id"] for m in newer["messages"]] == [created[6]["id"], created[5]["id"]]
+
+        response = await client.get(url, headers=headers, params={"message_id": 999999999})
+        assert response.status_code == 404
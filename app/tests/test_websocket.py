@@ -3,12 +3,23 @@ import websockets
 import json
 import aiohttp
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 import pytest
 from httpx import AsyncClient
 import uuid
 from fastapi.testclient import TestClient
 from main import app  # Импортируем основное приложение
+from src.config import get_settings
+from src.core.db import session_scope
+from src.core.pg_listener import get_pg_listener, PgListener
+from src.features.users.repositories import PresenceRepository
+from src.features.websocket.bus import BroadcastBus, PostgresBus
+from src.features.websocket.session_manager import WebSocketSessionManager
+from src.features.websocket.presence import PresenceTracker, IDLE_CLOSE_CODE
+from src.features.websocket.message_handler import WebSocketMessageHandler
+from src.features.websocket.dependencies import websocket_manager
+from src.features.chats.membership_cache import membership_cache
+from src.features.users.schemas import UserInDB
 
 from .logger_for_pytest import logger
 
@@ -52,6 +63,15 @@ async def connect_websocket(token: str, chat_id: int) -> websockets.WebSocketCli
         logger.error(f"WebSocket connection failed: {str(e)}")
         raise
 
+async def connect_user_websocket(token: str) -> websockets.WebSocketClientProtocol:
+    """Подключение к мультиплексированному WebSocket пользователя"""
+    return await websockets.connect(
+        "ws://localhost:8000/api/v1/websocket/user",
+        additional_headers={"Authorization": f"Bearer {token}"},
+        open_timeout=5,
+        close_timeout=5
+    )
+
 async def send_and_receive_message(websocket: websockets.WebSocketClientProtocol, chat_id: int) -> dict:
     """Отправка сообщения и получение ответа"""
     try:
@@ -64,9 +84,13 @@ async def send_and_receive_message(websocket: websockets.WebSocketClientProtocol
         }
         await websocket.send(json.dumps(message))
         
-        # Ждем ответ с таймаутом
-        response = await asyncio.wait_for(websocket.recv(), timeout=5)
-        return json.loads(response)
+        # Ждем ответ с таймаутом (события чата, например presence, пропускаем)
+        async def _receive():
+            while True:
+                response = json.loads(await websocket.recv())
+                if "response_type" in response:
+                    return response
+        return await asyncio.wait_for(_receive(), timeout=5)
         
     except asyncio.TimeoutError:
         logger.error("Timeout waiting for WebSocket response")
@@ -81,6 +105,27 @@ def generate_idempotency_key() -> str:
     unique_id = str(uuid.uuid4())
     return f"{timestamp}-{unique_id}"
 
+class FakeWebSocket:
+    """Заглушка серверного WebSocket для тестов менеджера сессий без сервера"""
+    def __init__(self):
+        self.frames = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.frames.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+    def presence_changes(self) -> list[dict]:
+        return [
+            change for frame in self.frames if frame["message_type"] == "presence"
+            for change in frame["changes"]
+        ]
+
 async def wait_for_type(ws, field: str, expected_type: str, timeout: float = 5.0):
     """Получение сообщения с ожидаемым типом"""
     async def _receive():
@@ -221,9 +266,8 @@ class TestWebSocket:
             }
             await ws1.send(json.dumps(read_status))
             
-            # Получаем подтверждение о прочтении
-            read_notification = await ws1.recv()
-            read_data = json.loads(read_notification)
+            # Получаем подтверждение о прочтении (кадры unread со счётчиками пропускаем)
+            read_data = await wait_for_type(ws1, "response_type", "read_status")
             logger.info(f"Received read status response: {read_data}")  # Добавляем логирование
 
             # Проверяем корректность ответа
@@ -271,7 +315,7 @@ class TestWebSocket:
 
 
 
-            response2 = json.loads(await ws2.recv())
+            response2 = await wait_for_type(ws2, "message_type", "new_message")
             logger.info(f"User 2 received message: {response2}")
 
             assert response2["message_type"] == "new_message"  # Тот же тип для всех
@@ -288,12 +332,12 @@ class TestWebSocket:
 
             }))
             logger.info(f"Чек 2")
-            message2 = json.loads(await ws2.recv())
+            message2 = await wait_for_type(ws2, "response_type", "new_message")
 
             logger.info(f"User 2 sent message: {message2}")
             logger.info(f"Чек 3")
             # Получаем ответ первым пользователем
-            response3 = json.loads(await ws1.recv())
+            response3 = await wait_for_type(ws1, "message_type", "new_message")
             logger.info(f"User 1 received new message notification: {response3}")
             assert response3["message_type"] == "new_message"
             assert response3["text"] == reply_message
@@ -306,7 +350,7 @@ class TestWebSocket:
             logger.info("User 1 sending read status")
             # Отправляем статус прочтения
             await asyncio.sleep(0.5)
-            read_status = json.loads(await ws2.recv())
+            read_status = await wait_for_type(ws2, "message_type", "read_status")
             # Даем время на обработку статуса прочтения
 
             
@@ -356,7 +400,7 @@ class TestWebSocket:
             assert response2["message_type"] == "new_message"
             assert response2["text"] == initial_message
             
-            response3 = json.loads(await ws3.recv())
+            response3 = await wait_for_type(ws3, "message_type", "new_message")
             logger.info(f"User 3 received message: {response3}")
             assert response3["message_type"] == "new_message"
             assert response3["text"] == initial_message
@@ -370,16 +414,16 @@ class TestWebSocket:
                 "idempotency_key": generate_idempotency_key()
             }))
             
-            message2 = json.loads(await ws2.recv())
+            message2 = await wait_for_type(ws2, "response_type", "new_message")
             logger.info(f"User 2 sent message: {message2}")
             
             # Первый и третий получают ответ
-            response1 = json.loads(await ws1.recv())
+            response1 = await wait_for_type(ws1, "message_type", "new_message")
             logger.info(f"User 1 received response after sending: {response1}")
             assert response1["message_type"] == "new_message"
             assert response1["text"] == reply1
             
-            response3 = json.loads(await ws3.recv())
+            response3 = await wait_for_type(ws3, "message_type", "new_message")
             logger.info(f"User 3 received response after sending: {response3}")
             assert response3["message_type"] == "new_message"
             assert response3["text"] == reply1
@@ -396,7 +440,7 @@ class TestWebSocket:
             # Все получают обновления статусов
             await asyncio.sleep(0.1)  # Даем время на обработку
             for _ in range(2):  # Ожидаем два статуса прочтения
-                status_update = json.loads(await ws2.recv())
+                status_update = await wait_for_type(ws2, "message_type", "read_status")
                 logger.info(f"Received status update: {status_update}")
                 assert status_update["message_type"] == "read_status"
                 assert status_update["message_id"] == message2["message_id"]
@@ -431,7 +475,7 @@ class TestWebSocket:
             }))
 
             # Получаем ответ на первом устройстве
-            response1 = json.loads(await ws1.recv())
+            response1 = await wait_for_type(ws1, "response_type", "new_message")
             logger.info(f"Device 1 received response after sending: {response1}")
             assert response1["response_type"] == "new_message"
             assert response1["text"] == test_message
@@ -446,7 +490,7 @@ class TestWebSocket:
             }))
 
             # Получаем ответ на втором устройстве
-            response2 = json.loads(await ws2.recv())
+            response2 = await wait_for_type(ws2, "response_type", "new_message")
             logger.info(f"Device 2 received response after sending: {response2}")
             assert response2["response_type"] == "new_message"
             assert response2["text"] == second_message
@@ -460,7 +504,7 @@ class TestWebSocket:
 
             # Проверяем, что статус прочтения получен на всех устройствах
             await asyncio.sleep(0.1)  # Даем время на обработку
-            read_status = json.loads(await ws3.recv())
+            read_status = await wait_for_type(ws3, "response_type", "read_status")
             logger.info(f"Device 3 received confirmation of read status: {read_status}")
             assert read_status["response_type"] == "read_status"
             assert read_status["message_id"] == response2["message_id"]
@@ -479,40 +523,45 @@ class TestWebSocket:
         token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
         chat_id = 1
 
-        # Подключаем первого пользователя
+        user2_id = (await client.get(
+            "/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"}
+        )).json()["id"]
+
+        async def wait_for_user_presence(ws, timeout: float) -> dict:
+            """Ожидание кадра presence со сменой статуса второго пользователя"""
+            async def _receive():
+                while True:
+                    msg = json.loads(await ws.recv())
+                    if msg.get("message_type") != "presence":
+                        continue
+                    for change in msg["changes"]:
+                        if change["user_id"] == user2_id:
+                            return change
+            return await asyncio.wait_for(_receive(), timeout)
+
+        # Подключаем обоих пользователей
         ws1 = await connect_websocket(token1, chat_id)
         
         try:
-            # Ждем немного, чтобы первый пользователь получил статус "онлайн"
-            await asyncio.sleep(0.1)
-            
-            # Подключаем второго пользователя
             ws2 = await connect_websocket(token2, chat_id)
-
             logger.info("User 2 connected")
-            # Первый пользователь должен получить уведомление о подключении второго
-            status_notification = json.loads(await ws1.recv())
-            logger.info(f"User 1 received status notification: {status_notification}")
-            assert status_notification["message_type"] == "user_status"
-            assert status_notification["status"] == "online"
+
+            # "online" приходит пакетом, если второй пользователь не был онлайн в пределах grace period
+            try:
+                status_notification = await wait_for_user_presence(ws1, timeout=1)
+                logger.info(f"User 1 received status notification: {status_notification}")
+                assert status_notification["status"] == "online"
+            except asyncio.TimeoutError:
+                pass
             
-            # Отключаем второго пользователя
+            # Быстрое переподключение второго пользователя укладывается в grace period
             await ws2.close()
-            
-            # Первый пользователь должен получить уведомление об отключении второго
-            offline_notification = json.loads(await ws1.recv())
-            logger.info(f"User 1 received offline notification: {offline_notification}")
-            assert offline_notification["message_type"] == "user_status"
-            assert offline_notification["status"] == "offline"
-
-            # Подключаем второго пользователя снова
             ws2 = await connect_websocket(token2, chat_id)
-            
-            # Проверяем получение уведомления о повторном подключении
-            online_again_notification = json.loads(await ws1.recv())
-            logger.info(f"User 1 received online notification: {online_again_notification}")
-            assert online_again_notification["message_type"] == "user_status"
-            assert online_again_notification["status"] == "online"
+
+            # Первый пользователь не должен получить ни offline, ни повторный online
+            with pytest.raises(asyncio.TimeoutError):
+                notification = await wait_for_user_presence(ws1, timeout=1.5)
+                logger.info(f"Unexpected presence notification: {notification}")
 
         finally:
             # Закрываем все соединения
@@ -521,3 +570,829 @@ class TestWebSocket:
             if 'ws2' in locals():
                 await ws2.close()
 
+
+    @pytest.mark.asyncio
+    async def test_send_queue_stats(self, client: AsyncClient):
+        """Тест статистики исходящих очередей WebSocket соединений"""
+        token = await get_auth_token(client, VALID_LOGIN_DATA)
+        chat_id = 1
+
+        ws = await connect_websocket(token, chat_id)
+        try:
+            response_data = await send_and_receive_message(ws, chat_id)
+            assert response_data["response_type"] == "new_message"
+
+            async with aiohttp.ClientSession() as http:
+                async with http.get(
+                    "http://localhost:8000/api/v1/websocket/stats",
+                    headers={"Authorization": f"Bearer {token}"}
+                ) as response:
+                    assert response.status == 200
+                    stats = await response.json()
+
+            logger.info(f"Send queue stats: {stats}")
+            assert stats["connections"] >= 1
+            assert stats["sent_frames"] >= 1
+            assert stats["max_queue_depth"] >= 0
+            assert stats["policy"] in ("drop_oldest", "coalesce", "disconnect")
+        finally:
+            await ws.close()
+
+    @pytest.mark.asyncio
+    async def test_multiplexed_user_connection(self, client: AsyncClient):
+        """Тест одного соединения пользователя с подпиской на чаты"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        chat_id = 1
+        foreign_chat_id = 999999
+
+        user_ws = await connect_user_websocket(token2)
+        chat_ws = await connect_websocket(token1, chat_id)
+        try:
+            await user_ws.send(json.dumps({
+                "message_type": "subscribe",
+                "chat_ids": [chat_id, foreign_chat_id]
+            }))
+            subscribed = await wait_for_type(user_ws, "response_type", "subscribe")
+            assert subscribed["chat_ids"] == [chat_id]
+            assert subscribed["rejected"] == [foreign_chat_id]
+
+            # Событие чата приходит в мультиплексированное соединение
+            await chat_ws.send(json.dumps({
+                "message_type": "new_message",
+                "chat_id": chat_id,
+                "text": "Сообщение для подписчика",
+                "idempotency_key": generate_idempotency_key()
+            }))
+            notification = await wait_for_type(user_ws, "message_type", "new_message")
+            assert notification["chat_id"] == chat_id
+            assert notification["text"] == "Сообщение для подписчика"
+
+            # Отправка в чат через мультиплексированное соединение
+            await user_ws.send(json.dumps({
+                "message_type": "new_message",
+                "chat_id": chat_id,
+                "text": "Ответ через одно соединение",
+                "idempotency_key": generate_idempotency_key()
+            }))
+            response = await wait_for_type(user_ws, "response_type", "new_message")
+            assert response["chat_id"] == chat_id
+            received = await wait_for_type(chat_ws, "message_type", "new_message")
+            assert received["text"] == "Ответ через одно соединение"
+
+            # Кадр в чат без подписки отклоняется, но соединение остаётся открытым
+            await user_ws.send(json.dumps({
+                "message_type": "new_message",
+                "chat_id": foreign_chat_id,
+                "text": "Чужой чат",
+                "idempotency_key": generate_idempotency_key()
+            }))
+            error = await wait_for_type(user_ws, "response_type", "error")
+            assert "detail" in error
+
+            await user_ws.send(json.dumps({"message_type": "unsubscribe", "chat_ids": [chat_id]}))
+            unsubscribed = await wait_for_type(user_ws, "response_type", "unsubscribe")
+            assert unsubscribed["chat_ids"] == []
+        finally:
+            await user_ws.close()
+            await chat_ws.close()
+
+    @pytest.mark.asyncio
+    async def test_cross_process_broadcast_bus(self):
+        """Тест доставки событий между процессами через Postgres LISTEN/NOTIFY"""
+        dsn = get_pg_listener().dsn
+        channel = f"ws_events_test_{uuid.uuid4().hex[:8]}"
+        node_a = PostgresBus(PgListener(dsn), channel=channel, flush_ms=1)
+        node_b = PostgresBus(PgListener(dsn), channel=channel, flush_ms=1)
+
+        delivered_a, delivered_b, delivered_b_users, delivered_b_members = [], [], [], []
+        node_a.set_handler(lambda *event: delivered_a.append(event))
+        node_b.set_handler(lambda *event: delivered_b.append(event))
+        node_b.set_user_handler(lambda *event: delivered_b_users.append(event))
+        node_b.set_member_handler(lambda *event: delivered_b_members.append(event))
+
+        await node_a.start()
+        await node_b.start()
+        try:
+            big_frame = json.dumps({"message_type": "new_message", "text": "x" * 20000})
+            await node_a.publish(1, '{"message_type":"ping"}', 5, "key:1")
+            await node_a.publish(1, big_frame, 5)
+            await node_a.publish_to_user(7, '{"message_type":"unread"}', "unread:1")
+            await node_a.publish_to_member(1, 7, '{"message_type":"presence"}')
+
+            for _ in range(100):
+                if len(delivered_b) == 2 and delivered_b_users and delivered_b_members:
+                    break
+                await asyncio.sleep(0.05)
+
+            # Локальные соединения получают событие сразу и ровно один раз
+            assert len(delivered_a) == 2
+            assert delivered_b == [
+                (1, '{"message_type":"ping"}', 5, "key:1"),
+                (1, big_frame, 5, None)
+            ]
+            # Адресные события пользователю доставляются его соединениям на других процессах
+            assert delivered_b_users == [(7, '{"message_type":"unread"}', "unread:1")]
+            # Адресные события участнику чата - только его соединениям в этом чате
+            assert delivered_b_members == [(1, 7, '{"message_type":"presence"}', None)]
+        finally:
+            await node_a.stop()
+            await node_b.stop()
+
+    @pytest.mark.asyncio
+    async def test_broadcast_bus_partials_bounded(self):
+        """Тест шины: части потерянных уведомлений не копятся, а шина без publish_* не создаётся"""
+        with pytest.raises(TypeError):
+            BroadcastBus()
+
+        node = PostgresBus(PgListener(get_pg_listener().dsn), partials_size=2)
+        delivered = []
+        node.set_handler(lambda *event: delivered.append(event))
+
+        # Вторые части событий 0..4 так и не пришли
+        for n in range(5):
+            node._on_part(("c", 1), [f"lost-{n}", None, None, 0, 2, "{"])
+        assert list(node._partials) == ["lost-3", "lost-4"]
+
+        node._on_part(("c", 1), ["whole", None, None, 1, 2, "}"])
+        node._on_part(("c", 1), ["whole", None, None, 0, 2, "{"])
+        assert delivered == [(1, "{}", None, None)]
+        assert list(node._partials) == ["lost-4"]
+
+    @pytest.mark.asyncio
+    async def test_broadcast_bus_publish_during_flush(self):
+        """Тест шины: событие, опубликованное во время отправки пачки, тоже доходит до другого процесса"""
+        dsn = get_pg_listener().dsn
+        channel = f"ws_events_test_{uuid.uuid4().hex[:8]}"
+        node_a = PostgresBus(PgListener(dsn), channel=channel, flush_ms=1)
+        node_b = PostgresBus(PgListener(dsn), channel=channel, flush_ms=1)
+
+        delivered_b = []
+        node_a.set_handler(lambda *event: None)
+        node_b.set_handler(lambda *event: delivered_b.append(event))
+
+        # Первая отправка NOTIFY задерживается, чтобы следующая публикация пришлась на неё
+        in_flight = asyncio.Event()
+        notify = node_a.listener.notify
+
+        async def slow_notify(channel: str, payload: str) -> None:
+            if not in_flight.is_set():
+                in_flight.set()
+                await asyncio.sleep(0.2)
+            await notify(channel, payload)
+
+        node_a.listener.notify = slow_notify
+        await node_a.start()
+        await node_b.start()
+        try:
+            await node_a.publish(1, '{"n":1}', None)
+            await asyncio.wait_for(in_flight.wait(), 5)
+            await node_a.publish(1, '{"n":2}', None)
+
+            for _ in range(100):
+                if len(delivered_b) == 2:
+                    break
+                await asyncio.sleep(0.05)
+            assert [frame for _, frame, _, _ in delivered_b] == ['{"n":1}', '{"n":2}']
+        finally:
+            await node_a.stop()
+            await node_b.stop()
+
+    @pytest.mark.asyncio
+    async def test_idle_connections_release_db_pool(self, client: AsyncClient):
+        """Открытые WebSocket соединения не удерживают соединения из пула БД"""
+        token = await get_auth_token(client, VALID_LOGIN_DATA)
+        chat_id = 1
+        # Больше, чем pool_size + max_overflow по умолчанию (5 + 10)
+        sockets = []
+        try:
+            for _ in range(20):
+                sockets.append(await connect_websocket(token, chat_id))
+
+            async with aiohttp.ClientSession() as http:
+                async with http.get(
+                    "http://localhost:8000/api/v1/chats/list",
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=aiohttp.ClientTimeout(total=5)
+                ) as response:
+                    assert response.status == 200
+
+            response_data = await send_and_receive_message(sockets[-1], chat_id)
+            assert response_data["response_type"] == "new_message"
+        finally:
+            for ws in sockets:
+                await ws.close()
+
+    @pytest.mark.asyncio
+    async def test_presence_query(self, client: AsyncClient):
+        """Тест запроса присутствия списка пользователей"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        headers = {"Authorization": f"Bearer {token1}"}
+        user2_id = (await client.get(
+            "/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"}
+        )).json()["id"]
+
+        async def query_presence(http: aiohttp.ClientSession) -> dict:
+            async with http.post(
+                "http://localhost:8000/api/v1/websocket/presence",
+                headers=headers,
+                json={"user_ids": [user2_id]}
+            ) as response:
+                assert response.status == 200
+                return (await response.json())["users"][0]
+
+        async with aiohttp.ClientSession() as http:
+            ws2 = await connect_user_websocket(token2)
+            try:
+                presence = await query_presence(http)
+                assert presence["user_id"] == user2_id
+                assert presence["online"] is True
+            finally:
+                await ws2.close()
+
+            # Ждём пакетную запись присутствия после отключения
+            await asyncio.sleep(3)
+            presence = await query_presence(http)
+            # С межпроцессной шиной инстанс не знает о соединениях на других,
+            # поэтому онлайн истекает только через TTL после последнего продления
+            multi_instance = get_settings().WS_BROADCAST_BACKEND == "postgres"
+            assert presence["online"] is multi_instance
+            assert presence["last_seen_at"] is not None
+
+    @pytest.mark.asyncio
+    async def test_presence_lease_across_instances(self, client: AsyncClient):
+        """Тест: уход с одного инстанса не сокращает онлайн, продлённый другим"""
+        token = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA_2)
+        user_id = (await client.get(
+            "/api/v1/users/me", headers={"Authorization": f"Bearer {token}"}
+        )).json()["id"]
+
+        def tracker(single_instance: bool) -> PresenceTracker:
+            return PresenceTracker(
+                ping_interval=1, idle_timeout=1, flush_interval=1, online_ttl=60,
+                session_factory=session_scope, single_instance=single_instance
+            )
+
+        async def online_until() -> datetime:
+            async with session_scope() as db:
+                return (await PresenceRepository(db).get_many([user_id]))[user_id][1]
+
+        # Пользователь подключён к двум инстансам, оба продлили онлайн
+        node_a, node_b = tracker(False), tracker(False)
+        ws_a, ws_b = FakeWebSocket(), FakeWebSocket()
+        node_a.add(ws_a, user_id)
+        node_b.add(ws_b, user_id)
+        await node_b.flush()
+        await node_a.flush()
+
+        # Последний сокет на инстансе A закрыт, на B соединение осталось
+        node_a.remove(ws_a, last_socket=True)
+        await node_a.flush()
+        assert await online_until() > datetime.now(timezone.utc)
+
+        # Единственный инстанс знает обо всех соединениях: уход сразу офлайн
+        single, ws = tracker(True), FakeWebSocket()
+        single.add(ws, user_id)
+        single.remove(ws, last_socket=True)
+        await single.flush()
+        assert await online_until() <= datetime.now(timezone.utc)
+
+    @pytest.mark.asyncio
+    async def test_idle_connection_reaped(self):
+        """Тест ping молчащих соединений и закрытия мёртвых"""
+        manager = WebSocketSessionManager(
+            presence=PresenceTracker(ping_interval=0.1, idle_timeout=0.4, flush_interval=1, online_ttl=1),
+            presence_grace_seconds=0,
+            presence_batch_ms=50
+        )
+        alive, dead = FakeWebSocket(), FakeWebSocket()
+        await manager.handle_connection(alive, 1, 1)
+        await manager.handle_connection(dead, 1, 2)
+        await manager.start()
+        try:
+            for _ in range(10):
+                await asyncio.sleep(0.1)
+                manager.touch(alive)  # Живой клиент отвечает на ping
+
+            assert any(frame["message_type"] == "ping" for frame in dead.frames)
+            assert dead.close_code == IDLE_CLOSE_CODE
+            assert alive.close_code is None
+            assert manager.get_active_users(1) == [1]
+            # Живой клиент получил уведомление об уходе мёртвого
+            assert {"user_id": 2, "status": "offline"} in alive.presence_changes()
+        finally:
+            await manager.handle_disconnection(alive, 1, 1)
+            await manager.stop()
+
+    @pytest.mark.asyncio
+    async def test_presence_debounce(self):
+        """Тест отложенной и пакетной рассылки смены статусов"""
+        manager = WebSocketSessionManager(presence_grace_seconds=0.5, presence_batch_ms=50)
+        observer = FakeWebSocket()
+        await manager.handle_connection(observer, 1, 1)
+        await asyncio.sleep(0.1)
+
+        # Соединение пользователя 2 с другим чатом присутствие чата 1 не получает
+        other_chat_ws2 = FakeWebSocket()
+        await manager.handle_connection(other_chat_ws2, 2, 2)
+
+        # Несколько подключений в одном окне - один кадр со всеми изменениями
+        ws2, ws3 = FakeWebSocket(), FakeWebSocket()
+        await manager.handle_connection(ws2, 1, 2)
+        await manager.handle_connection(ws3, 1, 3)
+        await asyncio.sleep(0.2)
+        presence_frames = [frame for frame in observer.frames if frame["message_type"] == "presence"]
+        assert len(presence_frames) == 1
+        assert presence_frames[0]["changes"] == [
+            {"user_id": 2, "status": "online"},
+            {"user_id": 3, "status": "online"}
+        ]
+        # Участники пачки не получают собственный статус, только изменения остальных
+        assert ws2.presence_changes() == [{"user_id": 3, "status": "online"}]
+        assert ws3.presence_changes() == [{"user_id": 2, "status": "online"}]
+        assert not [frame for frame in other_chat_ws2.frames if frame.get("chat_id") == 1]
+
+        # Переподключение в пределах grace period не порождает кадров
+        await manager.handle_disconnection(ws2, 1, 2)
+        ws2 = FakeWebSocket()
+        await manager.handle_connection(ws2, 1, 2)
+
+        # Уход без возвращения - "offline" после grace period
+        await manager.handle_disconnection(ws3, 1, 3)
+        await asyncio.sleep(0.3)
+        assert len(observer.presence_changes()) == 2
+        await asyncio.sleep(0.5)
+        assert observer.presence_changes()[2:] == [{"user_id": 3, "status": "offline"}]
+
+        for websocket, user_id in ((observer, 1), (ws2, 2)):
+            await manager.handle_disconnection(websocket, 1, user_id)
+        await manager.handle_disconnection(other_chat_ws2, 2, 2)
+        await manager.stop()
+
+
+    @pytest.mark.asyncio
+    async def test_catch_up_on_reconnect(self, client: AsyncClient):
+        """Тест догонки пропущенных событий по курсору при переподключении"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        chat_id = 1
+
+        ws1 = await connect_websocket(token1, chat_id)
+        try:
+            sent = []
+            for index in range(3):
+                response = await send_and_receive_message(ws1, chat_id)
+                assert response["response_type"] == "new_message"
+                sent.append(response["message_id"])
+
+            # Второй пользователь был офлайн и видел только первое сообщение
+            ws2 = await websockets.connect(
+                f"ws://localhost:8000/api/v1/websocket/chat/{chat_id}?last_message_id={sent[0]}",
+                additional_headers={"Authorization": f"Bearer {token2}"},
+                open_timeout=5,
+                close_timeout=5
+            )
+            try:
+                catch_up = json.loads(await asyncio.wait_for(ws2.recv(), timeout=5))
+                assert catch_up["message_type"] == "catch_up"
+                assert catch_up["chat_id"] == chat_id
+                assert catch_up["final"] is True
+                assert catch_up["truncated"] is False
+                assert [m["message_id"] for m in catch_up["messages"]] == sent[1:]
+                assert all("read_by" in m for m in catch_up["messages"])
+
+                # После догонки соединение получает живые события
+                response = await send_and_receive_message(ws1, chat_id)
+                live = await wait_for_type(ws2, "message_type", "new_message")
+                assert live["message_id"] == response["message_id"]
+            finally:
+                await ws2.close()
+
+            # Мультиплексированное соединение догоняет чаты из подписки
+            user_ws = await connect_user_websocket(token2)
+            try:
+                await user_ws.send(json.dumps({
+                    "message_type": "subscribe",
+                    "chat_ids": [chat_id],
+                    "cursors": {str(chat_id): sent[1]}
+                }))
+                subscribed = json.loads(await asyncio.wait_for(user_ws.recv(), timeout=5))
+                assert subscribed["response_type"] == "subscribe"
+                catch_up = json.loads(await asyncio.wait_for(user_ws.recv(), timeout=5))
+                assert catch_up["message_type"] == "catch_up"
+                assert [m["message_id"] for m in catch_up["messages"]] == [sent[2], response["message_id"]]
+            finally:
+                await user_ws.close()
+        finally:
+            await ws1.close()
+
+    @pytest.mark.asyncio
+    async def test_pipelined_frames_with_request_ids(self, client: AsyncClient):
+        """Тест конвейерной обработки кадров с корреляцией по request_id"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        chat_id = 1
+
+        ws1 = await connect_websocket(token1, chat_id)
+        ws2 = await connect_websocket(token2, chat_id)
+        try:
+            # Пачка новых сообщений без ожидания ответов - порядок в чате сохраняется
+            for index in range(5):
+                await ws1.send(json.dumps({
+                    "message_type": "new_message",
+                    "chat_id": chat_id,
+                    "text": f"Сообщение {index}",
+                    "idempotency_key": generate_idempotency_key(),
+                    "request_id": f"msg-{index}"
+                }))
+            responses = [await wait_for_type(ws1, "response_type", "new_message") for _ in range(5)]
+            by_request = {r["request_id"]: r for r in responses}
+            assert set(by_request) == {f"msg-{index}" for index in range(5)}
+            message_ids = [by_request[f"msg-{index}"]["message_id"] for index in range(5)]
+            assert message_ids == sorted(message_ids)
+            assert [by_request[f"msg-{index}"]["text"] for index in range(5)] == [
+                f"Сообщение {index}" for index in range(5)
+            ]
+
+            received = [await wait_for_type(ws2, "message_type", "new_message") for _ in range(5)]
+            assert [m["message_id"] for m in received] == message_ids
+
+            # Пачка статусов прочтения обрабатывается параллельно, ответы сопоставляются по request_id
+            for message_id in message_ids:
+                await ws2.send(json.dumps({
+                    "message_type": "read_status",
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "request_id": f"read-{message_id}"
+                }))
+            read_responses = [await wait_for_type(ws2, "response_type", "read_status") for _ in message_ids]
+            assert {r["request_id"] for r in read_responses} == {f"read-{m}" for m in message_ids}
+            for response in read_responses:
+                assert response["request_id"] == f"read-{response['message_id']}"
+
+            # Ошибка в кадре возвращается с его request_id и не закрывает соединение
+            await ws2.send(json.dumps({
+                "message_type": "read_status",
+                "chat_id": chat_id,
+                "message_id": 999999999,
+                "request_id": "read-missing"
+            }))
+            error = await wait_for_type(ws2, "response_type", "error")
+            assert error["request_id"] == "read-missing"
+            response_data = await send_and_receive_message(ws2, chat_id)
+            assert response_data["response_type"] == "new_message"
+        finally:
+            await ws1.close()
+            await ws2.close()
+
+    @pytest.mark.asyncio
+    async def test_batch_frames(self, client: AsyncClient):
+        """Тест пакетного кадра: одна транзакция и один ответ на весь пакет"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        chat_id = 1
+
+        ws1 = await connect_websocket(token1, chat_id)
+        ws2 = await connect_websocket(token2, chat_id)
+        try:
+            await ws1.send(json.dumps({
+                "message_type": "batch",
+                "request_id": "batch-send",
+                "operations": [
+                    {
+                        "message_type": "new_message",
+                        "chat_id": chat_id,
+                        "text": f"Пакетное сообщение {index}",
+                        "idempotency_key": generate_idempotency_key()
+                    }
+                    for index in range(3)
+                ]
+            }))
+            response = await wait_for_type(ws1, "response_type", "batch")
+            assert response["request_id"] == "batch-send"
+            assert [r["response_type"] for r in response["results"]] == ["new_message"] * 3
+            assert [r["text"] for r in response["results"]] == [f"Пакетное сообщение {index}" for index in range(3)]
+            message_ids = [r["message_id"] for r in response["results"]]
+            assert message_ids == sorted(message_ids)
+
+            received = [await wait_for_type(ws2, "message_type", "new_message") for _ in range(3)]
+            assert [m["message_id"] for m in received] == message_ids
+
+            # Статусы прочтения пакетом; повторная отметка не является ошибкой
+            await ws2.send(json.dumps({
+                "message_type": "batch",
+                "request_id": "batch-read",
+                "operations": [
+                    {"message_type": "read_status", "chat_id": chat_id, "message_id": message_id}
+                    for message_id in message_ids + message_ids[:1]
+                ]
+            }))
+            response = await wait_for_type(ws2, "response_type", "batch")
+            assert response["request_id"] == "batch-read"
+            assert [r["message_id"] for r in response["results"]] == message_ids + message_ids[:1]
+            for result in response["results"]:
+                assert result["response_type"] == "read_status"
+                assert result["reader_id"] in result["read_by"]
+
+            # Ошибка в одной операции отменяет весь пакет
+            text = f"Не должно сохраниться {uuid.uuid4()}"
+            await ws1.send(json.dumps({
+                "message_type": "batch",
+                "request_id": "batch-invalid",
+                "operations": [
+                    {
+                        "message_type": "new_message",
+                        "chat_id": chat_id,
+                        "text": text,
+                        "idempotency_key": generate_idempotency_key()
+                    },
+                    {"message_type": "read_status", "chat_id": chat_id, "message_id": 999999999}
+                ]
+            }))
+            error = await wait_for_type(ws1, "response_type", "error")
+            assert error["request_id"] == "batch-invalid"
+
+            # Получатель не видит сообщений отменённого пакета
+            response_data = await send_and_receive_message(ws1, chat_id)
+            received = await wait_for_type(ws2, "message_type", "new_message")
+            assert received["message_id"] == response_data["message_id"]
+        finally:
+            await ws1.close()
+            await ws2.close()
+
+    @pytest.mark.asyncio
+    async def test_read_watermarks(self, client: AsyncClient):
+        """Тест отметок прочтения: прочтение сообщения отмечает и все предыдущие, отметка не уменьшается"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        chat_id = 1
+
+        ws1 = await connect_websocket(token1, chat_id)
+        ws2 = await connect_websocket(token2, chat_id)
+        try:
+            sent = [(await send_and_receive_message(ws1, chat_id))["message_id"] for _ in range(3)]
+
+            async def read(ws, message_id):
+                await ws.send(json.dumps({
+                    "message_type": "read_status",
+                    "chat_id": chat_id,
+                    "message_id": message_id
+                }))
+                return await wait_for_type(ws, "response_type", "read_status")
+
+            second = await read(ws2, sent[1])
+            reader2 = second["reader_id"]
+            assert reader2 in second["read_by"]
+            assert second["read_count"] == len(second["read_by"])
+
+            # Более раннее сообщение уже прочитано, повторная отметка не сдвигает отметку назад
+            first = await read(ws2, sent[0])
+            assert reader2 in first["read_by"]
+
+            third = await read(ws1, sent[2])
+            assert third["reader_id"] in third["read_by"]
+            assert reader2 not in third["read_by"]
+            assert reader2 in (await read(ws1, sent[1]))["read_by"]
+        finally:
+            await ws1.close()
+            await ws2.close()
+
+        # Прочитавшие в кадрах catch_up вычисляются из тех же отметок
+        async with websockets.connect(
+            f"ws://localhost:8000/api/v1/websocket/chat/{chat_id}?last_message_id={sent[0] - 1}",
+            additional_headers={"Authorization": f"Bearer {token1}"}
+        ) as ws:
+            catch_up = await wait_for_type(ws, "message_type", "catch_up")
+            read_by = {m["message_id"]: m["read_by"] for m in catch_up["messages"]}
+            assert reader2 in read_by[sent[0]]
+            assert reader2 in read_by[sent[1]]
+            assert reader2 not in read_by[sent[2]]
+
+    @pytest.mark.asyncio
+    async def test_unread_counts(self, client: AsyncClient):
+        """Тест счётчиков непрочитанного: REST-выборка и рассылка в соединения пользователя"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        headers2 = {"Authorization": f"Bearer {token2}"}
+        chat_id = 1
+
+        async def unread_of_chat() -> int:
+            response = await client.get("/api/v1/chats/unread", headers=headers2)
+            assert response.status_code == 200
+            return {c["chat_id"]: c["unread_count"] for c in response.json()}[chat_id]
+
+        async def wait_for_unread(ws, expected: int) -> None:
+            async def _receive():
+                while True:
+                    frame = json.loads(await ws.recv())
+                    if frame.get("message_type") != "unread":
+                        continue
+                    counts = {c["chat_id"]: c["unread_count"] for c in frame["counts"]}
+                    if counts.get(chat_id) == expected:
+                        return
+            await asyncio.wait_for(_receive(), 5)
+
+        baseline = await unread_of_chat()
+
+        ws1 = await connect_websocket(token1, chat_id)
+        # Соединение пользователя без подписок на чаты тоже получает счётчики
+        user_ws2 = await connect_user_websocket(token2)
+        chat_ws2 = await connect_websocket(token2, chat_id)
+        try:
+            sent = [(await send_and_receive_message(ws1, chat_id))["message_id"] for _ in range(2)]
+            await wait_for_unread(user_ws2, baseline + 2)
+            assert await unread_of_chat() == baseline + 2
+
+            await chat_ws2.send(json.dumps({
+                "message_type": "read_status",
+                "chat_id": chat_id,
+                "message_id": sent[-1]
+            }))
+            await wait_for_type(chat_ws2, "response_type", "read_status")
+            await wait_for_unread(user_ws2, 0)
+            assert await unread_of_chat() == 0
+
+            # Отправка, удаление и прочтение через REST тоже рассылают счётчики
+            async with aiohttp.ClientSession(base_url="http://localhost:8000") as http:
+                async def rest(method: str, url: str, token: str, **kwargs) -> dict:
+                    async with http.request(
+                        method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs
+                    ) as response:
+                        assert response.status < 300, await response.text()
+                        return await response.json()
+
+                rest_sent = [
+                    (await rest("POST", "/api/v1/messages/create", token1,
+                                json={"text": "REST unread", "chat_id": chat_id}))["id"]
+                    for _ in range(2)
+                ]
+                await wait_for_unread(user_ws2, 2)
+                await rest("DELETE", f"/api/v1/messages/{rest_sent[-1]}/delete", token1)
+                await wait_for_unread(user_ws2, 1)
+                await rest("POST", f"/api/v1/messages/{rest_sent[0]}/read", token2)
+                await wait_for_unread(user_ws2, 0)
+        finally:
+            await ws1.close()
+            await user_ws2.close()
+            await chat_ws2.close()
+
+    @pytest.mark.asyncio
+    async def test_handshake_membership(self, client: AsyncClient):
+        """Тест контекста соединения: не участник получает отказ до accept, исключённый - закрытие 4003"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        token3 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA_2)
+        headers1 = {"Authorization": f"Bearer {token1}"}
+        user2 = (await client.get("/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"})).json()
+
+        response = await client.post("/api/v1/chats/create", headers=headers1, json={
+            "chat_type": "group",
+            "name": "Handshake chat",
+            "member_ids": [user2["id"]]
+        })
+        assert response.status_code == 200
+        chat_id = response.json()["id"]
+
+        with pytest.raises(websockets.exceptions.InvalidStatus) as rejected:
+            await connect_websocket(token3, chat_id)
+        assert rejected.value.response.status_code == 403
+        with pytest.raises(websockets.exceptions.InvalidStatus):
+            await connect_websocket(token1, 999999999)
+
+        ws2 = await connect_websocket(token2, chat_id)
+        try:
+            await ws2.send(json.dumps({
+                "message_type": "user_status",
+                "chat_id": chat_id,
+                "user_id": user2["id"],
+                "status": "connected"
+            }))
+            status = await wait_for_type(ws2, "response_type", "user_status")
+            assert status["user_id"] == user2["id"]
+
+            response = await client.post(f"/api/v1/chats/{chat_id}/members/remove", headers=headers1, json=[user2["id"]])
+            assert response.status_code == 200
+
+            # Соединение закрывается по уведомлению об изменении состава,
+            # а если кадр успел раньше - при перепроверке членства на этом кадре
+            with pytest.raises(websockets.exceptions.ConnectionClosed) as closed:
+                await ws2.send(json.dumps({
+                    "message_type": "user_status",
+                    "chat_id": chat_id,
+                    "user_id": user2["id"],
+                    "status": "connected"
+                }))
+                await wait_for_type(ws2, "response_type", "user_status")
+            assert closed.value.rcvd.code == 4003
+        finally:
+            await ws2.close()
+
+    @pytest.mark.asyncio
+    async def test_membership_delta_event(self, client: AsyncClient):
+        """Тест события membership_delta: изменение состава приходит участникам с версией"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        token3 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA_2)
+        user2 = (await client.get("/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"})).json()
+        user3 = (await client.get("/api/v1/users/me", headers={"Authorization": f"Bearer {token3}"})).json()
+
+        response = await client.post("/api/v1/chats/create", headers={"Authorization": f"Bearer {token1}"}, json={
+            "chat_type": "group",
+            "name": "Membership delta chat",
+            "member_ids": [user2["id"]]
+        })
+        chat = response.json()
+
+        ws2 = await connect_websocket(token2, chat["id"])
+        try:
+            # Изменение через HTTP того же сервера, что держит соединение
+            async with aiohttp.ClientSession() as http:
+                async with http.post(
+                    f"http://localhost:8000/api/v1/chats/{chat['id']}/members/add",
+                    headers={"Authorization": f"Bearer {token1}"},
+                    json=[user3["id"]],
+                    timeout=aiohttp.ClientTimeout(total=5)
+                ) as response:
+                    assert response.status == 200
+                    assert (await response.json())["membership_version"] == chat["membership_version"] + 1
+
+            event = await wait_for_type(ws2, "message_type", "membership_delta")
+            assert event["chat_id"] == chat["id"]
+            assert event["version"] == chat["membership_version"] + 1
+            assert event["added"] == [user3["id"]]
+            assert event["removed"] == []
+        finally:
+            await ws2.close()
+
+    @pytest.mark.asyncio
+    async def test_removed_member_detached(self, client: AsyncClient):
+        """Тест исключения: молчащий исключённый участник перестаёт получать события чата"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        headers1 = {"Authorization": f"Bearer {token1}"}
+        user2 = (await client.get("/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"})).json()
+
+        chat_id = (await client.post("/api/v1/chats/create", headers=headers1, json={
+            "chat_type": "group",
+            "name": "Eviction chat",
+            "member_ids": [user2["id"]]
+        })).json()["id"]
+
+        chat_ws = await connect_websocket(token2, chat_id)
+        user_ws = await connect_user_websocket(token2)
+        sender_ws = await connect_websocket(token1, chat_id)
+        try:
+            await user_ws.send(json.dumps({"message_type": "subscribe", "chat_ids": [chat_id]}))
+            assert (await wait_for_type(user_ws, "response_type", "subscribe"))["chat_ids"] == [chat_id]
+
+            # Состав меняет другой процесс: сервер узнаёт об этом из уведомления chat_members
+            response = await client.post(f"/api/v1/chats/{chat_id}/members/remove", headers=headers1, json=[user2["id"]])
+            assert response.status_code == 200
+
+            # По-чатовое соединение закрывается, хотя клиент ничего не отправлял
+            with pytest.raises(websockets.exceptions.ConnectionClosed) as closed:
+                await wait_for_type(chat_ws, "message_type", "new_message")
+            assert closed.value.rcvd.code == 4003
+
+            response_data = await send_and_receive_message(sender_ws, chat_id)
+            assert response_data["response_type"] == "new_message"
+            with pytest.raises(asyncio.TimeoutError):
+                await wait_for_type(user_ws, "message_type", "new_message", timeout=1)
+        finally:
+            await chat_ws.close()
+            await user_ws.close()
+            await sender_ws.close()
+
+    @pytest.mark.asyncio
+    async def test_connection_context_version(self, client: AsyncClient):
+        """Тест контекста соединения: актуален без кэша составов и устаревает только при изменении состава"""
+        token1 = await get_auth_token(client, VALID_LOGIN_DATA)
+        token2 = await get_auth_token(client, ADDITIONAL_TEST_USER_DATA)
+        headers1 = {"Authorization": f"Bearer {token1}"}
+        user1 = UserInDB.model_validate((await client.get("/api/v1/users/me", headers=headers1)).json())
+        user2 = (await client.get("/api/v1/users/me", headers={"Authorization": f"Bearer {token2}"})).json()
+
+        chat_id = (await client.post("/api/v1/chats/create", headers=headers1, json={
+            "chat_type": "group",
+            "name": "Context version chat",
+            "member_ids": [user2["id"]]
+        })).json()["id"]
+
+        # Кэш составов в процессе тестов не запущен: состав не закэширован, но контекст актуален
+        handler = WebSocketMessageHandler(websocket_manager, session_scope)
+        context = await handler.load_connection_context(chat_id, user1)
+        assert membership_cache.get(chat_id) is None
+        assert context.is_current
+        assert context.member_ids == {user1.id, user2["id"]}
+
+        # Изменения других чатов контекст не затрагивают
+        membership_cache.invalidate(-chat_id)
+        assert context.is_current
+
+        response = await client.post(f"/api/v1/chats/{chat_id}/members/remove", headers=headers1, json=[user2["id"]])
+        assert response.status_code == 200
+        assert not context.is_current
+        context = await handler.load_connection_context(chat_id, user1)
+        assert context.is_current
+        assert context.member_ids == {user1.id}
@@ -0,0 +1,58 @@
+import asyncio
+
+import typer
+
+from src.core.db import AsyncSessionFactory
+from src.features.messages.services import MessageService
+from src.features.chats.services import ChatService
+
+
+app = typer.Typer(help="Обслуживание базы данных мессенджера")
+
+
+@app.callback()
+def main():
+    """Команды обслуживания; запуск: python maintenance.py <команда>"""
+
+
+async def _prune_idempotency_keys() -> int:
+    async with AsyncSessionFactory() as session:
+        return await MessageService(session).prune_idempotency_keys()
+
+
+@app.command("prune-idempotency-keys")
+def prune_idempotency_keys():
+    """Очистка ключей идемпотентности сообщений старше IDEMPOTENCY_KEY_TTL_HOURS"""
+    pruned = asyncio.run(_prune_idempotency_keys())
+    print(f"✅ Очищено ключей идемпотентности: {pruned}")
+
+
+
+async def _check_chat_stats(repair: bool) -> list[dict]:
+    async with AsyncSessionFactory() as session:
+        return await ChatService(session).check_stats(repair)
+
+
+@app.command("check-chat-stats")
+def check_chat_stats(
+    repair: bool = typer.Option(False, "--repair", help="Пересчитать найденные расхождения")
+):
+    """Сверка денормализованной статистики чатов (последнее сообщение, активность, число участников)"""
+    inconsistent = asyncio.run(_check_chat_stats(repair))
+    for chat in inconsistent:
+        print(
+            f"⚠️ Чат {chat['chat_id']}: "
+            f"last_message_id {chat['last_message_id']} -> {chat['actual_last_message_id']}, "
+            f"last_activity_at {chat['last_activity_at']} -> {chat['actual_last_activity_at']}, "
+            f"member_count {chat['member_count']} -> {chat['actual_member_count']}"
+        )
+    if not inconsistent:
+        print("✅ Статистика чатов согласована")
+    elif repair:
+        print(f"✅ Исправлено чатов: {len(inconsistent)}")
+    else:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()